@@ -22,6 +22,8 @@ import yum
 import yum.Errors
 
 from utils import YumUtilBase
+from yumutils.profiling import add_profile_option, get_profiler, snapshot
+from yumutils.profiling import NoProfiler
 from yum import _
 
 import logging
@@ -51,13 +53,18 @@ class DebugInfoInstall(YumUtilBase):
         opts.add_option("", "--no-debuginfo-plugin",
                         action="store_true",
                         help="Turn off automatic installation/update of the yum debuginfo plugin")
+        add_profile_option(opts)
 
         self.done = set()
+        self.profiler = NoProfiler()
         try:
-            self.main()
-        except yum.Errors.YumBaseError, e:
-            print e
-            sys.exit(1)
+            try:
+                self.main()
+            except yum.Errors.YumBaseError, e:
+                print e
+                sys.exit(1)
+        finally:
+            self.profiler.done()
 
     def doUtilConfigSetup(self, *args, **kwargs):
         """ We override this to get our extra option out. """
@@ -67,7 +74,10 @@ class DebugInfoInstall(YumUtilBase):
 
     def main(self):
         # Parse the commandline option and setup the basics.
+        start = snapshot()
         opts = self.doUtilConfigSetup()
+        self.profiler = get_profiler(opts.profile)
+        self.profiler.phase('config', start)
         # Check if there is anything to do.
         if len(self.cmds) < 1: 
             print self.optparser.format_help()
@@ -104,8 +114,10 @@ class DebugInfoInstall(YumUtilBase):
                         setattr(r, opt, getattr(repo, opt))
 
         # Setup yum (Ts, RPM db, Repo & Sack)
+        self.profiler.phase('yum setup')
         self.doUtilYumSetup()
         
+        self.profiler.phase('depsolve')
         self.debugInfo_main()
         if hasattr(self, 'doUtilBuildTransaction'):
             errc = self.doUtilBuildTransaction()
@@ -122,6 +134,7 @@ class DebugInfoInstall(YumUtilBase):
             self.doUnlock()
             sys.exit()
             
+        self.profiler.phase('transaction')
         sys.exit(self.doUtilTransaction())
 
     def di_try_install(self, po):
@@ -21,7 +21,9 @@ import os.path
 from optparse import OptionParser
 
 import yum
+from yumutils.profiling import add_profile_option, get_profiler, snapshot
 
+start = snapshot()
 my = yum.YumBase()
 my.conf.showdupesfromrepos = 1
 
@@ -44,9 +46,12 @@ if True:
                       help="use private cache (default when used as non-root)")
     parser.add_option("--sync2yumdb", action="store_true",
                       help="sync anything that is found to the yumdb, if available")
+    add_profile_option(parser)
 
 
     (opts, args) = parser.parse_args()
+    profiler = get_profiler(opts.profile)
+    profiler.phase('config', start)
 
     if not my.setCacheDir(opts.tempcache):
         my.logger.error("Error: Could not make cachedir, exiting")
@@ -56,6 +61,7 @@ if True:
         my.conf.cache = True
         my.logger.info('Running from cache, results might be incomplete.')
 
+    profiler.phase('repo setup')
     if opts.repofrompath:
         # setup the fake repos
         for repo in opts.repofrompath:
@@ -94,6 +100,8 @@ if True:
 
 
 
+#  The rpmdb and the pkgSack (if it's needed) are loaded as we go.
+profiler.phase('query')
 if len(args) >= 1:
     pkgs = my.rpmdb.returnPackages(patterns=sys.argv[1:], ignore_case=True)
 else:
@@ -112,5 +120,6 @@ for ipkg in sorted(pkgs):
         if opts.sync2yumdb: # and hasattr(ipkg, 'yumdb_info'): for compat. ?
             ipkg.yumdb_info.from_repo = apkg.repoid
         print '%s from repo %s' % (ipkg, apkg.repoid)
+profiler.done()
         
     
@@ -34,6 +34,8 @@ import yum.depsolve # For flags
 from yum.Errors import YumBaseError
 from rpmUtils import miscutils, arch
 from optparse import OptionGroup
+from yumutils.profiling import add_profile_option, get_profiler, snapshot
+from yumutils.profiling import NoProfiler
 
 def exactlyOne(l):
     return len(filter(None, l)) == 1
@@ -57,7 +59,11 @@ class PackageCleanup(YumUtilBase):
         self.optparser = self.getOptionParser()
         self.optparser_grp = self.getOptionGroup()
         self.addCmdOptions()
-        self.main()
+        self.profiler = NoProfiler()
+        try:
+            self.main()
+        finally:
+            self.profiler.done()
 
     def addCmdOptions(self):
         self.optparser_grp.add_option("--problems", default=False, 
@@ -121,6 +127,7 @@ class PackageCleanup(YumUtilBase):
                              help='Do not remove kernel-devel packages when '
                                  'removing kernels')
         self.optparser.add_option_group(kernelgrp)
+        add_profile_option(self.optparser_grp)
     
     def _find_installed_duplicates(self, ignore_kernel=True):
         """find installed duplicate packages returns a dict of 
@@ -322,7 +329,10 @@ class PackageCleanup(YumUtilBase):
 
 
     def main(self):
+        start = snapshot()
         opts = self.doUtilConfigSetup()
+        self.profiler = get_profiler(opts.profile)
+        self.profiler.phase('config', start)
         if not exactlyOne([opts.problems, opts.dupes, opts.leaves, opts.kernels,
                            opts.orphans, opts.cleandupes]):
             print self.optparser.format_help()
@@ -331,6 +341,7 @@ class PackageCleanup(YumUtilBase):
         if self.conf.uid != 0:
             self.setCacheDir()
         
+        self.profiler.phase('check')
         if opts.problems:
             issues = self.rpmdb.check_dependencies()
             for prob in issues:
@@ -360,6 +371,7 @@ class PackageCleanup(YumUtilBase):
                 
             self._remove_old_kernels(opts.kernelcount, opts.keepdevel)
             self.run_with_package_names.add('yum-utils')
+            self.profiler.phase('depsolve')
             if hasattr(self, 'doUtilBuildTransaction'):
                 errc = self.doUtilBuildTransaction()
                 if errc:
@@ -375,6 +387,7 @@ class PackageCleanup(YumUtilBase):
                 print 'No old kernels to remove'
                 sys.exit(0)
             
+            self.profiler.phase('transaction')
             sys.exit(self.doUtilTransaction())
             
         
@@ -417,6 +430,7 @@ class PackageCleanup(YumUtilBase):
                         's' if count > 1 else ''))
             self.run_with_package_names.add('yum-utils')
 
+            self.profiler.phase('depsolve')
             if hasattr(self, 'doUtilBuildTransaction'):
                 errc = self.doUtilBuildTransaction()
                 if errc:
@@ -433,6 +447,7 @@ class PackageCleanup(YumUtilBase):
                 print 'No duplicates to remove'
                 errc = 0
             else:
+                self.profiler.phase('transaction')
                 errc = self.doUtilTransaction()
 
             if excluded:
@@ -23,6 +23,7 @@ import yum
 import sys
 from yum.misc import getCacheDir
 from optparse import OptionParser
+from yumutils.profiling import add_profile_option, get_profiler
 
 default_header = """
 size="20.69,25.52";
@@ -101,13 +102,17 @@ if __name__ == '__main__':
                       default="/etc/yum.conf", help="config file location")
     #parser.add_option("--header", dest="header", action="store",
     #                  help="specify alternative .dot header")
+    add_profile_option(parser)
     (opts, args) = parser.parse_args()
 
+    profiler = get_profiler(opts.profile)
+    profiler.phase('config')
     my = yumQuiet()
     my.doConfigSetup(opts.conffile, init_plugins=False)
     cachedir = getCacheDir()
     my.repos.setCacheDir(cachedir)
 
+    profiler.phase('repo setup')
     if len(opts.repoid) > 0:
         for repo in my.repos.findRepos('*'):
             if repo.id not in opts.repoid:
@@ -117,10 +122,13 @@ if __name__ == '__main__':
     try:
         my.doRepoSetup()
         my.doTsSetup()
+        profiler.phase('sack setup')
         my.doSackSetup()
 
+        profiler.phase('graph')
         my.doDot(default_header)
     except yum.Errors.YumBaseError, e:
         print "Encountered an error creating graph: %s" % e
         sys.exit(1)
+    profiler.done()
         
@@ -25,6 +25,7 @@ import os
 import libxml2
 import time
 from optparse import OptionParser
+from yumutils.profiling import add_profile_option, get_profiler
 
 class YumQuiet(yum.YumBase):
     def __init__(self):
@@ -180,12 +181,15 @@ def makeFeed(filename, title, link, description, recent, my):
 def main(options, args):
     days = options.days
     repoids = args
+    profiler = get_profiler(options.profile)
+    profiler.phase('config')
     my = YumQuiet()
     if options.config:
         my.doConfigSetup(init_plugins=False, fn=options.config)
     else:
         my.doConfigSetup(init_plugins=False)
 
+    profiler.phase('repo setup')
     if os.geteuid() != 0 or options.tempcache:
         cachedir = getCacheDir()
         if cachedir is None:
@@ -207,6 +211,7 @@ def main(options, args):
         print 'Cannot continue'
         sys.exit(1)
     print 'Reading in repository metadata - please wait....'
+    profiler.phase('sack setup')
     if len(options.arches):
         my._getSacks(archlist=options.arches)
     else:
@@ -221,6 +226,7 @@ def main(options, args):
             print >> sys.stderr, 'run as root to get changelog data'
             sys.exit(1)
     
+    profiler.phase('feeds')
     recent = my.getRecent(days=days)
     recent.sort(key=lambda pkg: pkg.returnSimple('filetime'))
     recent.reverse()
@@ -248,6 +254,7 @@ def main(options, args):
             makeFeed(filename, title, options.link, description, packages, my)
     # Always make a full feed
     makeFeed(options.filename, options.title, options.link, options.description, recent, my)
+    profiler.done()
     
 
 
@@ -276,6 +283,7 @@ if __name__ == "__main__":
                       help="arches to use - can be listed more than once")
     parser.add_option("-c", action='store', dest='config', default=None,
                       help="config file")
+    add_profile_option(parser)
     (options, args) = parser.parse_args()
 
     main(options, args)
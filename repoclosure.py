@@ -21,8 +21,12 @@
 #   packages with unresolved dependencies
 
 import fnmatch
+import re
 import sys
 import os
+import multiprocessing
+import json
+import cPickle as pickle
 
 import logging
 import yum
@@ -31,8 +35,11 @@ from yum.misc import getCacheDir
 from optparse import OptionParser
 import rpmUtils.arch
 import rpmUtils.updates
+from rpmUtils.miscutils import rangeCompare
 from yum.constants import *
-from yum.packageSack import ListPackageSack
+from yum.sqlitesack import decodefilenamelist
+from yumutils.metadata import prefetch_metadata, format_timing
+from yumutils.profiling import add_profile_option, get_profiler, NoProfiler
 
 
 def filter_repos(patterns, repolist):
@@ -81,9 +88,278 @@ def parseArgs():
                       help="check closure for this package only")
     parser.add_option("-g", "--group", action="append",
                       help="check closure for packages in this group only")
+    parser.add_option("-j", "--jobs", default=1, type="int",
+                      help="check the dependencies with this many processes (default: 1)")
+    parser.add_option("--state-file", default=None,
+                      help="save the results to this file, and only recheck the packages affected by repo changes since the last run with it")
+    parser.add_option("--output", default="text", choices=['text', 'json'],
+                      help="output format to use (can be text|json, default to 'text')")
+    parser.add_option("--baseline", default=None,
+                      help="only print what is newly broken or fixed since this --output=json report")
+    add_profile_option(parser)
     (opts, args) = parser.parse_args()
+    if opts.output == 'json':
+        # stdout is just the report
+        opts.quiet = True
     return (opts, args)
 
+def req_string(n, f, v):
+    """ Return the string for an unresolved requirement. """
+    req = '%s' % n
+    if f:
+        flag = LETTERFLAGS[f]
+        req = '%s %s'% (req, flag)
+    if v:
+        req = '%s %s' % (req, v)
+    return req
+
+#  The fields of the --output=json entries, the first four are what they are
+# compared on with --baseline.
+report_fields = ('name', 'arch', 'repo', 'requires', 'package')
+
+def report_entries(baddeps):
+    """
+    Return the (name, arch, repo, requires, package) entries of the
+    unresolved deps, sorted.
+    """
+    entries = []
+    for (pkg, reqs) in baddeps.iteritems():
+        for (n, f, v) in reqs:
+            entries.append((pkg.name, pkg.arch, pkg.repoid, req_string(n, f, v),
+                            str(pkg)))
+    entries.sort()
+    return entries
+
+def write_json_report(entries, out=sys.stdout, status=False):
+    """
+    Write the entries as a JSON list, with an object per line so it can be
+    read back by read_json_report() without loading all of it. With status
+    the entries are (status, entry), from diff_reports().
+    """
+    out.write('[')
+    sep = '\n'
+    for entry in entries:
+        fields = []
+        if status:
+            (status_val, entry) = entry
+            fields.append('"status": %s' % json.dumps(status_val))
+        for (key, val) in zip(report_fields, entry):
+            fields.append('%s: %s' % (json.dumps(key), json.dumps(val)))
+        out.write(sep + '{' + ', '.join(fields) + '}')
+        sep = ',\n'
+    out.write('\n]\n')
+
+def read_json_report(fn):
+    """
+    Yield the entries of a report written by write_json_report(), a line at
+    a time. Raises ValueError if it isn't one.
+    """
+    fo = open(fn)
+    try:
+        for line in fo:
+            line = line.strip().rstrip(',')
+            if line in ('', '[', ']'):
+                continue
+            data = json.loads(line)
+            try:
+                yield tuple([data[key] for key in report_fields])
+            except (KeyError, TypeError):
+                raise ValueError("%s is not a repoclosure report" % fn)
+    finally:
+        fo.close()
+
+def diff_reports(old, new):
+    """
+    Merge two sorted lists of entries, yielding ('fixed', entry) for the
+    ones only in old and ('broken', entry) for the ones only in new. Entries
+    are the same if they just differ in the package version.
+    """
+    old = iter(old)
+    new = iter(new)
+    oentry = next(old, None)
+    nentry = next(new, None)
+    while oentry is not None or nentry is not None:
+        if nentry is None or (oentry is not None and
+                              oentry[:4] < nentry[:4]):
+            yield ('fixed', oentry)
+            oentry = next(old, None)
+        elif oentry is None or nentry[:4] < oentry[:4]:
+            yield ('broken', nentry)
+            nentry = next(new, None)
+        else:
+            oentry = next(old, None)
+            nentry = next(new, None)
+
+class ProvidesIndex:
+    """
+    The provides of all the packages in a set of repos by name, and the
+    files they have, so requires can be checked in memory instead of with a
+    whatProvides() call (and sqlite queries) for each one.
+    """
+
+    def __init__(self, filereqs=None):
+        # name => [(flags, (e, v, r), pkg)]
+        self.provides = {}
+        # path => [pkg]
+        self.files = {}
+        #  Just index these files, there are a lot more files in a repo than
+        # there are file requires. None means all of them.
+        self.filereqs = filereqs
+        self._filedirs = None
+        if filereqs is not None:
+            self._filedirs = set([os.path.dirname(fn) for fn in filereqs])
+
+    def addProvide(self, pkg, name, flags, evr):
+        if flags not in (None, 'EQ'):
+            #  A provide without the version is provided at the package's
+            # version, as in YumAvailablePackage.matchingPrcos()
+            (e, v, r) = evr
+            if e is None:
+                e = pkg.epoch
+            if v is None:
+                v = pkg.ver
+            if r is None:
+                r = pkg.rel
+            evr = (e, v, r)
+        if name not in self.provides:
+            self.provides[name] = []
+        self.provides[name].append((flags, evr, pkg))
+
+    def addFile(self, pkg, fn):
+        if self.filereqs is not None and fn not in self.filereqs:
+            return
+        if fn not in self.files:
+            self.files[fn] = []
+        self.files[fn].append(pkg)
+
+    def addPackage(self, pkg):
+        """ Add the provides and files of a package. """
+        for (n, f, evr) in pkg.returnPrco('provides'):
+            self.addProvide(pkg, n, f, evr)
+        self.addPackageFiles(pkg)
+
+    def addPackageFiles(self, pkg):
+        """ Add the files of a package. """
+        for ftype in pkg.returnFileTypes():
+            for fn in pkg.returnFileEntries(ftype):
+                self.addFile(pkg, fn)
+
+    def addSqliteRepo(self, sack, repo, pkgs):
+        """
+        Add the provides and files of the pkgs from the repo, reading them
+        straight from the sqlite metadata of the sack. Only the given pkgs
+        are added (the rows of excluded or deleted packages are skipped).
+        """
+        bykey = dict([(pkg.pkgKey, pkg) for pkg in pkgs])
+        cur = sack.primarydb[repo].cursor()
+        cur.execute("SELECT pkgKey, name, flags, epoch, version, release "
+                    "FROM provides")
+        for (key, n, f, e, v, r) in cur:
+            pkg = bykey.get(key)
+            if pkg is not None and n:
+                self.addProvide(pkg, n, f, (e, v, r))
+        self.addSqliteFiles(sack, repo, pkgs)
+
+    def addSqliteFiles(self, sack, repo, pkgs):
+        """
+        Add the files of the pkgs from the repo, from filelists if the sack
+        has it loaded, else from primary.
+        """
+        if repo not in getattr(sack, 'filelistsdb', {}):
+            #  Just the files in primary, which is what most of the file
+            # requires are for anyway.
+            bykey = dict([(pkg.pkgKey, pkg) for pkg in pkgs])
+            cur = sack.primarydb[repo].cursor()
+            cur.execute("SELECT pkgKey, name FROM files")
+            for (key, fn) in cur:
+                pkg = bykey.get(key)
+                if pkg is not None:
+                    self.addFile(pkg, fn)
+            return
+
+        #  filelists has it's own pkgKeys, so match on pkgId
+        bypkgid = dict([(pkg.pkgId, pkg) for pkg in pkgs])
+        cur = sack.filelistsdb[repo].cursor()
+        cur.execute("SELECT packages.pkgId, dirname, filenames "
+                    "FROM filelist JOIN packages USING(pkgKey)")
+        for (pkgId, dirname, filenames) in cur:
+            if self._filedirs is not None and dirname not in self._filedirs:
+                continue
+            pkg = bypkgid.get(pkgId)
+            if pkg is None:
+                continue
+            if dirname == '/':
+                dirname = ''
+            for fn in decodefilenamelist(filenames):
+                self.addFile(pkg, '%s/%s' % (dirname, fn))
+
+    def pkgNames(self, pkgkey):
+        """
+        Return a dict of pkgkey(pkg) => set of the names (and indexed files)
+        the pkg provides.
+        """
+        ret = {}
+        def _add(pkg, name):
+            key = pkgkey(pkg)
+            if key not in ret:
+                ret[key] = set()
+            ret[key].add(name)
+        for (name, provs) in self.provides.iteritems():
+            for (flags, evr, pkg) in provs:
+                _add(pkg, name)
+        for (name, pkgs) in self.files.iteritems():
+            for pkg in pkgs:
+                _add(pkg, name)
+        return ret
+
+    def providers(self, name, flags, evr):
+        """
+        Return the packages which provide the requirement, like
+        YumBase.whatProvides() does.
+        """
+        ret = []
+        (e, v, r) = evr
+        if v is None:
+            evr = (None, None, None)
+            if name.startswith('/'):
+                # file dep, all the pkgs with the file
+                ret.extend(self.files.get(name, []))
+        elif e is None:
+            #  Same as when whatProvides() parses the version string
+            evr = ('0', v, r)
+        reqtuple = (name, flags, evr)
+        for (pflags, pevr, pkg) in self.provides.get(name, []):
+            if not flags or rangeCompare(reqtuple, (name, pflags, pevr)):
+                ret.append(pkg)
+        return ret
+
+
+#  The files createrepo puts in primary, a file require that doesn't match
+# this can only be resolved with filelists.
+_primary_files_re = re.compile('^(.*bin/.*|/etc/.*|/usr/lib/sendmail)$')
+
+#  The workers are forked from us, so they get what they check from here,
+# instead of having it all pickled.
+_shard_state = None
+
+def _check_shard(start, end):
+    """
+    Worker: check the requires[start:end] of the _shard_state. Returns
+    [(number of pkg in requires, [unresolved reqs])].
+    """
+    (closure, requires, index) = _shard_state
+    try:
+        unresolved = closure._checkRequires(requires[start:end], index)
+    except KeyboardInterrupt:
+        return None
+    ret = []
+    for num in xrange(start, min(end, len(requires))):
+        pkg = requires[num][0]
+        if pkg in unresolved:
+            ret.append((num, unresolved[pkg]))
+    return ret
+
+
 #  Note that this is a "real" API, used by spam-o-matic etc.
 # so we have to do at least some API guarantee stuff.
 class RepoClosure(yum.YumBase):
@@ -99,6 +375,13 @@ class RepoClosure(yum.YumBase):
         self.grouponly = grouponly
         self.doConfigSetup(fn = config,init_plugins=False)
         self._rc_arches = arch
+        self._md_timing = (0, [])
+        self.profiler = NoProfiler()
+        self.jobs = 1
+        self.state_file = None
+        self._state_info = None
+        self._newest_pkgs = []
+        self._index_pkgs = []
 
         if hasattr(self.repos, 'sqlite'):
             self.repos.sqlite = False
@@ -122,8 +405,18 @@ class RepoClosure(yum.YumBase):
 
         return val
 
-    def readMetadata(self):
+    def readMetadata(self, filelists=True):
+        """
+        Set up the repos and their sacks. With filelists=False the filelists
+        aren't loaded here, getBrokenDeps() loads them if there are file
+        requires which primary can't resolve.
+        """
         self.doRepoSetup()
+        # Get all the repos. metadata at once, then set them up from the cache
+        self.profiler.phase('metadata')
+        self._md_timing = prefetch_metadata(self.repos.listEnabled(),
+                                            cache=self.conf.cache)
+        self.profiler.phase('sack setup')
         archs = []
         if not self._rc_arches:
             archs.extend(self.arch.archlist)
@@ -134,33 +427,165 @@ class RepoClosure(yum.YumBase):
         if self.builddeps and 'src' not in archs:
             archs.append('src')
         self.doSackSetup(archs)
+        if not filelists:
+            return
         for repo in self.repos.listEnabled():
             self.repos.populateSack(which=[repo.id], mdtype='filelists')
 
-    def getBrokenDeps(self, newest=False):
-        unresolved = {}
-        resolved = {}
-        pkgs = self.pkgSack
-        if newest:
-            pkgs = self.pkgSack.returnNewestByNameArch()
-            mypkgSack = ListPackageSack(pkgs)
-            pkgtuplist = mypkgSack.simplePkgList()
+    def _sqliteSack(self, repo):
+        """
+        Return the sqlite sack of the repo, if it has one, so we can read
+        all of it's data in one go. Else None.
+        """
+        sack = getattr(self.pkgSack, 'sacks', {}).get(repo.id)
+        if sack is not None and repo in getattr(sack, 'primarydb', {}):
+            return sack
+        return None
+
+    def _byRepo(self, pkgs):
+        """ Return a list of (repo, [pkg]) for the pkgs. """
+        repos = {}
+        for pkg in pkgs:
+            if pkg.repo not in repos:
+                repos[pkg.repo] = []
+            repos[pkg.repo].append(pkg)
+        return repos.items()
+
+    def _returnPrco(self, pkgs, prcotype):
+        """
+        Return a list of (pkg, [(name, flags, (e, v, r))]) of the prcotype
+        (requires, obsoletes, ...) of the pkgs, read in one go for each
+        sqlite repo.
+        """
+        ret = []
+        for (repo, rpkgs) in self._byRepo(pkgs):
+            sack = self._sqliteSack(repo)
+            if sack is None:
+                for pkg in rpkgs:
+                    ret.append((pkg, pkg.returnPrco(prcotype)))
+                continue
 
-            # toss out any of the obsoleted pkgs so we can't depsolve with them
-            self.up = rpmUtils.updates.Updates([], pkgtuplist)
-            self.up.rawobsoletes = mypkgSack.returnObsoletes()
-            for pkg in pkgs:
-                fo = self.up.checkForObsolete([pkg.pkgtup])
-                if fo:
+            prcos = dict([(pkg.pkgKey, []) for pkg in rpkgs])
+            cur = sack.primarydb[repo].cursor()
+            cur.execute("SELECT pkgKey, name, flags, epoch, version, release "
+                        "FROM %s" % prcotype)
+            for (key, n, f, e, v, r) in cur:
+                if key in prcos and n:
+                    prcos[key].append((n, f, (e, v, r)))
+            for pkg in rpkgs:
+                ret.append((pkg, prcos[pkg.pkgKey]))
+        return ret
+
+    def returnRequires(self, pkgs):
+        """
+        Return a list of (pkg, [(req, flags, (e, v, r))]) of the pkgs,
+        without the rpmlib() requires.
+        """
+        ret = []
+        for (pkg, reqs) in self._returnPrco(pkgs, 'requires'):
+            ret.append((pkg, [req for req in reqs
+                              if not req[0].startswith('rpmlib')]))
+        return ret
+
+    def returnNewest(self):
+        """
+        Return the newest packages by name and arch, without the ones that
+        are obsoleted by one of them. Also sets self.up to the Updates of
+        the newest packages, as it always has.
+        """
+        pkgs = self.pkgSack.returnNewestByNameArch()
+
+        #  obsoleted name => [(flags, (e, v, r))], so each package is just
+        # checked against the obsoletes of it's name.
+        obsoletes = {}
+        rawobsoletes = {}
+        for (pkg, obs) in self._returnPrco(pkgs, 'obsoletes'):
+            if obs:
+                rawobsoletes[pkg.pkgtup] = obs
+            for (n, f, evr) in obs:
+                if not f and n == pkg.name:
+                    # as rpmUtils.updates.Updates.checkForObsolete()
+                    continue
+                if n not in obsoletes:
+                    obsoletes[n] = []
+                obsoletes[n].append((f, evr))
+        self.up = rpmUtils.updates.Updates([], [pkg.pkgtup for pkg in pkgs])
+        self.up.rawobsoletes = rawobsoletes
+
+        ret = []
+        for pkg in pkgs:
+            pkgtuple = (pkg.name, 'EQ', (pkg.epoch, pkg.ver, pkg.rel))
+            for (f, evr) in obsoletes.get(pkg.name, []):
+                if rangeCompare((pkg.name, f, evr), pkgtuple):
                     # useful debug to make sure the obsoletes is sane
                     #print "ignoring obsolete pkg %s" % pkg
-                    #for i in fo[pkg.pkgtup]:
-                    #    print i
-                    self.pkgSack.delPackage(pkg)
+                    break
+            else:
+                ret.append(pkg)
+        return ret
+
+    def buildProvidesIndex(self, filereqs=None, pkgs=None):
+        """
+        Return a ProvidesIndex of the pkgs (default: all the packages in the
+        pkgSack), with just the filereqs files (if given).
+        """
+        if pkgs is None:
+            pkgs = self.pkgSack.returnPackages()
+        self._index_pkgs = pkgs
+        index = ProvidesIndex(filereqs)
+        for (repo, pkgs) in self._byRepo(pkgs):
+            sack = self._sqliteSack(repo)
+            if sack is None:
+                for pkg in pkgs:
+                    index.addPackage(pkg)
+            else:
+                index.addSqliteRepo(sack, repo, pkgs)
+        return index
+
+    def _checkRequiresJobs(self, requires, index):
+        """
+        _checkRequires() with self.jobs worker processes, each checking
+        shards of the requires. The workers are forked after the index is
+        built, so they all share it.
+        """
+        global _shard_state
+
+        jobs = min(self.jobs, len(requires))
+        #  More shards than workers, so a worker that gets the big packages
+        # doesn't hold everything up.
+        size = max(1, len(requires) / (jobs * 4))
+        _shard_state = (self, requires, index)
+        pool = multiprocessing.Pool(jobs)
+        try:
+            shards = [pool.apply_async(_check_shard, (start, start + size))
+                      for start in xrange(0, len(requires), size)]
+            pool.close()
+            #  A timeout, so that a ^C isn't ignored while we wait.
+            results = [shard.get(86400) for shard in shards]
+        finally:
+            pool.terminate()
+            pool.join()
+            _shard_state = None
 
-            # we've deleted items so remake the pkgs
-            pkgs = self.pkgSack.returnNewestByNameArch()
-            pkgtuplist = mypkgSack.simplePkgList()
+        unresolved = {}
+        for result in results:
+            if result is None:
+                raise KeyboardInterrupt
+            for (num, reqs) in result:
+                unresolved[requires[num][0]] = reqs
+        return unresolved
+
+    def getBrokenDeps(self, newest=False):
+        #  Before the group packages get added to pkgonly, below.
+        options = self._stateOptions(newest)
+        if newest:
+            #  Only depsolve with the newest pkgs, and toss out any of the
+            # obsoleted ones so we can't depsolve with them.
+            pkgs = self.returnNewest()
+            self._newest_pkgs = pkgs
+        else:
+            pkgs = self.pkgSack.returnPackages()
+        index_pkgs = pkgs
 
         if self.builddeps:
             pkgs = filter(lambda x: x.arch == 'src', pkgs)
@@ -178,55 +603,296 @@ class RepoClosure(yum.YumBase):
         if pkglist:
             pkgs = filter(lambda x: x.name in pkglist, pkgs)
 
-        for pkg in pkgs:
-            if pkg.repoid in self.lookaside:
-                # don't attempt to resolve dependency issues for
-                # packages from lookaside repositories
-                continue
-            for (req, flags, (reqe, reqv, reqr)) in pkg.returnPrco('requires'):
-                if req.startswith('rpmlib'): continue # ignore rpmlib deps
-
-                ver = self.evrTupletoVer((reqe, reqv, reqr))
-                if (req,flags,ver) in resolved:
-                    continue
+        # don't attempt to resolve dependency issues for
+        # packages from lookaside repositories
+        pkgs = [pkg for pkg in pkgs if pkg.repoid not in self.lookaside]
+
+        #  Check the requires against an index of all the provides, instead
+        # of calling whatProvides() for each of them.
+        requires = self.returnRequires(pkgs)
+        filereqs = set()
+        for (pkg, reqs) in requires:
+            for (req, flags, evr) in reqs:
+                if req.startswith('/'):
+                    filereqs.add(req)
+        index = self.buildProvidesIndex(filereqs, index_pkgs)
+
+        if not self.state_file:
+            return self._runCheck(requires, index)
+
+        pkgkey = lambda pkg: (pkg.repoid, pkg.pkgId)
+        names = index.pkgNames(pkgkey)
+        state = self._loadState(options)
+
+        recheck = requires
+        results = {}
+        if state is not None:
+            (recheck, results) = self._stateRecheck(state, requires, names,
+                                                    pkgkey)
+        unresolved = self._runCheck(recheck, index)
+
+        for (pkg, reqs) in recheck:
+            results[pkgkey(pkg)] = unresolved.get(pkg, [])
+        for (pkg, reqs) in requires:
+            if results[pkgkey(pkg)]:
+                unresolved[pkg] = results[pkgkey(pkg)]
+
+        #  The check might have added files from filelists to the index. And
+        # the files a package has don't change, so keep the ones it was
+        # found to have by earlier runs too.
+        names = index.pkgNames(pkgkey)
+        if state is not None:
+            for (key, old) in state['names'].iteritems():
+                if key in names:
+                    names[key].update(old)
+        self._saveState(names, results, options)
+        return unresolved
 
-                resolve_sack = [] # make it empty
-                try:
-                    resolve_sack = self.whatProvides(req, flags, ver)
-                except yum.Errors.RepoError, e:
-                    pass
+    def _runCheck(self, requires, index):
+        """
+        Check the requires against the index, first with the files from
+        primary. If that leaves file requires (that primary can't have)
+        unresolved, add just those files from filelists to the index and
+        check the packages with them again.
+        """
+        unresolved = self._runCheckJobs(requires, index)
+
+        paths = set()
+        for reqs in unresolved.itervalues():
+            for (req, flags, ver) in reqs:
+                if (req.startswith('/') and ver is None and
+                    not _primary_files_re.match(req)):
+                    paths.add(req)
+        if not paths:
+            return unresolved
+
+        self.profiler.phase('filelists')
+        self.addFileLists(index, paths)
+        self.profiler.phase('dependencies')
+        recheck = []
+        for (pkg, reqs) in requires:
+            if pkg not in unresolved:
+                continue
+            for (req, flags, ver) in unresolved[pkg]:
+                if req in paths and ver is None:
+                    recheck.append((pkg, reqs))
+                    break
+        runresolved = self._runCheckJobs(recheck, index)
+        for (pkg, reqs) in recheck:
+            if pkg in runresolved:
+                unresolved[pkg] = runresolved[pkg]
+            else:
+                del unresolved[pkg]
+        return unresolved
 
-                if len(resolve_sack) < 1:
+    def _runCheckJobs(self, requires, index):
+        if self.jobs > 1 and len(requires) > 1:
+            return self._checkRequiresJobs(requires, index)
+        return self._checkRequires(requires, index)
+
+    def addFileLists(self, index, paths):
+        """
+        Load the filelists of the repos, and add the paths to the index
+        from them.
+        """
+        repos = self.repos.listEnabled()
+        prefetch_metadata(repos, ('filelists',), cache=self.conf.cache)
+        findex = ProvidesIndex(paths)
+        pkgs = dict(self._byRepo(self._index_pkgs))
+        for repo in repos:
+            try:
+                self.repos.populateSack(which=[repo.id], mdtype='filelists')
+            except yum.Errors.RepoError, e:
+                self.logger.warning("Could not load filelists of %s: %s" %
+                                    (repo.id, e))
+                continue
+            sack = self._sqliteSack(repo)
+            if sack is not None:
+                findex.addSqliteFiles(sack, repo, pkgs.get(repo, []))
+            else:
+                for pkg in pkgs.get(repo, []):
+                    findex.addPackageFiles(pkg)
+        #  filelists has all the files primary has, for the same packages
+        index.files.update(findex.files)
+
+    def _repoChecksums(self):
+        """ Return a dict of repoid => checksum of primary. """
+        ret = {}
+        for repo in self.repos.listEnabled():
+            try:
+                ret[repo.id] = repo.repoXML.getData('primary').checksum
+            except (yum.Errors.RepoError, yum.Errors.RepoMDError,
+                    KeyError):
+                pass
+        return ret
+
+    def _stateOptions(self, newest):
+        """
+        Return the options which change the results of the check, the state
+        of a run with other ones can't be used.
+        """
+        return {'arch' : sorted(self._rc_arches or []),
+                'basearch' : self.arch.basearch,
+                'newest' : bool(newest),
+                'lookaside' : sorted(self.lookaside),
+                'builddeps' : bool(self.builddeps),
+                'pkgonly' : sorted(self.pkgonly or []),
+                'grouponly' : sorted(self.grouponly or [])}
+
+    def _loadState(self, options):
+        """
+        Return the state saved by the last --state-file run, or None if
+        there isn't a (usable) one: from another version, or a run with
+        other options.
+        """
+        try:
+            fo = open(self.state_file, 'rb')
+            try:
+                state = pickle.load(fo)
+            finally:
+                fo.close()
+            if state['version'] != 3 or state['options'] != options:
+                return None
+        except (IOError, EOFError, KeyError, TypeError, ValueError,
+                pickle.UnpicklingError):
+            return None
+        return state
+
+    def _saveState(self, names, results, options):
+        state = {'version' : 3,
+                 'options' : options,
+                 'checksums' : self._repoChecksums(),
+                 'names' : names,
+                 'results' : results}
+        try:
+            fo = open(self.state_file + '.tmp', 'wb')
+            try:
+                pickle.dump(state, fo, -1)
+            finally:
+                fo.close()
+            os.rename(self.state_file + '.tmp', self.state_file)
+        except (IOError, OSError), e:
+            self.logger.warning("Could not save state to %s: %s" %
+                                (self.state_file, e))
+
+    def _stateRecheck(self, state, requires, names, pkgkey):
+        """
+        Work out what has to be rechecked since the last run, from it's
+        state. That's the packages we don't have a result for, and the ones
+        with a require of something provided by a package that has been
+        added or removed since (or stopped or started being newest), or
+        with an unresolved file require that only filelists could have.
+        Returns (requires to recheck, dict of pkgkey => unresolved reqs we
+        can keep).
+        """
+        old_names = state['names']
+        old_results = state['results']
+        touched = set()
+        for key in names:
+            if key not in old_names:
+                touched.update(names[key])
+        for key in old_names:
+            if key not in names:
+                touched.update(old_names[key])
+
+        recheck = []
+        results = {}
+        for (pkg, reqs) in requires:
+            key = pkgkey(pkg)
+            if key not in old_results:
+                recheck.append((pkg, reqs))
+                continue
+            #  Whatever provides these might not be in the names, if it's
+            # only in filelists.
+            for (req, flags, ver) in old_results[key]:
+                if (req.startswith('/') and ver is None and
+                    not _primary_files_re.match(req)):
+                    recheck.append((pkg, reqs))
+                    break
+            else:
+                for req in reqs:
+                    if req[0] in touched:
+                        recheck.append((pkg, reqs))
+                        break
+                else:
+                    results[key] = old_results[key]
+
+        checksums = self._repoChecksums()
+        old_checksums = state['checksums']
+        changed = [repoid for repoid in checksums
+                   if old_checksums.get(repoid) != checksums[repoid]]
+        self._state_info = ('Repos changed since the last run: %d of %d, '
+                            'rechecking %d of %d packages' %
+                            (len(changed), len(checksums), len(recheck),
+                             len(requires)))
+        return (recheck, results)
+
+    def _checkRequires(self, requires, index):
+        """
+        Check the requires, a list of (pkg, [(req, flags, (e, v, r))]),
+        against the index. Returns a dict of pkg => [unresolved reqs].
+        """
+        unresolved = {}
+        resolved = {}
+        for (pkg, reqs) in requires:
+            for (req, flags, (reqe, reqv, reqr)) in reqs:
+                key = (req, flags, (reqe, reqv, reqr))
+                if key not in resolved:
+                    resolve_sack = index.providers(req, flags,
+                                                   (reqe, reqv, reqr))
+                    resolved[key] = len(resolve_sack) > 0
+
+                if not resolved[key]:
                     if pkg not in unresolved:
                         unresolved[pkg] = []
+                    ver = self.evrTupletoVer((reqe, reqv, reqr))
                     unresolved[pkg].append((req, flags, ver))
-                    continue
-
-                if newest:
-                    resolved_by_newest = False
-                    for po in resolve_sack:# look through and make sure all our answers are newest-only
-                        if po.pkgtup in pkgtuplist:
-                            resolved_by_newest = True
-                            break
-
-                    if resolved_by_newest:
-                        resolved[(req,flags,ver)] = 1
-                    else:
-                        if pkg not in unresolved:
-                            unresolved[pkg] = []
-                        unresolved[pkg].append((req, flags, ver))
 
         return unresolved
 
 
+def print_diff(my, opts, diff):
+    """
+    Print the (status, entry) of diff_reports() in the --output format.
+    Returns the number of newly broken deps.
+    """
+    counts = {'broken' : 0, 'fixed' : 0}
+    def _count(diff):
+        for (status, entry) in diff:
+            counts[status] += 1
+            yield (status, entry)
+
+    if opts.output == 'json':
+        write_json_report(_count(diff), status=True)
+        return counts['broken']
+
+    last = None
+    for (status, entry) in _count(diff):
+        (name, arch, repo, req, package) = entry
+        if (status, package, repo) != last:
+            my.logger.info('package: %s from %s\n  newly %s deps: ' %
+                           (package, repo, status))
+            last = (status, package, repo)
+        my.logger.info('     %s' % req)
+    if not opts.quiet:
+        my.logger.info('Newly broken deps: %d, newly fixed deps: %d' %
+                       (counts['broken'], counts['fixed']))
+    return counts['broken']
+
 def main():
     (opts, cruft) = parseArgs()
+    profiler = get_profiler(opts.profile)
+    profiler.phase('config')
     my = RepoClosure(arch=opts.arch,
                      config=opts.config,
                      builddeps=opts.builddeps,
                      pkgonly=opts.pkg,
                      grouponly=opts.group,
                      basearch=opts.basearch)
+    my.profiler = profiler
+    my.jobs = opts.jobs
+    my.state_file = opts.state_file
+    profiler.phase('repo setup')
 
     if opts.repofrompath:
         # setup the fake repos
@@ -274,18 +940,26 @@ def main():
         my.logger.info('Reading in repository metadata - please wait....')
 
     try:
-        my.readMetadata()
+        my.readMetadata(filelists=False)
     except yum.Errors.RepoError, e:
         my.logger.info(e)
         my.logger.info('Some dependencies may not be complete for this repository')
         my.logger.info('Run as root to get all dependencies or use -t to enable a user temp cache')
 
+    if not opts.quiet:
+        for line in format_timing(*my._md_timing):
+            my.logger.info(line)
+
     if not opts.quiet:
         my.logger.info('Checking Dependencies')
 
+    profiler.phase('dependencies')
     baddeps = my.getBrokenDeps(opts.newest)
+    profiler.phase('output')
+    if my._state_info and not opts.quiet:
+        my.logger.info(my._state_info)
     if opts.newest:
-        num = len(my.pkgSack.returnNewestByNameArch())
+        num = len(my._newest_pkgs)
     else:
         num = len(my.pkgSack)
 
@@ -297,6 +971,26 @@ def main():
             my.logger.info('   %s' % repo)
         my.logger.info('Num Packages in Repos: %s' % num)
 
+    if opts.baseline:
+        try:
+            diff = diff_reports(read_json_report(opts.baseline),
+                                report_entries(baddeps))
+            broken = print_diff(my, opts, diff)
+        except IOError, e:
+            raise yum.Errors.YumBaseError, "Could not read baseline %s: %s" % \
+                  (opts.baseline, e)
+        profiler.done()
+        if broken:
+            sys.exit(1)
+        return
+
+    if opts.output == 'json':
+        write_json_report(report_entries(baddeps))
+        profiler.done()
+        if baddeps:
+            sys.exit(1)
+        return
+
     pkgs = baddeps.keys()
 
     def sortbyname(a,b):
@@ -307,14 +1001,8 @@ def main():
     for pkg in pkgs:
         my.logger.info('package: %s from %s\n  unresolved deps: ' % (pkg, pkg.repoid))
         for (n, f, v) in baddeps[pkg]:
-            req = '%s' % n
-            if f:
-                flag = LETTERFLAGS[f]
-                req = '%s %s'% (req, flag)
-            if v:
-                req = '%s %s' % (req, v)
-
-            my.logger.info('     %s' % req)
+            my.logger.info('     %s' % req_string(n, f, v))
+    profiler.done()
     if baddeps:
         sys.exit(1)
 
@@ -23,6 +23,8 @@ import rpmUtils.arch
 from yum.i18n import to_unicode
 
 from urlgrabber.progress import format_number
+from yumutils.metadata import prefetch_metadata
+from yumutils.profiling import add_profile_option, get_profiler
 
 from optparse import OptionParser
 
@@ -65,6 +67,8 @@ class DiffYum(yum.YumBase):
         self.repos.add(newrepo)        
         # enable that repo
         self.repos.enableRepo(repoid)
+
+    def dy_setup_sack(self, repoid):
         # setup the repo dirs/etc
         self.doRepoSetup(thisrepo=repoid)
         if '*' in self.dy_archlist:
@@ -175,6 +179,7 @@ def parseArgs(args):
                       help="Output upgrade/downgrade separately")
     parser.add_option("--simple",  default=False, action='store_true',
                       help="output simple format")
+    add_profile_option(parser)
     (opts, argsleft) = parser.parse_args()
 
     if not opts.new or not opts.old:
@@ -236,7 +241,8 @@ def _out_mod(opts, oldpkg, pkg, sizechange):
 
 def main(args):
     opts = parseArgs(args)
-
+    profiler = get_profiler(opts.profile)
+    profiler.phase('config')
             
     my = DiffYum()
     archlist_changed = False
@@ -254,24 +260,34 @@ def main(args):
     if archlist_changed:
         my.dy_archlist += my.arch.archlist
 
+    profiler.phase('repo setup')
     if not opts.quiet: print 'setting up repos'
     for r in opts.old:
-        if not opts.quiet: print "setting up old repo %s" % r
-        try:
-            my.dy_setup_repo('old', r)
-        except yum.Errors.RepoError, e:
-            print "Could not setup repo at url  %s: %s" % (r, e)
-            sys.exit(1)
-    
+        my.dy_setup_repo('old', r)
     for r in opts.new:
-        if not opts.quiet: print "setting up new repo %s" % r
-        try:
-            my.dy_setup_repo('new', r)
-        except yum.Errors.RepoError, e:
-            print "Could not setup repo at url %s: %s" % (r, e)
-            sys.exit(1)
+        my.dy_setup_repo('new', r)
+
+    # Download all the metadata at once, then setup each repo from the cache
+    profiler.phase('metadata')
+    try:
+        my.repos.doSetup()
+    except yum.Errors.RepoError, e:
+        print "Could not setup repos: %s" % e
+        sys.exit(1)
+    prefetch_metadata(my.repos.listEnabled(), cache=my.conf.cache)
+    profiler.phase('sack setup')
+    for repotype, urls in (('old', opts.old), ('new', opts.new)):
+        for repoid, r in zip(my.dy_repos[repotype], urls):
+            if not opts.quiet: print "setting up %s repo %s" % (repotype, r)
+            try:
+                my.dy_setup_sack(repoid)
+            except yum.Errors.RepoError, e:
+                print "Could not setup repo at url %s: %s" % (r, e)
+                sys.exit(1)
     if not opts.quiet: print 'performing the diff'
+    profiler.phase('diff')
     ygh = my.dy_diff(opts.compare_arch)
+    profiler.phase('output')
     
 
 
@@ -367,6 +383,7 @@ def main(args):
         print msg % (remove_sizechange, bkMG(remove_sizechange))
         msg = 'Size change: %s (%s)'
         print msg % (total_sizechange, bkMG(total_sizechange))
+    profiler.done()
     
       
 if __name__ == "__main__":
@@ -26,6 +26,14 @@ import time
 import os
 import os.path
 import urlparse
+import shlex
+import socket
+import select
+import json
+import cPickle as pickle
+import csv
+from collections import deque
+from StringIO import StringIO
 
 from optparse import OptionParser
 from optparse import SUPPRESS_HELP
@@ -38,10 +46,12 @@ import yum.Errors
 import yum.packages
 from yum.i18n import to_unicode
 from rpmUtils.arch import getArchList, getBaseArch
-from rpmUtils.miscutils import formatRequire
+from rpmUtils.miscutils import formatRequire, compareEVR
 import output
 from urlgrabber.progress import TextMeter
 from urlgrabber.progress import format_number
+from yumutils.metadata import prefetch_metadata, format_timing
+from yumutils.profiling import add_profile_option, get_profiler, NoProfiler
 
 version = "0.0.11"
 
@@ -138,6 +148,7 @@ class queryError(Exception):
 
 class DotPlot(object):
     def __init__(self):
+        self._added = set()
 
         print 'digraph packages {',
         print """
@@ -151,6 +162,11 @@ ranksep="1";
 """
     
     def addPackage(self, pkg, deps):
+        # Only output each package once, even if it's in multiple trees
+        if str(pkg) in self._added:
+            return
+        self._added.add(str(pkg))
+
         # color calculations lifted from rpmgraph 
         h=0.5+(0.6/23*len(deps))
         s=h+0.1
@@ -165,64 +181,227 @@ ranksep="1";
     def __del__(self):
         print "}"
 
+_qf_tag_re = re.compile('%([-\d]*?){([:\.\w]*?)}')
+_qf_key_re = re.compile('%\(([^)]*)\)')
+
+#  Accessors for querytags, and compiled formats, keyed by
+# (query class, tag/format) ... so they are only worked out once per run.
+_tag_accessors = {}
+_compiled_qfs = {}
+# --qf strings => the %(tag)s formats they translate to
+_translated_qfs = {}
+
+#  The fields in the --search-index, with the weight a word matching in them
+# adds to the rank of a package. Words are runs of letters and digits.
+search_index_fields = {'name' : 8, 'summary' : 4, 'url' : 2, 'description' : 1}
+_search_word_re = re.compile('[^\W_]+', re.UNICODE)
+
+def search_words(text):
+    """ Return the set of (lower case) words in text, for --search-index. """
+    if not text:
+        return set()
+    return set(_search_word_re.findall(to_unicode(text).lower()))
+
+def make_search_index(rows):
+    """
+    Build a --search-index from (key, name, summary, description, url) rows,
+    the whole name is also a word of the name.
+
+    @rtype: dict of field => dict of word => list of keys
+    """
+    fields = ('name', 'summary', 'description', 'url')
+    index = {}
+    for field in fields:
+        index[field] = {}
+    for row in rows:
+        key = row[0]
+        for field, text in zip(fields, row[1:]):
+            words = search_words(text)
+            if field == 'name' and text:
+                words.add(to_unicode(text).lower())
+            findex = index[field]
+            for word in words:
+                findex.setdefault(word, []).append(key)
+    return index
+
+def glob_matcher(patterns):
+    """
+    Return a function which says if a string is (or fnmatches) any of the
+    patterns, using one compiled regex for all of them.
+    """
+    literals = set(patterns)
+    regex = re.compile('|'.join(['(?:%s)' % fnmatch.translate(pat)
+                                 for pat in patterns]))
+    def match(val):
+        return val in literals or regex.match(val) is not None
+    return match
+
+class compiledQueryFormat:
+    """
+    A %(tag)s style format, with the accessor for each tag it uses looked
+    up once. Rendering a package then just calls the accessors and does a
+    single string format, instead of going through pkgQuery.__getitem__
+    for every tag of every package.
+    """
+
+    def __init__(self, fmt, qpkg):
+        self.fmt = fmt
+        self.accessors = []
+        seen = set()
+        for tag in _qf_key_re.findall(fmt):
+            if tag in seen:
+                continue
+            seen.add(tag)
+            self.accessors.append((tag, qpkg._tag_accessor(tag)))
+
+    def render(self, qpkg):
+        vals = {}
+        for tag, accessor in self.accessors:
+            vals[tag] = accessor(qpkg)
+        return self.fmt % vals
+
+#  Outputs which write a record per package, instead of text. These fields are
+# used when there's no --qf, and these pkgops give lists.
+record_outputs = ('jsonl', 'csv')
+record_tags = ['name', 'epoch', 'version', 'release', 'arch', 'repoid']
+record_lists = ['requires', 'provides', 'conflicts', 'obsoletes',
+                'weak_requires', 'info_requires',
+                'weak_reverse_requires', 'info_reverse_requires', 'list']
+
+class JSONLOutput(object):
+    """ Write records as JSON objects, one per line. """
+
+    def addRecord(self, record):
+        fields = []
+        for key, val in record:
+            fields.append('%s: %s' % (json.dumps(key),
+                                      json.dumps(val, default=to_unicode)))
+        print '{' + ', '.join(fields) + '}'
+
+class CSVOutput(object):
+    """ Write records as CSV, with a header row from the first record. """
+
+    def __init__(self):
+        self._writer = csv.writer(sys.stdout)
+        self._header = False
+
+    def _val2field(self, val):
+        if val is None:
+            return ''
+        if isinstance(val, (list, tuple)):
+            val = "\n".join([to_unicode(v) for v in val])
+        return to_unicode(val).encode('utf-8')
+
+    def addRecord(self, record):
+        if not self._header:
+            self._writer.writerow([key for key, val in record])
+            self._header = True
+        self._writer.writerow([self._val2field(val) for key, val in record])
+
 # abstract class
-class pkgQuery:
+class pkgQuery(object):
     """
     My implementation of __getitem__ either forwards to an implementation
     of fmt_(name), or to self.pkg.returnSimple(), allowing subclasses
     to override the package's items.
 
+    There can be one of these per package, so they only have slots and
+    everything worked out from the query format is shared.
+
     @type pkg: L{yum.package.YumAvailablePackage}
     @ivar qf:  the query format for this package query
     @type qf:  str
     """
+    __slots__ = ('yb', 'pkg', 'qf', 'name')
+
+    classname = None
+
+    #  Text pkgops which are a list of lines, the prco type they list (None
+    # for files). These are printed a line at a time, see iterQuery().
+    list_ops = {'list' : None,
+                'provides' : 'provides',
+                'requires' : 'requires',
+                'conflicts' : 'conflicts',
+                'obsoletes' : 'obsoletes',
+                'weak_requires' : 'weak_requires',
+                'recommends' : 'weak_requires',
+                'info_requires' : 'info_requires',
+                'suggests' : 'info_requires',
+                'weak_reverse_requires' : 'weak_reverse_requires',
+                'supplements' : 'weak_reverse_requires',
+                'info_reverse_requires' : 'info_reverse_requires',
+                'enhances' : 'info_reverse_requires'}
 
     def __init__(self, pkg, qf, yb=None):
         self.yb = yb
         self.pkg = pkg
         self.qf = qf
         self.name = pkg.name
-        self.classname = None
-        self._translated_qf = {}
     
     def __getitem__(self, item):
-        item = item.lower()
-        if hasattr(self, "fmt_%s" % item):
-            return getattr(self, "fmt_%s" % item)()
-        elif item.startswith('repo.'):
+        return self._tag_accessor(item)(self)
+
+    def _tag_accessor(self, tag):
+        """
+        Return the (cached) accessor for a querytag, a callable taking a
+        query of this class and returning the value of the tag.
+        """
+        key = (self.__class__, tag)
+        if key not in _tag_accessors:
+            _tag_accessors[key] = self._compile_tag(tag)
+        return _tag_accessors[key]
+
+    def _compile_tag(self, tag):
+        """
+        Work out once how a querytag is looked up, so that rendering
+        doesn't have to redo that for every package.
+        """
+        item = tag.lower()
+        fmt = getattr(self.__class__, "fmt_%s" % item, None)
+        if fmt is not None:
+            return fmt
+        if item.startswith('repo.'):
             repo_item = item.split('.')[1]
-            try:
-                return getattr(self.pkg.repo, repo_item)
-            except AttributeError,e:
-                raise queryError("Invalid repo querytag '%s' for %s: %s" % (repo_item, self.classname, self.pkg))
-        elif hasattr(self.pkg, item):
-            return getattr(self.pkg, item)
+            def get_repo_item(qpkg):
+                try:
+                    return getattr(qpkg.pkg.repo, repo_item)
+                except AttributeError,e:
+                    raise queryError("Invalid repo querytag '%s' for %s: %s" % (repo_item, qpkg.classname, qpkg.pkg))
+            return get_repo_item
 
-        res = None
         convert = None
-
         tmp = item.split(':')
         if len(tmp) > 1:
-            item = tmp[0]
             conv = tmp[1]
             if conv in convertmap:
                 convert = convertmap[conv]
             else:
                 raise queryError("Invalid conversion: %s" % conv)
+        simple = tmp[0]
 
-        # this construct is the way it is because pkg.licenses isn't
-        # populated before calling pkg.returnSimple() ?!
-        try:
-            res = self.pkg.returnSimple(item)
-        except (KeyError, ValueError):
-            if item == "license":
-                res = ", ".join(self.pkg.licenses)
-            else:
-                raise queryError("Invalid querytag '%s' for %s: %s" % (item, self.classname, self.pkg))
+        def get_item(qpkg):
+            pkg = qpkg.pkg
+            if convert is None:
+                # Same as a hasattr() test, but with only one lookup.
+                try:
+                    return getattr(pkg, item)
+                except Exception:
+                    pass
 
-        if convert:
-            res = convert(res)
-        return res
+            # this construct is the way it is because pkg.licenses isn't
+            # populated before calling pkg.returnSimple() ?!
+            try:
+                res = pkg.returnSimple(simple)
+            except (KeyError, ValueError):
+                if simple == "license":
+                    res = ", ".join(pkg.licenses)
+                else:
+                    raise queryError("Invalid querytag '%s' for %s: %s" % (simple, qpkg.classname, pkg))
+
+            if convert:
+                res = convert(res)
+            return res
+        return get_item
 
     def __str__(self):
         return self.fmt_queryformat()
@@ -239,6 +418,23 @@ class pkgQuery:
     def isSource(self):
         return self["arch"] == "src"
 
+    def record(self, tags, lists):
+        """
+        Return the values of the given querytags, and the given prco lists
+        (or "list" for the files), for --output=jsonl/csv.
+
+        @rtype: list of (key, value)
+        """
+        rec = []
+        for tag in tags:
+            rec.append((tag, self._tag_accessor(tag)(self)))
+        for what in lists:
+            if what == 'list':
+                rec.append(('files', self.files()))
+            else:
+                rec.append((what, self.prco(what)))
+        return rec
+
     def prco(self, what, **kw):
         """
         Query for the provides/requires/conflicts/obsoletes of this package.
@@ -251,21 +447,50 @@ class pkgQuery:
         # for subclasses to implement
         raise NotImplementedError
 
+    def iterPrco(self, what):
+        """ Same as prco(), but a generator. """
+        return iter(self.prco(what))
+
+    def iterFiles(self):
+        """ Same as files(), but a generator. """
+        return iter(self.files())
+
+    def iterQuery(self, method):
+        """
+        The lines of a text query of one of the list_ops, as they are read
+        from the package data.
+
+        @rtype: generator of str
+        """
+        what = self.list_ops[method]
+        if what is None:
+            return self.iterFiles()
+        return self.iterPrco(what)
+
     def fmt_queryformat(self, **kw):
 
         if not self.qf:
             return self.fmt_nevra()
 
         # Override .qf for fun and profit...
-        if self.qf not in self._translated_qf:
+        if self.qf not in _translated_qfs:
             qf = self.qf
 
             qf = qf.replace("\\n", "\n")
             qf = qf.replace("\\t", "\t")
-            pattern = re.compile('%([-\d]*?){([:\.\w]*?)}')
-            fmt = re.sub(pattern, r'%(\2)\1s', qf)
-            self._translated_qf[self.qf] = fmt
-        return self._translated_qf[self.qf] % self
+            fmt = re.sub(_qf_tag_re, r'%(\2)\1s', qf)
+            _translated_qfs[self.qf] = fmt
+        return self._render(_translated_qfs[self.qf])
+
+    def _render(self, fmt):
+        """
+        Render a %(tag)s style format for this package, using the compiled
+        form of the format (shared by all queries of this class).
+        """
+        key = (self.__class__, fmt)
+        if key not in _compiled_qfs:
+            _compiled_qfs[key] = compiledQueryFormat(fmt, self)
+        return _compiled_qfs[key].render(self)
 
     def fmt_requires(self, **kw):
         if self.yb.options.output in ("ascii-tree", "dot-tree",
@@ -333,21 +558,27 @@ class pkgQuery:
         return "\n".join(self.files())
 
     def fmt_evr(self, **kw):
-        return "%(epoch)s:%(version)s-%(release)s" % self
+        return self._render("%(epoch)s:%(version)s-%(release)s")
     def fmt_nevr(self, **kw):
-        return "%(name)s-%(evr)s" % self
+        return self._render("%(name)s-%(evr)s")
     def fmt_envr(self, **kw):
-        return "%(epoch)s:%(name)s-%(version)s-%(release)s" % self
+        return self._render("%(epoch)s:%(name)s-%(version)s-%(release)s")
     def fmt_nevra(self, **kw):
-        return "%(nevr)s.%(arch)s" % self
+        return self._render("%(nevr)s.%(arch)s")
     def fmt_envra(self, **kw):
-        return "%(envr)s.%(arch)s" % self
+        return self._render("%(envr)s.%(arch)s")
 
     def fmt_location(self, **kw):
+        if self.yb is not None:
+            return self.yb.pkgLocation(self.pkg)
         loc = ''
         repo = self.pkg.repo
+        # Installed packages aren't downloaded from anywhere
+        if not getattr(self.pkg, 'relativepath', None) or \
+           not getattr(repo, 'urls', None):
+            return loc
         if self['basepath']:
-            loc = "%(basepath)s/%(relativepath)s" % self
+            loc = self._render("%(basepath)s/%(relativepath)s")
         else:
             repourl = repo.urls[0]
             if repourl[-1] != '/':
@@ -362,13 +593,17 @@ class pkgQuery:
         print "%s%s [%s]" % (indent, str(req), str(val))
 
     # These are common helpers for the --tree-* options...
-    def _tree_print_req(self, req, val, level):
+    def _tree_print_req(self, req, val, level, ref=False):
         indent = ''
         if level:
             indent = ' |  ' * (level - 1) + ' \_  '
         self.pkg = req
         self.name = req.name
-        print "%s%s [%s]" % (indent, self.fmt_queryformat(), str(val))
+        if ref:
+            print "%s%s [%s] (see above)" % (indent, self.fmt_queryformat(),
+                                             str(val))
+        else:
+            print "%s%s [%s]" % (indent, self.fmt_queryformat(), str(val))
     def _tree_pkg2uniq(self, pkg):
         """ Turn a pkg into a "unique" req."""
         if self.yb and self.yb.conf.showdupesfromrepos:
@@ -401,6 +636,67 @@ class pkgQuery:
             for npkg in sorted(tup2pkgs(rptup, rname), reverse=True):
                 self._tree_maybe_add_pkg(all_reqs, loc_reqs, rpkgs, npkg, rname)
         return rpkgs, loc_reqs
+    def _tree_walk(self, kind, pkg, req, level, all_reqs, kw, children):
+        """
+        Show the tree of pkg, for the --tree-* options. children(pkg,
+        all_reqs) returns the (rpkgs, loc_reqs) of a package, as from
+        _tree_maybe_add_pkgs(). The tree is walked with an explicit stack,
+        so deep trees don't hit the recursion limit. Packages whose subtree
+        was already shown for an earlier package in this query are shown by
+        reference, instead of being expanded again.
+        """
+        dot = kw['dot']
+        tree_level = kw['tree_level']
+        if str(tree_level).lower() == 'all':
+            tree_level = None
+
+        shown = None
+        expanded = set()
+        if self.yb is not None and tree_level is None:
+            shown = self.yb.treeShown((kind, kw['output'].lower()))
+
+        stack = [(pkg, req, level, True)]
+        while stack:
+            (pkg, req, level, expand) = stack.pop()
+            uniq = self._tree_pkg2uniq(pkg)
+            ref = expand and shown is not None and uniq in shown
+
+            #  Level means something a bit different for dot, because we have
+            # to lookup it's packages ... but we don't for ascii. *sigh*
+            if dot is None:
+                self._tree_print_req(pkg, req, level, ref)
+                if not expand or ref:
+                    continue
+                if tree_level is not None and tree_level < level + 1:
+                    continue
+            elif ref:
+                continue
+
+            rpkgs, loc_reqs = children(pkg, all_reqs)
+            expanded.add(uniq)
+            if dot is not None:
+                dot.addPackage(pkg, rpkgs)
+                if tree_level is not None and tree_level < level + 2:
+                    continue
+
+            nlevel = level + 1
+            todo = []
+            for rpkg in sorted(rpkgs):
+                if pkg.verEQ(rpkg): # Remove deps. on self.
+                    continue
+                if rpkgs[rpkg] is None:
+                    if dot is None:
+                        todo.append((rpkg, self._tree_pkg2val(loc_reqs, rpkg),
+                                     nlevel, False))
+                    continue
+                todo.append((rpkg, self._tree_pkg2val(loc_reqs, rpkg),
+                             nlevel, True))
+            todo.reverse()
+            stack.extend(todo)
+
+        if shown is not None:
+            shown.update(expanded)
+
     def _fmt_tree_prov(self, prco_type, **kw):
         pkg      = kw.get('pkg', self.pkg)
         req      = kw.get('req', 'cmd line')
@@ -423,84 +719,41 @@ class pkgQuery:
         if not 'output' in kw.keys():
             kw['output'] = 'ascii-tree'
 
-        #  Level means something a bit different for dot, because we have to
-        # lookup it's packages ... but we don't for ascii. *sigh*
-        if dot is None:
-            self._tree_print_req(pkg, req, level)
-            lim = level + 1
-            if str(kw['tree_level']).lower() != 'all' and \
-                int(kw['tree_level']) < int(lim):
-                return
-
-        __req2pkgs = {}
         def req2pkgs(ignore, req):
-            req = str(req)
-            if req in __req2pkgs:
-                return __req2pkgs[req]
-
             if self.yb is None:
                 return []
-            yb = self.yb
 
             providers = []
-            try:
-                # XXX rhbz#246519, for some reason returnPackagesByDep() fails
-                # to find some root level directories while 
-                # searchPackageProvides() does... use that for now
-                matches = self.yb.searchPackageProvides([req])
-                if self.yb.options.pkgnarrow == 'repos':
-                    # Sucks that we do the work, and throw it away...
-                    for provider in matches:
-                        if provider.repoid != 'installed':
-                            providers.append(provider)
-                elif self.yb.options.pkgnarrow == 'installed':
-                    # Sucks that we do the work, and throw it away...
-                    for provider in matches:
-                        if provider.repoid == 'installed':
-                            providers.append(provider)
-                else:
-                    # Assume "all"
-                    providers = matches.keys()
-
-
-            except yum.Errors.RepoError:
-                raise
-            except yum.Errors.YumBaseError, err:
+            matches = self.yb.returnProviders(req)
+            if matches is None:
                 print >>sys.stderr, "No package provides %s" % req
                 return []
-
-            __req2pkgs[req] = providers
+            if self.yb.options.pkgnarrow == 'repos':
+                # Sucks that we do the work, and throw it away...
+                for provider in matches:
+                    if provider.repoid != 'installed':
+                        providers.append(provider)
+            elif self.yb.options.pkgnarrow == 'installed':
+                # Sucks that we do the work, and throw it away...
+                for provider in matches:
+                    if provider.repoid == 'installed':
+                        providers.append(provider)
+            else:
+                # Assume "all"
+                providers = matches
             return providers 
-        
-        tups = getattr(pkg, prco_type)
-        if kw['output'].lower() in ('ascii-tree+', 'dot-tree+'):
-            if prco_type in ("info_requires",):
-                tups.extend(getattr(pkg, "weak_requires"))
-            if prco_type in ("info_requires", "weak_requires"):
-                tups.extend(getattr(pkg, "requires"))
-        rpkgs, loc_reqs = self._tree_maybe_add_pkgs(all_reqs, tups, req2pkgs)
-        if dot is not None:
-            dot.addPackage(pkg, rpkgs)
-            lim = level + 2
-        nlevel = level + 1
-        if str(kw['tree_level']).lower() != 'all' and \
-            int(kw['tree_level']) < int(lim):
-            return
-        for rpkg in sorted(rpkgs):
-            if pkg.verEQ(rpkg):
-                continue
-            if rpkgs[rpkg] is None:
-                req = self._tree_pkg2val(loc_reqs, rpkg)
-                if dot is None:
-                    self._tree_print_req(rpkg, req, nlevel)
-                continue
-            self._fmt_tree_prov(prco_type,
-                                pkg = rpkg, level = nlevel, all_reqs = all_reqs,
-                                req = self._tree_pkg2val(loc_reqs, rpkg),
-                                tree_level = kw['tree_level'],
-                                output = kw['output'],
-                                dot = dot)
-        
+
+        def children(pkg, all_reqs):
+            tups = getattr(pkg, prco_type)
+            if kw['output'].lower() in ('ascii-tree+', 'dot-tree+'):
+                if prco_type in ("info_requires",):
+                    tups.extend(getattr(pkg, "weak_requires"))
+                if prco_type in ("info_requires", "weak_requires"):
+                    tups.extend(getattr(pkg, "requires"))
+            return self._tree_maybe_add_pkgs(all_reqs, tups, req2pkgs)
+
+        self._tree_walk(prco_type, pkg, req, level, all_reqs, kw, children)
+
     def fmt_tree_requires(self, **kw):
         return self._fmt_tree_prov('requires', **kw)
     def fmt_tree_weak_requires(self, **kw):
@@ -610,15 +863,6 @@ class pkgQuery:
         if not 'output' in kw.keys():
             kw['output'] = 'ascii-tree'
 
-        #  Level means something a bit different for dot, because we have to
-        # lookup it's packages ... but we don't for ascii. *sigh*
-        if dot is None:
-            self._tree_print_req(pkg, req, level)
-            lim = level + 1
-            if str(kw['tree_level']).lower() != 'all' and \
-                int(kw['tree_level']) < int(lim):
-                return
-
         __prov2pkgs = {}
         def prov2pkgs(prov, ignore):
             if str(prov) in __prov2pkgs:
@@ -653,48 +897,70 @@ class pkgQuery:
             __prov2pkgs[str(prov)] = arequirers + irequirers
             return arequirers + irequirers
 
-        filetupes = []
-        for n in pkg.filelist + pkg.dirlist + pkg.ghostlist:
-            filetupes.append((n, None, (None, None, None)))
-        
-        tups = pkg.provides + filetupes
-        rpkgs, loc_reqs = self._tree_maybe_add_pkgs(all_reqs, tups, prov2pkgs)
-        
-        if dot is not None:
-            dot.addPackage(pkg, rpkgs)
-            lim = level + 2
-        nlevel = level + 1
-        
-        if str(kw['tree_level']).lower() != 'all' and \
-            int(kw['tree_level']) < int(lim):
-            return
-        for rpkg in sorted(rpkgs):
-            if pkg.verEQ(rpkg): # Remove deps. on self.
-                continue
-            if rpkgs[rpkg] is None:
-                req = self._tree_pkg2val(loc_reqs, rpkg)
-                if dot is None:
-                    self._tree_print_req(rpkg, req, nlevel)
-                continue
-            self.fmt_tree_what_requires(pkg=rpkg,
-                                        level=nlevel, all_reqs=all_reqs,
-                                        req=self._tree_pkg2val(loc_reqs, rpkg),
-                                        tree_level = kw['tree_level'],
-                                        output = kw['output'],
-                                        dot = dot)
+        def children(pkg, all_reqs):
+            filetupes = []
+            for n in pkg.filelist + pkg.dirlist + pkg.ghostlist:
+                filetupes.append((n, None, (None, None, None)))
+
+            tups = pkg.provides + filetupes
+            return self._tree_maybe_add_pkgs(all_reqs, tups, prov2pkgs)
+
+        self._tree_walk('what_requires', pkg, req, level, all_reqs, kw,
+                        children)
 
 
 class repoPkgQuery(pkgQuery):
     """
     I wrap a query of a non-installed package available in the repository.
     """
-    def __init__(self, pkg, qf, yb=None):
-        pkgQuery.__init__(self, pkg, qf, yb)
-        self.classname = 'repo pkg'
+    __slots__ = ()
+
+    classname = 'repo pkg'
+
+    def _sqlitePkg(self):
+        """ Can we read the package data straight from its sqlite MD. """
+        return isinstance(self.pkg, yum.sqlitesack.YumAvailablePackageSqlite)
+
+    def _prcoTuples(self, what):
+        #  Read the sqlite rows ourself, if the package hasn't loaded them,
+        # so they don't stay around in the package for the rest of the run.
+        if (self._sqlitePkg() and
+            what in ('provides', 'requires', 'conflicts', 'obsoletes') and
+            isinstance(self.pkg.prco.get(what), tuple)):
+            cur = self.pkg._sql_MD('primary',
+                                   "SELECT name, flags, epoch, version, "
+                                   "release FROM %s WHERE pkgKey = ?" % what,
+                                   (self.pkg.pkgKey,))
+            for (n, f, e, v, r) in cur:
+                if n:
+                    yield (n, f, (e, v, r))
+            return
+        for rptup in self.pkg.returnPrco(what):
+            yield rptup
+
+    def _fileNames(self):
+        if self._sqlitePkg() and not self.pkg._loadedfiles:
+            self.pkg.sack.populate(self.pkg.repo, mdtype='filelists')
+            cur = self.pkg._sql_MD('filelists',
+                                   "SELECT dirname, filenames FROM filelist "
+                                   "JOIN packages USING(pkgKey) "
+                                   "WHERE packages.pkgId = ?",
+                                   (self.pkg.pkgId,))
+            for (dirname, filenames) in cur:
+                if dirname == '.':
+                    dirname = ''
+                for fn in yum.sqlitesack.decodefilenamelist(filenames):
+                    if dirname:
+                        fn = dirname + '/' + fn
+                    yield fn
+            return
+        for ftype in self.pkg.returnFileTypes():
+            for fn in self.pkg.returnFileEntries(ftype):
+                yield fn
 
-    def prco(self, what, **kw):
+    def iterPrco(self, what):
         rpdict = {}
-        for rptup in self.pkg.returnPrco(what):
+        for rptup in self._prcoTuples(what):
             (rpn, rpf, (rp,rpv,rpr)) = rptup
             if rpn.startswith('rpmlib'):
                 continue
@@ -702,18 +968,23 @@ class repoPkgQuery(pkgQuery):
     
         rplist = rpdict.keys()
         rplist.sort()
-        return rplist
+        return iter(rplist)
 
-    def files(self, **kw):
+    def prco(self, what, **kw):
+        return list(self.iterPrco(what))
+
+    def iterFiles(self):
         fdict = {}
-        for ftype in self.pkg.returnFileTypes():
-            for fn in self.pkg.returnFileEntries(ftype):
-                # workaround for yum returning double leading slashes on some 
-                # directories - posix allows that but it looks a bit odd
-                fdict[os.path.normpath('//%s' % fn)] = None
+        for fn in self._fileNames():
+            # workaround for yum returning double leading slashes on some 
+            # directories - posix allows that but it looks a bit odd
+            fdict[os.path.normpath('//%s' % fn)] = None
         files = fdict.keys()
         files.sort()
-        return files
+        return iter(files)
+
+    def files(self, **kw):
+        return list(self.iterFiles())
 
     def fmt_changelog(self, **kw):
         changelog = []
@@ -733,22 +1004,25 @@ class instPkgQuery(pkgQuery):
     tagmap = { 'installedsize': 'size',
              }
 
-    def __init__(self, pkg, qf, yb=None):
-        pkgQuery.__init__(self, pkg, qf, yb)
-        self.classname = 'installed pkg'
+    __slots__ = ()
 
-    def __getitem__(self, item):
-        if item in self.tagmap:
-            return self.pkg.tagByName(self.tagmap[item])
-        elif item.startswith('yumdb_info.'):
-            yumdb_item = item.split('.')[1]
-            try:
-                return getattr(self.pkg.yumdb_info, yumdb_item)
-            except AttributeError,e:
-                raise queryError("Invalid yumdb querytag '%s' for %s: %s" % (yumdb_item, self.classname, self.pkg))
+    classname = 'installed pkg'
+
+    def _compile_tag(self, tag):
+        if tag in self.tagmap:
+            rpmtag = self.tagmap[tag]
+            return lambda qpkg: qpkg.pkg.tagByName(rpmtag)
+        elif tag.startswith('yumdb_info.'):
+            yumdb_item = tag.split('.')[1]
+            def get_yumdb_item(qpkg):
+                try:
+                    return getattr(qpkg.pkg.yumdb_info, yumdb_item)
+                except AttributeError,e:
+                    raise queryError("Invalid yumdb querytag '%s' for %s: %s" % (yumdb_item, qpkg.classname, qpkg.pkg))
+            return get_yumdb_item
         else:
-            return pkgQuery.__getitem__(self, item)
-            
+            return pkgQuery._compile_tag(self, tag)
+
     def prco(self, what, **kw):
         prcodict = {}
         what = {"weak_requires" : "recommends",
@@ -790,7 +1064,80 @@ class instPkgQuery(pkgQuery):
         return "\n".join(changelog)
 
 
+class hdrPkgQuery(pkgQuery):
+    """
+    I wrap a query of an installed package read straight from the rpmdb, the
+    pkg is a dict of just the header tags the query format uses instead of a
+    L{yum.packages.YumInstalledPackage}.
+    """
+    __slots__ = ()
+
+    classname = 'installed pkg'
+
+    tagmap = instPkgQuery.tagmap
+
+    # Header tags we can query
+    header_tags = ('name', 'epoch', 'version', 'release', 'arch', 'size',
+                   'summary', 'description', 'packager', 'url', 'buildhost',
+                   'sourcerpm', 'vendor', 'group', 'license', 'buildtime',
+                   'installtime')
+    # Querytags made from the nevra tags
+    nevra_tags = ('evr', 'nevr', 'envr', 'nevra', 'envra')
+
+    def __init__(self, pkg, qf, yb=None):
+        self.yb = yb
+        self.pkg = pkg
+        self.qf = qf
+        self.name = pkg['name']
+
+    def projection(cls, qf):
+        """
+        Return the header tags needed to render qf, or None if it uses
+        querytags we can't do without a real installed package.
+
+        @rtype: list of str
+        """
+        tags = set(['name', 'epoch', 'version', 'release', 'arch'])
+        for width, tag in _qf_tag_re.findall(qf):
+            item = tag.lower().split(':')
+            if len(item) > 1:
+                if len(item) > 2 or item[1] not in convertmap:
+                    return None
+                if item[0] in cls.nevra_tags:
+                    return None
+            item = cls.tagmap.get(item[0], item[0])
+            if item in cls.nevra_tags or item == 'repoid':
+                continue
+            if item not in cls.header_tags:
+                return None
+            tags.add(item)
+        return sorted(tags)
+    projection = classmethod(projection)
+
+    def _compile_tag(self, tag):
+        item = tag.lower()
+        if item in self.nevra_tags:
+            return pkgQuery._compile_tag(self, tag)
+        if item == 'repoid':
+            return lambda qpkg: 'installed'
+
+        convert = None
+        tmp = item.split(':')
+        if len(tmp) > 1:
+            convert = convertmap[tmp[1]]
+        hdrtag = self.tagmap.get(tmp[0], tmp[0])
+        def get_tag(qpkg):
+            res = qpkg.pkg[hdrtag]
+            if convert:
+                res = convert(res)
+            return res
+        return get_tag
+
+
 class groupQuery:
+    # Nothing is listed a line at a time, see pkgQuery.list_ops
+    list_ops = {}
+
     def __init__(self, group, grouppkgs="required"):
         self.grouppkgs = grouppkgs
         self.id = group.groupid
@@ -803,6 +1150,15 @@ class groupQuery:
         else:
             raise queryError("Invalid group query: %s" % method)
 
+    def record(self, tags, lists):
+        rec = [('groupid', self.id), ('name', self.name)]
+        for what in lists:
+            if what == 'list':
+                rec.append(('packages', self.fmt_list()))
+            elif what == 'requires':
+                rec.append(('requires', self.fmt_requires()))
+        return rec
+
     # XXX temporary hack to make --group -a query work
     def fmt_queryformat(self, **kw):
         return self.fmt_nevra()
@@ -846,6 +1202,25 @@ class YumBaseQuery(yum.YumBase):
         console_stderr.setFormatter(logging.Formatter("%(message)s"))
         self.logger.propagate = False
         self.logger.addHandler(console_stderr)
+        self._have_otherdata = False
+        self._have_groups = False
+        self.query_archlist = None
+        self.profiler = NoProfiler()
+        self._resetCaches()
+        self._tree_shown = {}
+        self._provides_hits = 0
+        self._provides_misses = 0
+        self.setQuery(pkgops, sackops, options)
+
+    def setQuery(self, pkgops, sackops, options):
+        """
+        Set the operations and options used by the next runQuery(), this
+        lets one YumBaseQuery answer many queries.
+
+        @type  pkgops:  list of str
+        @type  sackops: list of str
+        @type  options: L{optparse.Values}
+        """
         self.options = options
         self.pkgops = pkgops
         self.sackops = sackops
@@ -924,19 +1299,118 @@ class YumBaseQuery(yum.YumBase):
 
         return pkgs
 
-    def returnPackagesByDepStr(self, depstring):
-        provider = []
+    def returnProviders(self, depstring):
+        """
+        Given a requirement, return the installed and available packages
+        providing it, or None if there was an error looking it up. Results
+        are cached for the run (and on disk, with --cache-provides), as
+        thousands of packages share the same requirements.
+
+        @type  depstring: str
+
+        @rtype: list of L{yum.package.YumAvailablePackage}
+        """
+        depstring = str(depstring)
+        if depstring in self._provides_cache:
+            self._provides_hits += 1
+            return self._provides_cache[depstring]
+
+        providers = self._diskProviders(depstring)
+        if providers is not None:
+            self._provides_hits += 1
+            self._provides_cache[depstring] = providers
+            return providers
+
+        self._provides_misses += 1
         try:
             # XXX rhbz#246519, for some reason returnPackagesByDep() fails
             # to find some root level directories while 
             # searchPackageProvides() does... use that for now
-            matches = yum.YumBase.searchPackageProvides(self, [str(depstring)])
-            provider = matches.keys()
+            matches = yum.YumBase.searchPackageProvides(self, [depstring])
+            providers = matches.keys()
             # provider.extend(yum.YumBase.returnPackagesByDep(self, depstring))
         except yum.Errors.RepoError:
             raise
         except yum.Errors.YumBaseError, err:
+            providers = None
+        self._provides_cache[depstring] = providers
+        return providers
+
+    def _providesCacheKey(self):
+        key = [self.options.pkgnarrow, self._rpmdbMtime(),
+               sorted(self.conf.exclude), self.query_archlist]
+        for repo in sorted(self.repos.listEnabled(), key=lambda r: r.id):
+            key.append((repo.id, repo.repoXML.getData('primary').checksum))
+        return key
+
+    def _providesCacheFile(self):
+        return os.path.join(self.conf.cachedir, 'repoquery-provides.pickle')
+
+    def _diskProviders(self, depstring):
+        """ Lookup depstring in the --cache-provides data, if we have it. """
+        if not self.options.cache_provides:
+            return None
+        if self._provides_disk is None:
+            self._provides_disk = {}
+            try:
+                fo = open(self._providesCacheFile(), 'rb')
+                try:
+                    data = pickle.load(fo)
+                finally:
+                    fo.close()
+                if data['key'] == self._providesCacheKey():
+                    self._provides_disk = data['providers']
+            except (IOError, EOFError, KeyError, ValueError,
+                    pickle.UnpicklingError):
+                pass
+
+        if depstring not in self._provides_disk:
+            return None
+        if self._provides_disk[depstring] is None:
+            return None # Look it up again, to get the error
+
+        providers = []
+        for repoid, pkgtup in self._provides_disk[depstring]:
+            if repoid == 'installed':
+                pkgs = self.rpmdb.searchPkgTuple(pkgtup)
+            else:
+                pkgs = [pkg for pkg in self.pkgSack.searchPkgTuple(pkgtup)
+                        if pkg.repoid == repoid]
+            if not pkgs:
+                return None
+            providers.append(pkgs[0])
+        return providers
+
+    def saveProvidesCache(self):
+        """ Write out the --cache-provides data, for the next run. """
+        if not self.options.cache_provides or not self._provides_misses:
+            return
+
+        providers = {}
+        if self._provides_disk:
+            providers.update(self._provides_disk)
+        for depstring, pkgs in self._provides_cache.iteritems():
+            if pkgs is not None:
+                pkgs = [(pkg.repoid, pkg.pkgtup) for pkg in pkgs]
+            providers[depstring] = pkgs
+
+        fn = self._providesCacheFile()
+        try:
+            fo = open(fn + '.tmp', 'wb')
+            try:
+                pickle.dump({'key' : self._providesCacheKey(),
+                             'providers' : providers}, fo, -1)
+            finally:
+                fo.close()
+            os.rename(fn + '.tmp', fn)
+        except (IOError, OSError), e:
+            self.logger.warning("Could not save provides cache: %s" % e)
+
+    def returnPackagesByDepStr(self, depstring):
+        provider = self.returnProviders(depstring)
+        if provider is None:
             self.logger.error("No package provides %s" % depstring)
+            provider = []
         return self.queryPkgFactory(provider)
 
     def returnGroups(self):
@@ -947,13 +1421,14 @@ class YumBaseQuery(yum.YumBase):
         return grps
 
     def matchGroups(self, items):
+        if not items:
+            return []
+        match = glob_matcher(items)
         grps = []
-        for grp in self.returnGroups():
-            for expr in items:
-                if grp.name == expr or fnmatch.fnmatch("%s" % grp.name, expr):
-                    grps.append(grp)
-                elif grp.id == expr or fnmatch.fnmatch("%s" % grp.id, expr):
-                    grps.append(grp)
+        for group in self.comps.get_groups():
+            if match("%s" % group.name) or match("%s" % group.groupid):
+                grps.append(groupQuery(group,
+                                       grouppkgs = self.options.grouppkgs))
         return grps
                     
     def matchPkgs(self, items, plain_pkgs=False):
@@ -994,6 +1469,130 @@ class YumBaseQuery(yum.YumBase):
         
         return self.queryPkgFactory(pkgs)
         
+    def _searchIndexFile(self, repo):
+        return os.path.join(repo.cachedir, 'repoquery-search.pickle')
+
+    def _repoSearchIndex(self, repo, sack):
+        """
+        Return the --search-index of a repo. It's saved next to the
+        primary_db, and rebuilt from that when the primary checksum changes.
+        """
+        if repo.id in self._search_index:
+            return self._search_index[repo.id]
+
+        checksum = repo.repoXML.getData('primary').checksum
+        fn = self._searchIndexFile(repo)
+        index = None
+        try:
+            fo = open(fn, 'rb')
+            try:
+                data = pickle.load(fo)
+            finally:
+                fo.close()
+            if data['checksum'] == checksum:
+                index = data['index']
+        except (IOError, EOFError, KeyError, ValueError,
+                pickle.UnpicklingError):
+            pass
+
+        if index is None:
+            cur = sack.primarydb[repo].cursor()
+            cur.execute("SELECT pkgKey, name, summary, description, url "
+                        "FROM packages")
+            index = make_search_index(cur)
+            try:
+                fo = open(fn + '.tmp', 'wb')
+                try:
+                    pickle.dump({'checksum' : checksum, 'index' : index},
+                                fo, -1)
+                finally:
+                    fo.close()
+                os.rename(fn + '.tmp', fn)
+            except (IOError, OSError), e:
+                self.logger.warning("Could not save search index for %s: %s"
+                                    % (repo.id, e))
+        self._search_index[repo.id] = index
+        return index
+
+    def _searchIndex(self, index, fields, words):
+        """
+        Return the (key, rank) of everything in the index which has all the
+        words, in any of the fields.
+        """
+        ranks = None
+        for word in words:
+            wranks = {}
+            for field in fields:
+                weight = search_index_fields[field]
+                for key in index[field].get(word, ()):
+                    if wranks.get(key, 0) < weight:
+                        wranks[key] = weight
+            if ranks is None:
+                ranks = wranks
+            else:
+                ranks = dict([(key, rank + wranks[key])
+                              for key, rank in ranks.iteritems()
+                              if key in wranks])
+            if not ranks:
+                return []
+        return ranks.items()
+
+    def index_search(self, terms):
+        """
+        --search using the --search-index. All the words of the terms have
+        to be in one of the search fields, and the packages are ranked by
+        the fields they matched in (and an exact name match).
+        """
+        fields = self.options.searchfields
+        if not fields:
+            fields = ['name', 'summary']
+        for field in fields:
+            if field not in search_index_fields:
+                self.logger.warning("Field %s is not in the search index, "
+                                    "searching without it" % field)
+                return self.yum_search(terms)
+
+        words = set()
+        for term in terms:
+            words.update(search_words(term))
+        if not words:
+            return []
+        names = set([to_unicode(term).lower() for term in terms])
+
+        ranked = []
+        try:
+            # Narrowed the same as yum_search()
+            if ('rpmdb' in self._sacks and
+                self.options.pkgnarrow in ('all', 'installed', 'extras')):
+                ipkgs = self.rpmdb.returnPackages()
+                index = make_search_index([(num, pkg.name, pkg.summary,
+                                            pkg.description, pkg.url)
+                                           for num, pkg in enumerate(ipkgs)])
+                for key, rank in self._searchIndex(index, fields, words):
+                    ranked.append((rank, ipkgs[key]))
+            if ('pkgSack' in self._sacks and
+                self.options.pkgnarrow in ('all', 'available', 'repos')):
+                for repo in self.repos.listEnabled():
+                    #  An enabled repo can have no sack, eg. if it was
+                    # skipped as unavailable.
+                    sack = self.pkgSack.sacks.get(repo.id)
+                    if sack is None:
+                        continue
+                    index = self._repoSearchIndex(repo, sack)
+                    for key, rank in self._searchIndex(index, fields, words):
+                        pkg = sack._packageByKey(repo, key)
+                        if pkg is not None:
+                            ranked.append((rank, pkg))
+        except yum.Errors.RepoError, e:
+            raise queryError("Could not run search: %s" % e)
+
+        if 'name' in fields:
+            bonus = search_index_fields['name'] * 2
+            ranked = [(rank + bonus * (pkg.name.lower() in names), pkg)
+                      for rank, pkg in ranked]
+        ranked.sort(key=lambda x: (-x[0], x[1].name))
+        return self.queryPkgFactory([pkg for rank, pkg in ranked])
+
     def _at_grps(self, items):
         #  We want to move from @foo => lists of package names here, to make
         # a bunch of things easier. Ie. pkgs. ops. on lists of packages from
@@ -1008,26 +1607,88 @@ class YumBaseQuery(yum.YumBase):
             nitems.append(item)
         return nitems
 
+    def recordFields(self):
+        """
+        Work out the querytags and prco lists for each record, with
+        --output=jsonl/csv. The tags come from the --qf (or are the nevra
+        parts) plus any pkgops which aren't lists.
+
+        @rtype: tuple of (tags, lists)
+        """
+        if self.options.queryformat:
+            tags = [tag for width, tag in
+                    _qf_tag_re.findall(self.options.queryformat)]
+        else:
+            tags = record_tags[:]
+        lists = []
+        for oper in self.pkgops:
+            if oper in record_lists:
+                lists.append(oper)
+            elif oper in std_qf:
+                tags.extend([tag for width, tag in
+                             _qf_tag_re.findall(std_qf[oper])])
+            elif oper != 'queryformat' and not oper.startswith('tree_'):
+                tags.append(oper)
+
+        utags = []
+        for tag in tags:
+            if tag not in utags:
+                utags.append(tag)
+        return utags, lists
+
     def runQuery(self, items):
+        self.profiler.phase('match')
+        self._tree_shown = {}
+        records = None
+        if self.options.output == 'jsonl':
+            records = JSONLOutput()
+        elif self.options.output == 'csv':
+            records = CSVOutput()
+
         plain_pkgs = False
         if self.options.group:
             pkgs = self.matchGroups(items)
         elif self.options.groupmember:
             pkglist = self.matchPkgs(items, plain_pkgs=True)
             for pkg in sorted(pkglist):
+                groups = sorted(self.find_groupmember(pkg.name))
+                if records is not None:
+                    records.addRecord([('name', pkg.name),
+                                       ('arch', pkg.arch),
+                                       ('groups', groups)])
+                    continue
                 print to_unicode(pkg)
-                for group in sorted(self.find_groupmember(pkg.name)):
+                for group in groups:
                     print to_unicode('  @%s' % group)
             pkgs = []
         elif self.options.search:
             plain_pkgs = False
             pkgs = []
             try:
-                pkgs = self.yum_search(items)
+                if self.options.search_index:
+                    pkgs = self.index_search(items)
+                else:
+                    pkgs = self.yum_search(items)
             except queryError, e:
                 self.logger.error(e)
         else:
             items = self._at_grps(items)
+            if (self.pkgops == ['location'] and not self.sackops and
+                not self.options.srpm and records is None):
+                self.profiler.phase('format')
+                self.profiler.runcall(self.runLocations, items)
+                return
+            if (self.options.pkgnarrow == 'installed' and
+                len(self.pkgops) == 1 and not self.sackops and
+                not self.options.srpm and records is None):
+                qf = std_qf.get(self.pkgops[0])
+                if self.pkgops[0] == 'queryformat':
+                    qf = self.options.queryformat or std_qf["nevra"]
+                if qf is not None:
+                    self.profiler.phase('format')
+                    if self.profiler.runcall(self.runInstalled, items, qf):
+                        return
+                    self.profiler.phase('match')
             if self.options.srpm:
                 pkgs = self.matchSrcPkgs(items)
 
@@ -1048,11 +1709,20 @@ class YumBaseQuery(yum.YumBase):
                         except queryError, e:
                             self.logger.error(e)
 
+        self.profiler.phase('format')
+        self.profiler.runcall(self.printQueries, pkgs, plain_pkgs, records)
+
+    def printQueries(self, pkgs, plain_pkgs, records):
+        """
+        Print the pkgops (or records) for each of the matched packages, this
+        is the formatting loop of runQuery().
+        """
         if plain_pkgs:
             iq = None
             rq = None
             qf = self.options.queryformat or std_qf["nevra"]
             pkgs = sorted(pkgs)
+        tags = None
         for pkg in pkgs:
             if plain_pkgs:
                 if isinstance(pkg, yum.packages.YumInstalledPackage):
@@ -1067,10 +1737,23 @@ class YumBaseQuery(yum.YumBase):
                     rq.pkg = pkg
                     rq.name = pkg.name
                     pkg = rq
+            if records is not None:
+                if tags is None:
+                    (tags, lists) = self.recordFields()
+                try:
+                    records.addRecord(pkg.record(tags, lists))
+                except queryError, e:
+                    self.logger.error(e)
+                continue
             if not self.pkgops:
                 print to_unicode(pkg)
             for oper in self.pkgops:
                 try:
+                    if (oper in pkg.list_ops and
+                        self.options.output == 'text'):
+                        for line in pkg.iterQuery(oper):
+                            print to_unicode(line)
+                        continue
                     out = pkg.doQuery(oper, 
                         tree_level = self.options.tree_level,
                         output = self.options.output,
@@ -1083,23 +1766,413 @@ class YumBaseQuery(yum.YumBase):
     def doQuery(self, method, *args, **kw):
         return getattr(self, "fmt_%s" % method)(*args, **kw)
 
+    def setupExtraMetadata(self, needother=False, needgroup=False):
+        """ Load otherdata and/or comps, if they aren't already loaded. """
+        if needother and not self._have_otherdata:
+            self.repos.populateSack(mdtype='otherdata')
+            self._have_otherdata = True
+        if needgroup and not self._have_groups:
+            self.doGroupSetup()
+            self._have_groups = True
+
+    #  Options which are used to setup the config., repos. and sacks, these
+    # can't change between queries in --batch mode so we always use the
+    # values from the command line.
+    _batch_fixed_opts = ('archlist', 'releasever', 'repoid', 'enablerepos',
+                         'disablerepos', 'repofrompath', 'plugins', 'quiet',
+                         'cache', 'tempcache', 'nolock', 'conffile',
+                         'installroot', 'setopts', 'show_dupes',
+                         'batch', 'batch_delim', 'serve', 'connect',
+                         'cache_provides', 'profile', 'profile_file')
+    #  The ones of those which don't change the results, the others are an
+    # error for --serve queries, as the daemon can't answer them.
+    _serve_ok_opts = ('quiet', 'connect', 'profile', 'profile_file')
+
+    def runQueryLine(self, parser, line):
+        """
+        Parse a single query, options and arguments as they would be given
+        on the command line, and run it against the already loaded sacks.
+
+        @type  parser: L{optparse.OptionParser}
+        @type  line:   str
+        @rtype: bool, True if the query was run
+        """
+        try:
+            args = shlex.split(line)
+        except ValueError, e:
+            self.logger.error("Bad query: %s" % e)
+            return False
+        return self.runQueryArgs(parser, args)
+
+    def runQueryArgs(self, parser, args, serving=False):
+        """
+        Run a single query, given as a list of command line arguments,
+        against the already loaded sacks.
+
+        @type  parser:  L{optparse.OptionParser}
+        @type  args:    list of str
+        @type  serving: bool, setup options are an error instead of ignored
+        @rtype: bool, True if the query was run
+        """
+        try:
+            (opts, items) = parser.parse_args(args)
+        except SystemExit:
+            # optparse has already told them what's wrong
+            return False
+
+        bad = False
+        for opt in self._batch_fixed_opts:
+            if getattr(opts, opt) != parser.defaults.get(opt):
+                if serving and opt not in self._serve_ok_opts:
+                    self.logger.error("Option %s can't be used with the "
+                                      "query daemon" % opt)
+                    bad = True
+                else:
+                    self.logger.warning("Option %s is ignored in batch "
+                                        "queries" % opt)
+            setattr(opts, opt, getattr(self.options, opt))
+        if bad:
+            return False
+
+        if len(items) < 1:
+            if opts.all:
+                items = ['*']
+            else:
+                self.logger.error("No packages given for query: %s" %
+                                  " ".join(args))
+                return False
+        if opts.installed:
+            opts.pkgnarrow = 'installed'
+
+        (pkgops, sackops,
+         needother, needgroup, needsource) = query_ops(opts)
+        orig = (self.pkgops, self.sackops, self.options)
+        self.setQuery(pkgops, sackops, opts)
+        try:
+            try:
+                self.setupExtraMetadata(needother, needgroup)
+                self.runQuery(items)
+            except (yum.Errors.RepoError, yum.Errors.GroupsError,
+                    yum.Errors.MiscError, queryError), e:
+                self.logger.error(e)
+        finally:
+            # Make sure a DotPlot is finished before any delimiter is written
+            opts.dot = None
+            self.setQuery(*orig)
+        return True
+
+    def runBatch(self, parser, infile=None):
+        """
+        Run queries read one per line from infile (default stdin), writing
+        the --batch-delim line after the output of each one. Empty lines
+        and lines starting with # are skipped.
+
+        @type  parser: L{optparse.OptionParser}
+        """
+        if infile is None:
+            infile = sys.stdin
+        delim = self.options.batch_delim
+        #  Don't use "for line in infile", as that reads ahead and so the
+        # caller can't pipeline queries.
+        for line in iter(infile.readline, ''):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            self.runQueryLine(parser, line)
+            print delim
+            sys.stdout.flush()
+
+    def _rpmdbMtime(self):
+        try:
+            return os.stat(self.conf.installroot + '/var/lib/rpm/Packages').st_mtime
+        except OSError:
+            return None
+
+    def _repomdTimestamps(self):
+        return dict([(repo.id, repo.repoXML.timestamp)
+                     for repo in self.repos.listEnabled()])
+
+    def treeShown(self, kind):
+        """
+        Return the set of packages whose tree of the given kind has already
+        been shown by this query.
+        """
+        return self._tree_shown.setdefault(kind, set())
+
+    def _resetCaches(self):
+        """ Drop everything we've worked out from the sacks. """
+        self._requires_index = {}
+        self._provides_cache = {}
+        self._provides_disk = None
+        self._search_index = {}
+        self._repo_urls = {}
+        self._group_members = None
+
+    def checkMetadata(self):
+        """
+        Reload the sack of any repo. whose repomd.xml timestamp has changed,
+        and the rpmdb if it has changed. Repos. are only rechecked when their
+        metadata has expired (as per metadata_expire), so this is cheap.
+        """
+        if self._rpmdbMtime() != self._serve_rpmdb_mtime:
+            self.logger.info("rpmdb changed, reloading")
+            self.closeRpmDB()
+            self._resetCaches()
+            self._serve_rpmdb_mtime = self._rpmdbMtime()
+
+        if self.conf.cache or 'pkgSack' not in self._sacks:
+            return
+
+        if not self.options.nolock:
+            try:
+                self.doLock()
+            except yum.Errors.LockError:
+                return # Something else is using the cache, try next time
+        try:
+            for repo in self.repos.listEnabled():
+                repo._metadataCurrent = None
+                if repo.metadataCurrent():
+                    continue
+                repo._repoXML = None
+                try:
+                    timestamp = repo.repoXML.timestamp
+                except yum.Errors.RepoError, e:
+                    self.logger.error(e)
+                    continue
+                if timestamp == self._serve_repomd.get(repo.id):
+                    continue
+
+                self.logger.info("repo %s changed, reloading" % repo.id)
+                repo._resetSack()
+                self._resetCaches()
+                self._getSacks(archlist=self.query_archlist,
+                               thisrepo=repo.id)
+                if self._have_otherdata:
+                    self.repos.populateSack(which=[repo.id],
+                                            mdtype='otherdata')
+                if self._have_groups:
+                    self._comps = None
+                    self._have_groups = False
+                self._serve_repomd[repo.id] = timestamp
+        finally:
+            if not self.options.nolock:
+                self.doUnlock()
+
+    def handleRequest(self, parser, request):
+        """
+        Run a JSON decoded query request, and return the response for it.
+        Requests are objects with either "argv" (a list of repoquery
+        arguments), or "query" (one of whatprovides, whatrequires, requires
+        or queryformat) plus "args", and optionally "queryformat" and
+        "resolve". The response has "status", "output" (list of lines) and
+        "errors" (list of lines).
+
+        @type  parser:  L{optparse.OptionParser}
+        @type  request: dict
+        @rtype: dict
+        """
+        if not isinstance(request, dict):
+            return {'status' : 1, 'output' : [],
+                    'errors' : ["Bad request, not an object"]}
+        if 'argv' in request:
+            args = list(request['argv'])
+        elif request.get('query') in _serve_queries:
+            args = _serve_queries[request['query']][:]
+            if request.get('resolve'):
+                args.append('--resolve')
+            if request.get('queryformat'):
+                args.extend(['--qf', request['queryformat']])
+            args.extend(request.get('args', []))
+        else:
+            return {'status' : 1, 'output' : [],
+                    'errors' : ["Bad request, unknown query: %s" %
+                                request.get('query')]}
+
+        out = StringIO()
+        err = StringIO()
+        handler = logging.StreamHandler(err)
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        handler.setLevel(logging.ERROR)
+        self.logger.addHandler(handler)
+        stdout = sys.stdout
+        sys.stdout = out
+        try:
+            ran = self.runQueryArgs(parser, [str(arg) for arg in args], True)
+        finally:
+            sys.stdout = stdout
+            self.logger.removeHandler(handler)
+
+        errors = [to_unicode(line) for line in err.getvalue().splitlines()]
+        return {'status' : int(not ran or bool(errors)),
+                'output' : [to_unicode(line)
+                            for line in out.getvalue().splitlines()],
+                'errors' : errors}
+
+    # Max. length of a request line, so a client can't eat all our memory
+    _serve_max_request = 1024 * 1024
+
+    def serve(self, parser, path):
+        """
+        Answer JSON encoded query requests, one per line, from any number of
+        clients connected to the UNIX socket at path. The sacks stay loaded,
+        and are only reloaded when the metadata changes. Requests are
+        answered in the order they arrive, as yum isn't thread safe.
+
+        @type  parser: L{optparse.OptionParser}
+        @type  path:   str
+        """
+        def _error(msg):
+            return json.dumps({'status' : 1, 'output' : [], 'errors' : [msg]})
+
+        if os.path.exists(path):
+            if query_daemon_running(path):
+                raise queryError("Already serving on %s" % path)
+            os.unlink(path)
+
+        self._serve_repomd = self._repomdTimestamps()
+        self._serve_rpmdb_mtime = self._rpmdbMtime()
+        # Let yum, and other repoquery's, use the cache while we idle.
+        if not self.options.nolock:
+            self.doUnlock()
+
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(path)
+        listener.listen(64)
+
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        clients = {}
+        try:
+            while True:
+                readable = select.select([listener] + clients.keys(), [], [])[0]
+                for sock in readable:
+                    if sock is listener:
+                        conn, addr = listener.accept()
+                        clients[conn] = ''
+                        continue
+
+                    try:
+                        data = sock.recv(65536)
+                    except socket.error:
+                        data = ''
+                    if not data:
+                        del clients[sock]
+                        sock.close()
+                        continue
+
+                    clients[sock] += data
+                    if (len(clients[sock]) > self._serve_max_request and
+                        '\n' not in clients[sock]):
+                        try:
+                            sock.sendall(_error("Bad request, too long") +
+                                         '\n')
+                        except socket.error:
+                            pass
+                        del clients[sock]
+                        sock.close()
+                        continue
+                    while sock in clients and '\n' in clients[sock]:
+                        line, clients[sock] = clients[sock].split('\n', 1)
+                        if not line.strip():
+                            continue
+                        try:
+                            request = json.loads(line)
+                        except ValueError, e:
+                            resp = _error("Bad request: %s" % e)
+                        else:
+                            #  Whatever goes wrong with one request, the
+                            # daemon has to keep answering the others.
+                            try:
+                                self.checkMetadata()
+                                resp = json.dumps(self.handleRequest(parser,
+                                                                     request))
+                            except Exception, e:
+                                resp = _error("Error: %s" % e)
+                        try:
+                            sock.sendall(resp + '\n')
+                        except socket.error:
+                            del clients[sock]
+                            sock.close()
+        finally:
+            listener.close()
+            os.unlink(path)
+
+    def _groupMembers(self):
+        """
+        Return a dict of package name => ids of the groups it is in, this is
+        built from comps once, instead of scanning every group per package.
+        """
+        if self._group_members is None:
+            members = {}
+            for group in self.comps.get_groups():
+                for name in group.packages:
+                    grps = members.setdefault(name, [])
+                    if not grps or grps[-1] != group.groupid:
+                        grps.append(group.groupid)
+            self._group_members = members
+        return self._group_members
+
     def find_groupmember(self, name, **kw):
-        grps = []
-        for group in self.comps.get_groups():
-            if name in group.packages:
-                grps.append(group.groupid)
-        return grps
+        return list(self._groupMembers().get(name, []))
 
     def fmt_whatprovides(self, name, **kw):
         return self.returnPackagesByDepStr(name)
 
+    def _requiresIndex(self):
+        """
+        Return a dict of requirement name => packages requiring it, for
+        the packages in the sacks we are using. This is built once (per.
+        set of sacks) and lets --whatrequires --recursive do a lookup per
+        provide, instead of a sack search.
+        """
+        key = tuple(self._sacks)
+        if key not in self._requires_index:
+            index = {}
+            for sackstr in self._sacks:
+                sack = getattr(self, sackstr)
+                for pkg in sack.returnPackages():
+                    for (n, f, (e, v, r)) in pkg.returnPrco('requires'):
+                        pkgs = index.setdefault(n, [])
+                        if not pkgs or pkgs[-1] is not pkg:
+                            pkgs.append(pkg)
+            self._requires_index[key] = index
+        return self._requires_index[key]
+
+    def _searchRequiresIndex(self, index, prov):
+        """ Same as searchRequires() over all our sacks, but using index. """
+        try:
+            (n, f, (e, v, r)) = misc.string_to_prco_tuple(prov)
+        except yum.Errors.MiscError:
+            n = None
+        if n is None or misc.re_glob(n):
+            pkgs = []
+            for sackstr in self._sacks:
+                sack = getattr(self, sackstr)
+                pkgs.extend(sack.searchRequires(prov))
+            return pkgs
+
+        pkgs = index.get(n, [])
+        if f is None:
+            return pkgs
+        return [pkg for pkg in pkgs
+                if pkg.inPrcoRange('requires', (n, f, (e, v, r)))]
+
     def fmt_whatrequires(self, name, **kw):
         pkgs = {}
         done = set() # keep track of names we have already visited
-
-        def require_recursive(name):
+        if self.options.output in ('ascii-tree','dot-tree'):
+            return self.queryPkgFactory([])
+
+        #  With --recursive we can look at a lot of provides, so index all the
+        # requires once. Without it, just search the sacks.
+        index = None
+        if self.options.recursive:
+            index = self._requiresIndex()
+
+        todo = deque([name])
+        while todo:
+            name = todo.popleft()
             if name in done:
-                return
+                continue
             done.add(name)
 
             provs = [name]
@@ -1110,17 +2183,18 @@ class YumBaseQuery(yum.YumBase):
                     provs.extend(pkg.files())
 
             for prov in provs:
+                if index is not None:
+                    for pkg in self._searchRequiresIndex(index, prov):
+                        pkgs[pkg.pkgtup] = pkg
+                        if pkg.name not in done:
+                            todo.append(pkg.name)
+                    continue
+
                 for sackstr in self._sacks:
                     sack = getattr(self, sackstr)
                     for pkg in sack.searchRequires(prov):
                         pkgs[pkg.pkgtup] = pkg
-                        if self.options.recursive:
-                            require_recursive(pkg.name)
-                
 
-        
-        if self.options.output not in ('ascii-tree','dot-tree'):
-            require_recursive(name)
         return self.queryPkgFactory(sorted(pkgs.values()))
 
     def fmt_whatobsoletes(self, name, **kw):
@@ -1142,16 +2216,25 @@ class YumBaseQuery(yum.YumBase):
     def fmt_requires(self, name, requires="requires", **kw):
         pkgs = {}
         done = set()
+        qpkgs = {} # Only make one query per. provider
         def require_recursive(pkg):
             if pkg.name in done:
                 return
             done.add(pkg.name)
 
             for req in pkg.prco(requires):
-                for res in self.fmt_whatprovides(req):
-                    pkgs[(res.name, res.pkg.arch)] = res
-                    if self.options.recursive:
-                        require_recursive(res)
+                providers = self.returnProviders(req)
+                if providers is None:
+                    self.logger.error("No package provides %s" % req)
+                    continue
+                for prov in providers:
+                    key = (prov.repoid, prov.pkgtup)
+                    if key not in qpkgs:
+                        qpkgs[key] = self.queryPkgFactory([prov])
+                    for res in qpkgs[key]:
+                        pkgs[(res.name, res.pkg.arch)] = res
+                        if self.options.recursive:
+                            require_recursive(res)
 
         for pkg in self.returnByName(name):
             require_recursive(pkg)
@@ -1175,14 +2258,137 @@ class YumBaseQuery(yum.YumBase):
         return self.fmt_requires(name, requires="info_reverse_requires", **kw)
 
     def fmt_location(self, name):
-        loc = []
-        for pkg in self.returnByName(name):
-            repo = self.repos.getRepo(pkg['repoid'])
-            if pkg['basepath']:
-                loc.append("%s/%s" % (pkg['basepath'], pkg['relativepath']))
+        return [self.pkgLocation(qpkg.pkg) for qpkg in self.returnByName(name)]
+
+    def repoURL(self, repo):
+        """
+        Return the URL packages from the repo. are downloaded from now, or
+        None if it has no URLs (Eg. the rpmdb). That's the current mirror of
+        its grabber, which starts at a random one for
+        failovermethod=roundrobin and drops any that failed, not always the
+        first of repo.urls. There's no API for the current mirror, this
+        relies on the _next index of urlgrabber's MirrorGroup, and uses
+        repo.urls[0] if that isn't there.
+        """
+        if repo.id not in self._repo_urls:
+            urls = getattr(repo, 'urls', None)
+            if not urls:
+                self._repo_urls[repo.id] = None
+                return None
+            url = None
+            try:
+                grab = repo.grab
+                mirrors = grab.mirrors
+                if mirrors and hasattr(grab, '_next'):
+                    url = mirrors[grab._next % len(mirrors)]['mirror']
+            except (AttributeError, KeyError, TypeError,
+                    yum.Errors.RepoError):
+                pass
+            if not url:
+                url = urls[0]
+            if url[-1] != '/':
+                url = url + '/'
+            self._repo_urls[repo.id] = url
+        return self._repo_urls[repo.id]
+
+    def pkgLocation(self, pkg):
+        """
+        Return the URL to download an available package from, or '' for
+        installed ones.
+        """
+        relativepath = getattr(pkg, 'relativepath', None)
+        if not relativepath:
+            return ''
+        basepath = getattr(pkg, 'basepath', None)
+        if basepath:
+            return "%s/%s" % (basepath, relativepath)
+        url = self.repoURL(pkg.repo)
+        if url is None:
+            return ''
+        #  Not urljoin(), that drops the base of schemes it doesn't know,
+        # like media://. repoURL() ends with a /.
+        return url + relativepath
+
+    def _hdrPkgs(self, items, tags):
+        """
+        Return the installed packages matching the items, as dicts of the
+        given header tags, sorted like the packages would be. This doesn't
+        create a YumInstalledPackage per installed package.
+        """
+        match = None
+        if items and items != ['*']:
+            match = glob_matcher(items)
+
+        pkgs = []
+        for hdr in self.rpmdb.readOnlyTS().dbMatch():
+            if hdr['name'] == 'gpg-pubkey':
+                continue
+            pkg = dict([(tag, hdr[tag]) for tag in tags])
+            if pkg['epoch'] is None:
+                pkg['epoch'] = '0'
             else:
-                loc.append("%s/%s" % (repo.urls[0], pkg['relativepath']))
-        return loc
+                pkg['epoch'] = str(pkg['epoch'])
+            if match is not None:
+                nvr = "%(name)s-%(version)s-%(release)s" % pkg
+                if not (match(pkg['name']) or
+                        match("%(name)s.%(arch)s" % pkg) or
+                        match("%(name)s-%(version)s" % pkg) or
+                        match(nvr) or
+                        match("%s.%s" % (nvr, pkg['arch'])) or
+                        match("%s:%s.%s" % (pkg['epoch'], nvr, pkg['arch'])) or
+                        match("%(name)s-%(epoch)s:%(version)s-%(release)s."
+                              "%(arch)s" % pkg)):
+                    continue
+            pkgs.append(pkg)
+
+        def _cmp_pkgs(a, b):
+            ret = cmp(a['name'], b['name'])
+            if ret == 0:
+                ret = compareEVR((a['epoch'], a['version'], a['release']),
+                                 (b['epoch'], b['version'], b['release']))
+            if ret == 0:
+                ret = cmp(a['arch'], b['arch'])
+            return ret
+        pkgs.sort(_cmp_pkgs)
+        return pkgs
+
+    def runInstalled(self, items, qf):
+        """
+        Print a query format for the installed packages matching the items,
+        reading only the header tags it needs from the rpmdb. Returns False,
+        without doing anything, if the format needs more than that.
+        """
+        tags = hdrPkgQuery.projection(qf)
+        if tags is None:
+            return False
+        qpkg = None
+        for pkg in self._hdrPkgs(items, tags):
+            if qpkg is None:
+                qpkg = hdrPkgQuery(pkg, qf, self)
+            qpkg.pkg = pkg
+            qpkg.name = pkg['name']
+            try:
+                out = qpkg.fmt_queryformat()
+                if out:
+                    print to_unicode(out)
+            except queryError, e:
+                self.logger.error(e)
+        return True
+
+    def runLocations(self, items):
+        """
+        Print the --location of all the packages matching the items, as they
+        are worked out. This is --location without any other query, so we
+        don't need query objects for the packages.
+        """
+        try:
+            pkgs = self.matchPkgs(items, plain_pkgs=True)
+        except yum.Errors.RepoError, e:
+            raise queryError("Could not match packages: %s" % to_unicode(e))
+        for pkg in sorted(pkgs):
+            if isinstance(pkg, yum.packages.YumInstalledPackage):
+                continue
+            print to_unicode(self.pkgLocation(pkg))
 
     def _parseSetOpts(self, setopts):
         """parse the setopts list handed to us and saves the results as
@@ -1223,15 +2429,58 @@ class YumBaseQuery(yum.YumBase):
         return bad_setopt_tm, bad_setopt_ne
 
 
-def main(args):
+# Requests (other than "argv" ones) the --serve daemon answers.
+_serve_queries = {'whatprovides' : ['--whatprovides'],
+                  'whatrequires' : ['--whatrequires'],
+                  'requires'     : ['--requires'],
+                  'queryformat'  : [],
+                 }
 
-    needother = 0
-    needgroup = 0
-    needsource = 0
+def query_daemon_running(path):
+    """ Is something answering on the UNIX socket at path. """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        try:
+            sock.connect(path)
+        except socket.error:
+            return False
+        return True
+    finally:
+        sock.close()
+
+def query_daemon(path, argv):
+    """
+    Send a query to a repoquery --serve daemon, and print the result.
 
-    signal.signal(signal.SIGPIPE, signal.SIG_DFL)
-    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    @type  path: str
+    @type  argv: list of str, repoquery arguments for the query
+    @rtype: int exit status, or None if there's no daemon to talk to
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except socket.error:
+        sock.close()
+        return None
 
+    try:
+        sock.sendall(json.dumps({'argv' : argv}) + '\n')
+        fo = sock.makefile('r')
+        line = fo.readline()
+        fo.close()
+    finally:
+        sock.close()
+    if not line:
+        return None
+
+    resp = json.loads(line)
+    for line in resp['output']:
+        print to_unicode(line)
+    for line in resp['errors']:
+        print >>sys.stderr, to_unicode(line)
+    return resp['status']
+
+def make_parser():
     parser = OptionParser(version = "Repoquery version %s" % version)
     # query options
     parser.add_option("-l", "--list", action="store_true",
@@ -1317,6 +2566,9 @@ def main(args):
                       help="check dependencies exactly as given, opposite of --alldeps")
     parser.add_option("--recursive", action="store_true",
                       help="recursively query for packages (for whatrequires)")
+    parser.add_option("--cache-provides", action="store_true",
+                      dest="cache_provides", default=False,
+                      help="keep the providers of requirements in the cachedir between runs (for --resolve)")
     parser.add_option("--whatprovides", action="store_true",
                       help="query what package(s) provide a capability")
     parser.add_option("--whatrequires", action="store_true",
@@ -1383,37 +2635,48 @@ def main(args):
     parser.add_option("--level", dest="tree_level", default="all",
                       help="levels to display (can be any number or 'all', default to 'all')")
     parser.add_option("--output", dest="output", default="text",
-                      help="output format to use (can be text|ascii-tree|dot-tree|ascii-tree+|dot-tree+, default to 'text')")
+                      help="output format to use (can be text|ascii-tree|dot-tree|ascii-tree+|dot-tree+|jsonl|csv, default to 'text')")
     parser.add_option("--search", action="store_true",
                       dest="search", default=False,
                       help="Use yum's search to return pkgs")
     parser.add_option("--search-fields", action="append", dest="searchfields",
                       default=[],
                       help="search fields to search using --search")
+    parser.add_option("--search-index", action="store_true",
+                      dest="search_index", default=False,
+                      help="use an index of words for --search, all the words "
+                           "have to match and results are ranked")
     parser.add_option("--installroot", default="/", help="set install root")
     parser.add_option("", "--setopt", dest="setopts", default=[],
                      action="append",
                      help="set arbitrary config and repo options")
-                      
-
-    (opts, regexs) = parser.parse_args()
-
-    if opts.querytags:
-        querytags.sort()
-        for tag in querytags:
-            print tag
-        sys.exit(0)
+    parser.add_option("--batch", action="store_true", default=False,
+                      help="read queries (options and arguments) from stdin, one per line")
+    parser.add_option("--batch-delim", dest="batch_delim", default="%%",
+                      help="line to write after the output of each query in --batch mode (default '%%')")
+    parser.add_option("--serve", metavar="SOCKET",
+                      help="keep the metadata loaded and answer queries from clients on the given UNIX socket")
+    parser.add_option("--connect", metavar="SOCKET",
+                      help="send the query to a repoquery --serve daemon on the given UNIX socket, if there is one")
+    add_profile_option(parser)
+    parser.add_option("--profile-file", metavar="FILE", dest="profile_file",
+                      help="write cProfile stats of the formatting of the query results to FILE (implies --profile)")
+
+    return parser
+
+def query_ops(opts):
+    """
+    Work out the package and sack operations for the parsed options of a
+    query (this also fixes up some of the options, Eg. output).
 
-    if len(regexs) < 1:
-        if opts.all:
-            regexs = ['*']
-        else:
-            print parser.format_help()
-            sys.exit(1)
+    @rtype: tuple of (pkgops, sackops, needother, needgroup, needsource)
+    """
+    needother = 0
+    needgroup = 0
+    needsource = 0
 
     pkgops = []
     sackops = []
-    archlist = None
     if opts.info:
         pkgops.append("info")
     if opts.requires:
@@ -1477,7 +2740,7 @@ def main(args):
     if opts.srpm:
         needsource = 1
     if opts.whatrequires:
-        if opts.output != 'text':
+        if opts.output not in ('text',) + record_outputs:
             pkgops.append("tree_what_requires")
         else:
             sackops.append("whatrequires")
@@ -1503,6 +2766,60 @@ def main(args):
     elif len(pkgops) == 0 and len(sackops) == 0:
         pkgops.append("queryformat")
 
+    if opts.searchfields or opts.search_index:
+        opts.search = True
+
+    return pkgops, sackops, needother, needgroup, needsource
+
+def main(args):
+
+    signal.signal(signal.SIGPIPE, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+
+    parser = make_parser()
+    (opts, regexs) = parser.parse_args()
+
+    if opts.querytags:
+        querytags.sort()
+        for tag in querytags:
+            print tag
+        sys.exit(0)
+
+    #  The daemon has its own config., repos. and sacks, so only plain
+    # queries go to it.
+    if opts.connect and [opt for opt in YumBaseQuery._batch_fixed_opts
+                         if opt not in YumBaseQuery._serve_ok_opts and
+                         getattr(opts, opt) != parser.defaults.get(opt)]:
+        opts.connect = None
+    if opts.connect:
+        argv = []
+        skip = False
+        for arg in args[1:]:
+            if skip:
+                skip = False
+            elif arg == '--connect':
+                skip = True
+            elif not arg.startswith('--connect='):
+                argv.append(arg)
+        try:
+            status = query_daemon(opts.connect, argv)
+        except (socket.error, ValueError, KeyError):
+            status = None
+        # No (working) daemon, so just do the query ourself
+        if status is not None:
+            sys.exit(status)
+
+    if len(regexs) < 1 and not opts.batch and not opts.serve:
+        if opts.all:
+            regexs = ['*']
+        else:
+            print parser.format_help()
+            sys.exit(1)
+
+    (pkgops, sackops,
+     needother, needgroup, needsource) = query_ops(opts)
+    archlist = None
+
     for exp in regexs:
         if exp.endswith('.src'):
             needsource = 1
@@ -1514,10 +2831,9 @@ def main(args):
         archlist = getArchList()
         archlist.append('src')
 
-    if opts.searchfields:
-        opts.search = True
-        
     repoq = YumBaseQuery(pkgops, sackops, opts)
+    repoq.profiler = get_profiler(opts.profile, opts.profile_file)
+    repoq.profiler.phase('config')
 
     # go through all the setopts and set the global ones
     bad_setopt_tm, bad_setopt_ne = repoq._parseSetOpts(opts.setopts)
@@ -1556,6 +2872,7 @@ def main(args):
                 repoq.logger.warning(msg % opt)
             setattr(repoq.conf, opt, getattr(repoq.main_setopts, opt))
 
+    repoq.profiler.phase('repo setup')
     if opts.repofrompath:
         # setup the fake repos
         for repo in opts.repofrompath:
@@ -1647,28 +2964,49 @@ def main(args):
             sys.exit(50)
         time.sleep(2)
 
+    repoq.query_archlist = archlist
     try:
+        repoq.profiler.phase('metadata')
+        mdtypes = ['primary']
+        if needother:
+            mdtypes.append('other')
+        repoq.repos.doSetup()
+        (taken, results) = prefetch_metadata(repoq.repos.listEnabled(),
+                                             mdtypes, cache=repoq.conf.cache)
+        repoq.profiler.phase('sack setup')
+        start = time.time()
         if not hasattr(repoq, 'arch'):
             repoq.doSackSetup(archlist=archlist)
         elif archlist is not None:
             repoq.arch.archlist = archlist
+        if not opts.quiet and results:
+            for line in format_timing(taken, results):
+                repoq.logger.info(line)
+            repoq.logger.info("  Sack setup: %.2fs" % (time.time() - start))
 
         #  Don't do needfiles, because yum will do it automatically and it's
         # not trivial to get it "right" so we don't download them when not
         # needed.
-        if needother:
-            repoq.repos.populateSack(mdtype='otherdata')
-        if needgroup:
-            repoq.doGroupSetup()
+        repoq.setupExtraMetadata(needother, needgroup)
     except (yum.Errors.RepoError, yum.Errors.GroupsError), e:
         repoq.logger.error(e)
         sys.exit(1)
 
     try:
-        repoq.runQuery(regexs)
+        if opts.serve:
+            repoq.serve(parser, opts.serve)
+        elif opts.batch:
+            repoq.runBatch(parser)
+        else:
+            repoq.runQuery(regexs)
+        repoq.saveProvidesCache()
+        if not opts.quiet and (repoq._provides_hits or repoq._provides_misses):
+            repoq.logger.info("Provides cache: %d hits, %d misses" %
+                              (repoq._provides_hits, repoq._provides_misses))
     except (yum.Errors.RepoError, yum.Errors.MiscError, queryError), e:
         repoq.logger.error(e)
         sys.exit(1)
+    repoq.profiler.done()
 
 if __name__ == "__main__":
     misc.setup_locale()
@@ -34,27 +34,785 @@
 
 import os
 import sys
+import errno
+import fcntl
 import shutil
 import stat
+import multiprocessing
+import subprocess
+import tempfile
+import time
+from multiprocessing.queues import SimpleQueue
+import sqlite3
 
 from optparse import OptionParser
-from urlparse import urljoin
+from urlparse import urljoin, urlparse
 
 from yumutils.i18n import _
+from yumutils.profiling import add_profile_option, get_profiler
 
 import yum
 import yum.Errors
+from yum import misc
 from yum.packageSack import ListPackageSack
+from yum.repoMDObject import ns_cleanup
+import rpm
+import rpmUtils
 import rpmUtils.arch
+import rpmUtils.miscutils
+from rpmUtils.miscutils import splitFilename
 import logging
-from urlgrabber.progress import TextMeter, TextMultiFileMeter
+from urlgrabber.progress import TextMeter, TextMultiFileMeter, format_number
+from urlgrabber.grabber import URLGrabError
 import urlgrabber
 
+try:
+    from xml.etree import cElementTree
+except ImportError:
+    import cElementTree
+iterparse = cElementTree.iterparse
+
 class RepoSync(yum.YumBase):
     def __init__(self, opts):
         yum.YumBase.__init__(self)
         self.logger = logging.getLogger('yum.verbose.reposync')
         self.opts = opts
+        self.downloaded = None
+
+    def verifyPkg(self, fo, po, raiseError):
+        """
+        As YumBase, and call self.downloaded(po) (if set) for each good one,
+        so the sequential downloadPkgs() tells us as each package lands.
+        """
+        ret = yum.YumBase.verifyPkg(self, fo, po, raiseError)
+        if ret and self.downloaded is not None:
+            self.downloaded(po)
+        return ret
+
+#  The download workers are forked from us, so they get the packages from
+# here, instead of having them pickled.
+_download_yb = None
+_download_pkgs = []
+# (num, pid) of each download as it starts, to tell if its worker dies
+_download_started = None
+
+def _download_pkg(num):
+    """
+    Worker: download a package with YumBase.downloadPkgs(), returns
+    (num, [errors]).
+    """
+    pkg = _download_pkgs[num]
+    _download_started.put((num, os.getpid()))
+    try:
+        probs = _download_yb.downloadPkgs([pkg])
+    except KeyboardInterrupt:
+        return (num, ['interrupted'])
+    except Exception, e:
+        return (num, [str(e)])
+    errors = []
+    for key in probs:
+        errors.extend([str(error) for error in probs[key]])
+    return (num, errors)
+
+class DownloadScheduler:
+    """
+    Downloads the packages of all the repos at once, with worker processes.
+    At most max_connections downloads run at a time, and at most
+    max_host_connections from any one host. The host is that of the first
+    url of the repo, which isn't where a mirrorlist repo downloads from. The
+    next package comes from each repo in turn, so they all make progress.
+    """
+
+    def __init__(self, yb, max_connections, max_host_connections=2,
+                 quiet=False):
+        self.yb = yb
+        self.max_connections = max_connections
+        self.max_host_connections = max_host_connections
+        self.quiet = quiet
+        # [(repoid, host, [num])]
+        self.queues = []
+        self.pkgs = []
+        self._turn = 0
+        self.total_pkgs = 0
+        self.total_size = 0
+        self._todo = {}
+
+    def _host(self, repo):
+        if not repo.urls:
+            return repo.id
+        return urlparse(repo.urls[0])[1] or repo.id
+
+    def addRepo(self, repo, pkgs):
+        """ Queue the pkgs of the repo (with their localpath set). """
+        nums = []
+        for pkg in pkgs:
+            nums.append(len(self.pkgs))
+            self.pkgs.append(pkg)
+            #  Only what isn't there already counts for the progress, as for
+            # text_meter_total_size().
+            sz = int(pkg.returnSimple('packagesize'))
+            if not (os.path.exists(pkg.localpath) and
+                    os.path.getsize(pkg.localpath) == sz):
+                self._todo[len(self.pkgs) - 1] = sz
+                self.total_pkgs += 1
+                self.total_size += sz
+        self.queues.append((repo.id, self._host(repo), nums))
+
+    def _next(self, hosts):
+        """
+        Return the next package to download, from the next repo (in turn)
+        which has packages left and a host with a free connection. None if
+        there isn't one.
+        """
+        for i in range(len(self.queues)):
+            (repoid, host, nums) = self.queues[(self._turn + i) %
+                                               len(self.queues)]
+            if nums and hosts.get(host, 0) < self.max_host_connections:
+                self._turn = (self._turn + i + 1) % len(self.queues)
+                return nums.pop(0)
+        return None
+
+    def _progress(self, num, done):
+        pkg = self.pkgs[num]
+        self.yb.logger.info('(%d/%d) [%s] %s  %s/%s' %
+                            (done[0], self.total_pkgs, pkg.repoid,
+                             os.path.basename(pkg.remote_path),
+                             format_number(done[1]),
+                             format_number(self.total_size)))
+
+    def _died(self, pid):
+        """ Has the worker with pid gone (and been reaped by the pool). """
+        if pid is None:
+            return False
+        try:
+            os.kill(pid, 0)
+        except OSError, e:
+            return e.errno == errno.ESRCH
+        return False
+
+    def run(self, downloaded=None):
+        """
+        Download everything, calling downloaded(pkg) (if given) for each
+        package as it's done. Returns a dict of repoid => {pkg: [errors]}
+        of the packages that failed, including the ones whose worker died.
+        """
+        global _download_yb, _download_pkgs, _download_started
+
+        failed = {}
+        if not self.pkgs:
+            return failed
+
+        # The workers can't share the progress meter, we do the progress.
+        self.yb.repos.setProgressBar(None)
+        _download_yb = self.yb
+        _download_pkgs = self.pkgs
+        _download_started = SimpleQueue()
+        pool = multiprocessing.Pool(min(self.max_connections,
+                                        len(self.pkgs)))
+        hosts = {}
+        # num => (host, AsyncResult)
+        running = {}
+        pids = {}
+        done = [0, 0]
+        try:
+            while True:
+                while len(running) < self.max_connections:
+                    num = self._next(hosts)
+                    if num is None:
+                        break
+                    host = self._host(self.pkgs[num].repo)
+                    hosts[host] = hosts.get(host, 0) + 1
+                    running[num] = (host, pool.apply_async(_download_pkg,
+                                                           (num,)))
+                if not running:
+                    break
+
+                #  The pool just replaces a worker which dies, its download
+                # never returns, so poll (which also lets ^C through).
+                time.sleep(0.1)
+                while not _download_started.empty():
+                    (num, pid) = _download_started.get()
+                    pids[num] = pid
+                for num in running.keys():
+                    (host, result) = running[num]
+                    if not result.ready():
+                        if not self._died(pids.get(num)):
+                            continue
+                        #  In case it died after sending the result.
+                        result.wait(1)
+                    if result.ready():
+                        errors = result.get()[1]
+                    else:
+                        errors = [_('the download process died')]
+                    del running[num]
+                    pids.pop(num, None)
+                    hosts[host] -= 1
+                    pkg = self.pkgs[num]
+                    if errors:
+                        if pkg.repoid not in failed:
+                            failed[pkg.repoid] = {}
+                        failed[pkg.repoid][pkg] = errors
+                        for error in errors:
+                            self.yb.logger.error('%s: %s', pkg, error)
+                        continue
+                    if downloaded is not None:
+                        downloaded(pkg)
+                    if num in self._todo:
+                        done[0] += 1
+                        done[1] += self._todo[num]
+                        if not self.quiet:
+                            self._progress(num, done)
+        finally:
+            pool.terminate()
+            pool.join()
+            _download_yb = None
+            _download_pkgs = []
+            _download_started = None
+        return failed
+
+#  The verify workers are forked from us too, for a list of packages at a
+# time.
+_verify_yb = None
+_verify_pkgs = []
+
+def _gpgcheck_pkg(num):
+    """ Worker: sigCheckPkg() a downloaded package, returns (result, error). """
+    try:
+        return _verify_yb.sigCheckPkg(_verify_pkgs[num])
+    except KeyboardInterrupt:
+        return (2, 'interrupted')
+    except Exception, e:
+        return (2, str(e))
+
+def _verify_local(num):
+    """ Worker: is the local file of a package the one in the metadata. """
+    (local, pkg) = _verify_pkgs[num]
+    try:
+        return os.path.exists(local) and _verify_yb.verifyPkg(local, pkg, False)
+    except KeyboardInterrupt:
+        return False
+
+class PkgVerifier:
+    """
+    Checks the signatures of the downloaded pkgs for --gpgcheck, with a
+    worker process per CPU. The workers are forked for the list of pkgs,
+    check() queues one as soon as it's downloaded, and finish() waits for
+    the rest and removes the ones that failed.
+    """
+
+    def __init__(self, yb, pkgs, workers=None):
+        global _verify_yb, _verify_pkgs
+
+        self.yb = yb
+        self.pkgs = pkgs
+        self._nums = dict([(pkg, num) for (num, pkg) in enumerate(pkgs)])
+        self.jobs = {}
+        self.pool = None
+        if not pkgs:
+            return
+        if not workers:
+            workers = multiprocessing.cpu_count()
+        _verify_yb = yb
+        _verify_pkgs = pkgs
+        self.pool = multiprocessing.Pool(min(workers, len(pkgs)))
+
+    def check(self, pkg):
+        """ Queue the signature check of the pkg (once). """
+        num = self._nums[pkg]
+        if num not in self.jobs:
+            self.jobs[num] = self.pool.apply_async(_gpgcheck_pkg, (num,))
+
+    def checkAll(self, failed=()):
+        """ Queue the pkgs not checked yet, but the failed downloads. """
+        for pkg in self.pkgs:
+            if pkg in failed or not os.path.exists(pkg.localpath):
+                continue
+            self.check(pkg)
+
+    def finish(self, failed=()):
+        """
+        Check the pkgs which haven't been yet, and remove the ones that
+        failed, in order. The pkgs in failed didn't download, so they aren't
+        checked. Returns the removed pkgs.
+        """
+        global _verify_yb, _verify_pkgs
+
+        if self.pool is None:
+            return []
+        self.checkAll(failed)
+        self.pool.close()
+        removed = []
+        try:
+            for (num, pkg) in enumerate(self.pkgs):
+                if num not in self.jobs:
+                    continue
+                #  A timeout, so that a ^C isn't ignored while we wait.
+                (result, error) = self.jobs[num].get(86400)
+                if result != 0:
+                    remove_unsigned(self.yb, pkg, result, error)
+                    removed.append(pkg)
+        finally:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+            _verify_yb = None
+            _verify_pkgs = []
+        return removed
+
+def remove_unsigned(my, pkg, result, error):
+    """ Remove a pkg which failed sigCheckPkg(). """
+    rpmfn = os.path.basename(pkg.remote_path)
+    if result == 1:
+        my.logger.warning('Removing %s, due to missing GPG key.' % rpmfn)
+    elif result == 2:
+        my.logger.warning('Removing %s due to failed signature check.' % rpmfn)
+    else:
+        my.logger.warning('Removing %s due to failed signature check: %s' % (rpmfn, error))
+    os.unlink(pkg.localpath)
+
+def verify_local_pkgs(my, pkgs):
+    """
+    Check the local files of the [(local path, pkg)] against the repo
+    metadata, for --urls, with a worker process per CPU. Returns a list of
+    True (it's there and good) or False.
+    """
+    global _verify_yb, _verify_pkgs
+
+    if not pkgs:
+        return []
+    _verify_yb = my
+    _verify_pkgs = pkgs
+    pool = multiprocessing.Pool(min(multiprocessing.cpu_count(), len(pkgs)))
+    try:
+        #  A timeout, so that a ^C isn't ignored while we wait.
+        return pool.map_async(_verify_local, range(len(pkgs))).get(86400)
+    finally:
+        pool.terminate()
+        pool.join()
+        _verify_yb = None
+        _verify_pkgs = []
+
+#  ioctl to make a file share the data of another one, see ioctl_ficlone(2)
+FICLONE = 0x40049409
+
+def reflink(src, dst):
+    """
+    Make dst a copy of src which shares its data (on btrfs, xfs, ...).
+    Raises IOError if the filesystem can't.
+    """
+    sfo = open(src, 'rb')
+    try:
+        dfo = open(dst, 'wb')
+        try:
+            fcntl.ioctl(dfo.fileno(), FICLONE, sfo.fileno())
+        except IOError:
+            dfo.close()
+            os.unlink(dst)
+            raise
+        dfo.close()
+    finally:
+        sfo.close()
+
+def unshare_local(pkg):
+    """
+    Remove the local file of the pkg, if it's hardlinked (by --dedup) and
+    isn't complete. The download would resume into it, and so write into
+    the store and the other repos too. A complete one is only read, and
+    unlinked by the download if it doesn't match.
+    """
+    try:
+        st = os.stat(pkg.localpath)
+    except OSError:
+        return
+    if st.st_nlink > 1 and \
+       st.st_size != int(pkg.returnSimple('packagesize')):
+        os.unlink(pkg.localpath)
+
+class DedupStore:
+    """
+    The synced packages by the checksum from the repo metadata, for
+    --dedup. Packages that are in it already are hardlinked (or reflinked,
+    across devices) into the repo dirs, instead of being downloaded again.
+    """
+
+    dirname = '.reposync-dedup'
+
+    def __init__(self, directory):
+        self.directory = os.path.join(directory, self.dirname)
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+        # store path => the pkg downloading it
+        self.pending = {}
+        # pkgs waiting for one of the pending ones
+        self.deferred = []
+        self.linked = 0
+        self.saved = 0
+
+    def _path(self, pkg):
+        (ctype, csum) = pkg.returnIdSum()
+        return os.path.join(self.directory, ctype, csum[:2], csum)
+
+    def _link(self, src, dst):
+        """ Link src to dst, returns True if it worked. """
+        try:
+            if os.stat(src).st_dev == os.stat(os.path.dirname(dst)).st_dev:
+                os.link(src, dst)
+            else:
+                reflink(src, dst)
+        except (IOError, OSError):
+            return False
+        return True
+
+    def _linkPkg(self, pkg):
+        src = self._path(pkg)
+        if not os.path.exists(src) or not self._link(src, pkg.localpath):
+            return False
+        self.linked += 1
+        self.saved += int(pkg.returnSimple('packagesize'))
+        return True
+
+    def link(self, pkgs):
+        """
+        Link the pkgs (with their localpath set) which are in the store.
+        Returns the ones which have to be downloaded.
+        """
+        ret = []
+        for pkg in pkgs:
+            if os.path.exists(pkg.localpath):
+                #  Let the download check it, it doesn't write into a shared
+                # file as unshare_local() has been done.
+                ret.append(pkg)
+                continue
+            src = self._path(pkg)
+            if src in self.pending:
+                self.deferred.append(pkg)
+                continue
+            if self._linkPkg(pkg):
+                continue
+            self.pending[src] = pkg
+            ret.append(pkg)
+        return ret
+
+    def add(self, pkgs, probs={}):
+        """ Add the downloaded pkgs (apart from the probs) to the store. """
+        for pkg in pkgs:
+            src = self._path(pkg)
+            if pkg in probs or os.path.exists(src):
+                continue
+            if not os.path.exists(os.path.dirname(src)):
+                os.makedirs(os.path.dirname(src))
+            if os.path.exists(pkg.localpath):
+                self._link(pkg.localpath, src)
+
+    def discard(self, pkgs):
+        """ Remove the pkgs from the store, Eg. they failed --gpgcheck. """
+        for pkg in pkgs:
+            try:
+                os.unlink(self._path(pkg))
+            except OSError:
+                pass
+
+    def linkDeferred(self):
+        """
+        Link the deferred pkgs, now what they were waiting for has been
+        downloaded. Returns the ones that still have to be downloaded.
+        """
+        ret = []
+        for pkg in self.deferred:
+            if not self._linkPkg(pkg):
+                ret.append(pkg)
+        self.deferred = []
+        self.pending = {}
+        return ret
+
+    def prune(self):
+        """ Remove the packages which aren't linked from a repo anymore. """
+        for (dirpath, dirnames, filenames) in os.walk(self.directory):
+            for fn in filenames:
+                fn = os.path.join(dirpath, fn)
+                try:
+                    if os.lstat(fn).st_nlink == 1:
+                        os.unlink(fn)
+                except OSError:
+                    pass
+
+APPLYDELTA = '/usr/bin/applydeltarpm'
+
+def _rebuild_pkg(oldrpm, drpm, newrpm, csumtype, csum):
+    """
+    Worker: rebuild newrpm from oldrpm and the drpm with applydeltarpm, and
+    check it against the checksum from the repo metadata. Returns None if it
+    worked, else the error.
+    """
+    tmp = newrpm + '.delta'
+    try:
+        proc = subprocess.Popen([APPLYDELTA, '-r', oldrpm, drpm, tmp],
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT)
+        out = proc.communicate()[0]
+        if proc.returncode:
+            error = out.strip() or 'applydeltarpm exited with %d' % \
+                    proc.returncode
+        elif misc.checksum(csumtype, tmp) != csum:
+            error = 'checksum of the rebuilt package doesn\'t match'
+        else:
+            os.rename(tmp, newrpm)
+            return None
+    except KeyboardInterrupt:
+        error = 'interrupted'
+    except Exception, e:
+        error = str(e)
+    if os.path.exists(tmp):
+        os.unlink(tmp)
+    return error
+
+def read_deltas(repo):
+    """
+    Read the prestodelta (or deltainfo) metadata of the repo, if it has
+    any. Returns a dict of the pkgtup of the new package => [delta], each
+    delta a dict of oldepoch, oldversion, oldrelease, filename and size.
+    """
+    for mdtype in ('prestodelta', 'deltainfo'):
+        if mdtype in repo.repoXML.fileTypes():
+            break
+    else:
+        return {}
+
+    deltas = {}
+    fn = misc.decompress(repo.retrieveMD(mdtype))
+    for (event, elem) in iterparse(fn):
+        if ns_cleanup(elem.tag) != 'newpackage':
+            continue
+        pkgtup = (elem.get('name'), elem.get('arch'), elem.get('epoch'),
+                  elem.get('version'), elem.get('release'))
+        for child in elem:
+            if ns_cleanup(child.tag) != 'delta':
+                continue
+            delta = {'oldepoch' : child.get('oldepoch') or '0',
+                     'oldversion' : child.get('oldversion'),
+                     'oldrelease' : child.get('oldrelease')}
+            for item in child:
+                tag = ns_cleanup(item.tag)
+                if tag == 'filename':
+                    delta['filename'] = item.text
+                elif tag == 'size':
+                    delta['size'] = int(item.text)
+            if 'filename' in delta and 'size' in delta:
+                deltas.setdefault(pkgtup, []).append(delta)
+        elem.clear()
+    return deltas
+
+class DeltaRebuilder:
+    """
+    Rebuilds the packages which have an older version in the repo dir
+    already, from the drpms of the repo, for --use-deltas. The drpms are
+    downloaded one after another, and rebuilt (and checked) by worker
+    processes meanwhile.
+    """
+
+    def __init__(self, yb, workers=None, quiet=False):
+        self.yb = yb
+        if not workers:
+            workers = multiprocessing.cpu_count()
+        self.workers = workers
+        self.quiet = quiet
+        self.rebuilt = 0
+        self.saved = 0
+
+    def _oldVersions(self, cache, wanted):
+        """
+        Return (name, arch) => {(epoch, version, release): path} of the rpms
+        in a localpkgs() cache, for the (name, arch)s in wanted. The epoch
+        isn't in the file name, so it's read from the header.
+        """
+        ts = rpm.TransactionSet()
+        ts.setVSFlags(~(rpm._RPMVSF_NOPAYLOAD))
+        ret = {}
+        for rpmname in cache:
+            (n, v, r, e, a) = splitFilename(rpmname)
+            if (n, a) not in wanted:
+                continue
+            path = cache[rpmname]['path']
+            if not os.path.exists(path):
+                continue
+            try:
+                hdr = rpmUtils.miscutils.hdrFromPackage(ts, path)
+            except rpmUtils.RpmUtilsError, e:
+                self.yb.logger.warning(_('Unable to read %s: %s') % (path, e))
+                continue
+            (n, a, e, v, r) = rpmUtils.miscutils.pkgTupleFromHeader(hdr)
+            ret.setdefault((n, a), {})[(e, v, r)] = path
+        return ret
+
+    def _pickDelta(self, pkg, deltas, old):
+        """
+        Return (old rpm path, delta) for the smallest delta of the pkg from a
+        version we have, or None.
+        """
+        versions = old.get((pkg.name, pkg.arch))
+        if not versions:
+            return None
+        best = None
+        for delta in deltas.get(pkg.pkgtup, []):
+            path = versions.get((delta['oldepoch'], delta['oldversion'],
+                                 delta['oldrelease']))
+            if path is None:
+                continue
+            if best is None or delta['size'] < best[1]['size']:
+                best = (path, delta)
+        if best is not None and \
+           best[1]['size'] >= int(pkg.returnSimple('packagesize')):
+            return None
+        return best
+
+    def rebuild(self, repo, pkgs, cache):
+        """
+        Rebuild what we can of the pkgs (with their localpath set) from the
+        deltas of the repo and the rpms in cache (from localpkgs()). Returns
+        the pkgs that still have to be downloaded.
+        """
+        try:
+            deltas = read_deltas(repo)
+        except (yum.Errors.RepoError, misc.MiscError, SyntaxError), e:
+            self.yb.logger.warning(_('%s: Unable to read the deltas: %s') %
+                                   (repo.id, e))
+            return pkgs
+        if not deltas:
+            return pkgs
+
+        wanted = set([(pkg.name, pkg.arch) for pkg in pkgs
+                      if pkg.pkgtup in deltas])
+        old = self._oldVersions(cache, wanted)
+        jobs = []
+        for pkg in pkgs:
+            if os.path.exists(pkg.localpath):
+                # let the download check it
+                continue
+            best = self._pickDelta(pkg, deltas, old)
+            if best is not None:
+                jobs.append((pkg, best[0], best[1]))
+        if not jobs:
+            return pkgs
+
+        done = set()
+        tmpdir = tempfile.mkdtemp(prefix='.reposync-deltas-',
+                                  dir=os.path.dirname(jobs[0][0].localpath))
+        pool = multiprocessing.Pool(min(self.workers, len(jobs)))
+        try:
+            results = []
+            for (pkg, oldrpm, delta) in jobs:
+                drpm = os.path.join(tmpdir, os.path.basename(delta['filename']))
+                try:
+                    repo.grab.urlgrab(delta['filename'], drpm,
+                                      copy_local=True, reget=None,
+                                      size=delta['size'])
+                except (URLGrabError, yum.Errors.RepoError), e:
+                    self.yb.logger.warning(_('%s: Unable to download the '
+                                             'delta, downloading the package: '
+                                             '%s') % (pkg, e))
+                    continue
+                (ctype, csum) = pkg.returnIdSum()
+                result = pool.apply_async(_rebuild_pkg,
+                                          (oldrpm, drpm, pkg.localpath,
+                                           ctype, csum))
+                results.append((pkg, delta, result))
+            pool.close()
+
+            for (pkg, delta, result) in results:
+                #  A timeout, so that a ^C isn't ignored while we wait.
+                error = result.get(86400)
+                if error is not None:
+                    self.yb.logger.warning(_('%s: Unable to rebuild from the '
+                                             'delta, downloading the package: '
+                                             '%s') % (pkg, error))
+                    continue
+                done.add(pkg)
+                self.rebuilt += 1
+                self.saved += int(pkg.returnSimple('packagesize')) - \
+                              delta['size']
+                if not self.quiet:
+                    self.yb.logger.info(_('Rebuilt %s from a delta') %
+                                        os.path.basename(pkg.remote_path))
+        finally:
+            pool.terminate()
+            pool.join()
+            shutil.rmtree(tmpdir, ignore_errors=True)
+        return [pkg for pkg in pkgs if pkg not in done]
+
+class PkgState:
+    """
+    The packages reposync has synced into a repo dir: the pkgId, size and
+    mtime of each one, and whether it passed --gpgcheck. Kept in a sqlite
+    db in the dir, for --incremental.
+    """
+
+    filename = '.reposync-state.sqlite'
+
+    def __init__(self, directory):
+        self.directory = directory
+        fn = os.path.join(directory, self.filename)
+        self.new = not os.path.exists(fn)
+        self.db = sqlite3.connect(fn)
+        self.db.execute("CREATE TABLE IF NOT EXISTS packages "
+                        "(path TEXT PRIMARY KEY, pkgId TEXT, size INTEGER, "
+                        "mtime INTEGER, verified INTEGER)")
+        # path => (pkgId, verified)
+        self.pkgs = {}
+        cur = self.db.execute("SELECT path, pkgId, verified FROM packages")
+        for (path, pkgId, verified) in cur:
+            self.pkgs[path] = (pkgId, verified)
+
+    def _path(self, remote_path):
+        return os.path.normpath(remote_path)
+
+    def unchanged(self, pkg, verified=False):
+        """
+        Is the pkg what we synced to its remote_path before (and passed
+        --gpgcheck, if verified).
+        """
+        entry = self.pkgs.get(self._path(pkg.remote_path))
+        if entry is None or entry[0] != pkg.pkgId:
+            return False
+        return entry[1] or not verified
+
+    def localpkgs(self):
+        """ Return what we synced before, like localpkgs() does. """
+        cache = {}
+        for path in self.pkgs:
+            fn = os.path.join(self.directory, path)
+            cache[os.path.basename(path)] = {'path' : fn}
+        return cache
+
+    def remove(self, localpath):
+        path = self._path(os.path.relpath(localpath, self.directory))
+        if path in self.pkgs:
+            del self.pkgs[path]
+            self.db.execute("DELETE FROM packages WHERE path = ?", (path,))
+
+    def add(self, pkg, verified=False):
+        """ Record the downloaded pkg, if it's (still) there. """
+        try:
+            st = os.stat(pkg.localpath)
+        except OSError:
+            self.remove(pkg.localpath)
+            return
+        path = self._path(pkg.remote_path)
+        self.pkgs[path] = (pkg.pkgId, verified)
+        self.db.execute("INSERT OR REPLACE INTO packages VALUES "
+                        "(?, ?, ?, ?, ?)", (path, pkg.pkgId, st.st_size,
+                                            int(st.st_mtime), int(verified)))
+
+    def update(self, pkgs, probs, verified=False):
+        """ Record the pkgs, after downloading them (with probs). """
+        for pkg in pkgs:
+            if pkg in probs:
+                self.remove(pkg.localpath)
+            else:
+                self.add(pkg, verified)
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
 
 def localpkgs(directory):
     names = os.listdir(directory)
@@ -74,6 +832,19 @@ def localpkgs(directory):
             cache[name] = {'path': fn, 'size': st.st_size, 'device': st.st_dev}
     return cache
 
+def delete_pkgs(my, current_pkgs, names, state=None, quiet=False):
+    """ Remove the names (from current_pkgs) from the repo dir, for --delete. """
+    for pkg in names:
+        if not quiet:
+            my.logger.info("Removing obsolete %s", pkg)
+        try:
+            os.unlink(current_pkgs[pkg]['path'])
+        except OSError, e:
+            if state is None or e.errno != errno.ENOENT:
+                raise
+        if state is not None:
+            state.remove(current_pkgs[pkg]['path'])
+
 def is_subpath(path, root):
     root = os.path.realpath(root)
     path = os.path.realpath(os.path.join(root, path))
@@ -126,6 +897,19 @@ def parseArgs():
         action="store_true",
         help=_("Allow packages stored outside their repo directory to be synced "
                "(UNSAFE, USE WITH CAUTION!)"))
+    parser.add_option("--incremental", default=False, action="store_true",
+        help=_("keep a database of the synced packages in each repo dir, and skip the ones which haven't changed since the last sync without looking at the local files"))
+    parser.add_option("--dedup", default=False, action="store_true",
+        help=_("hardlink (or reflink) packages which have been synced before, from any repo, instead of downloading them again"))
+    parser.add_option("--use-deltas", default=False, action="store_true",
+        help=_("rebuild the packages which have an older version in the download path from the deltarpms of the repo, instead of downloading them"))
+    parser.add_option("--delta-workers", default=0, type="int",
+        help=_("with --use-deltas, rebuild this many packages at once (default: the number of CPUs)"))
+    parser.add_option("--max-connections", default=1, type="int",
+        help=_("download this many packages at once, from all the repos (default: 1, one repo after another)"))
+    parser.add_option("--max-host-connections", default=2, type="int",
+        help=_("with --max-connections, download at most this many packages at once from the same host, that of the first baseurl of each repo, which doesn't apply to mirrorlists (default: 2)"))
+    add_profile_option(parser)
     (opts, args) = parser.parse_args()
     return (opts, args)
 
@@ -144,6 +928,8 @@ def main():
         print >> sys.stderr, _("Error: Cannot write to  destination dir %s") % opts.destdir
         sys.exit(1)
 
+    profiler = get_profiler(opts.profile)
+    profiler.phase('config')
     my = RepoSync(opts=opts)
     my.doConfigSetup(fn=opts.config, init_plugins=opts.plugins)
 
@@ -168,6 +954,7 @@ def main():
             print >> sys.stderr, _("Error: %s") % e
             sys.exit(50)
 
+    profiler.phase('repo setup')
     #  Use progress bar display when downloading repo metadata
     # and package files ... needs to be setup before .repos (ie. RHN/etc.).
     if not opts.quiet:
@@ -206,6 +993,7 @@ def main():
         print >> sys.stderr, _("Error: Can't use --norepopath with multiple repositories")
         sys.exit(1)
 
+    profiler.phase('sack setup')
     try:
         arches = rpmUtils.arch.getArchList(opts.arch)
         if opts.source:
@@ -217,7 +1005,23 @@ def main():
         sys.exit(1)
 
     exit_code = 0
+    scheduler = None
+    if opts.max_connections > 1 and not opts.urls:
+        scheduler = DownloadScheduler(my, opts.max_connections,
+                                      opts.max_host_connections, opts.quiet)
+    scheduled = []
+    store = None
+    if opts.dedup and not opts.urls:
+        store = DedupStore(opts.destdir)
+    deltas = None
+    if opts.use_deltas and not opts.urls:
+        if os.path.exists(APPLYDELTA):
+            deltas = DeltaRebuilder(my, opts.delta_workers, opts.quiet)
+        else:
+            my.logger.warning(_('Warning: %s is not installed, downloading '
+                                'the whole packages') % APPLYDELTA)
     for repo in my.repos.listEnabled():
+        profiler.phase('compare')
         reposack = ListPackageSack(my.pkgSack.returnPackages(repoid=repo.id))
 
         if opts.newest:
@@ -254,21 +1058,39 @@ def main():
                 )
             download_list = newlist
 
-        if opts.delete and os.path.exists(local_repo_path):
-            current_pkgs = localpkgs(local_repo_path)
+        state = None
+        if opts.incremental and (not opts.urls or os.path.exists(
+                os.path.join(local_repo_path, PkgState.filename))):
+            if not os.path.exists(local_repo_path):
+                os.makedirs(local_repo_path)
+            state = PkgState(local_repo_path)
 
+        current_pkgs = {}
+        obsolete = []
+        if ((opts.delete or deltas is not None) and
+            os.path.exists(local_repo_path)):
+            if state is not None and not state.new:
+                #  Just what we synced before, instead of looking at all the
+                # files in the tree.
+                current_pkgs = state.localpkgs()
+            else:
+                current_pkgs = localpkgs(local_repo_path)
+
+        if opts.delete:
             download_set = {}
             for pkg in download_list:
                 rpmname = os.path.basename(pkg.remote_path)
                 download_set[rpmname] = 1
 
             for pkg in current_pkgs:
-                if pkg in download_set:
-                    continue
+                if pkg not in download_set:
+                    obsolete.append(pkg)
 
-                if not opts.quiet:
-                    my.logger.info("Removing obsolete %s", pkg)
-                os.unlink(current_pkgs[pkg]['path'])
+            #  With --use-deltas the old versions are needed to rebuild the
+            # new ones, they go after that.
+            if deltas is None:
+                delete_pkgs(my, current_pkgs, obsolete, state, opts.quiet)
+                obsolete = []
 
         if opts.downloadcomps or opts.downloadmd:
 
@@ -303,24 +1125,30 @@ def main():
                     if not opts.quiet:
                         my.logger.error("Unable to fetch metadata: %s" % e)
 
-        remote_size = 0
-        if not opts.urls:
-            for pkg in download_list:
-                local = os.path.join(local_repo_path, pkg.remote_path)
-                sz = int(pkg.returnSimple('packagesize'))
-                if os.path.exists(local) and os.path.getsize(local) == sz:
-                    continue
-                remote_size += sz
-
-        if hasattr(urlgrabber.progress, 'text_meter_total_size'):
-            urlgrabber.progress.text_meter_total_size(remote_size)
+        if state is not None:
+            num = len(download_list)
+            download_list = [pkg for pkg in download_list
+                             if not state.unchanged(pkg, opts.gpgcheck)]
+            if not opts.quiet:
+                my.logger.info(_('%s: %d of %d packages changed since the '
+                                 'last sync') % (repo.id, len(download_list),
+                                                 num))
 
         download_list.sort(key=lambda pkg: pkg.name)
         if opts.urls:
+            local_list = []
             for pkg in download_list:
                 local = os.path.join(local_repo_path, pkg.remote_path)
-                if not (os.path.exists(local) and my.verifyPkg(local, pkg, False)):
+                if os.path.exists(local):
+                    local_list.append((local, pkg))
+            good = verify_local_pkgs(my, local_list)
+            have = set([pkg for ((local, pkg), ok) in zip(local_list, good)
+                        if ok])
+            for pkg in download_list:
+                if pkg not in have:
                     print urljoin(pkg.repo.urls[0], pkg.remote_path)
+            if state is not None:
+                state.close()
             continue
 
         # create dest dir
@@ -335,31 +1163,135 @@ def main():
             localdir = os.path.dirname(pkg.localpath)
             if not os.path.exists(localdir):
                 os.makedirs(localdir)
+            unshare_local(pkg)
+
+        fetch_list = download_list
+        if store is not None:
+            fetch_list = store.link(download_list)
+
+        if deltas is not None:
+            profiler.phase('deltas')
+            fetch_list = deltas.rebuild(repo, fetch_list, current_pkgs)
+        if obsolete:
+            delete_pkgs(my, current_pkgs, obsolete, state, opts.quiet)
+
+        if scheduler is not None:
+            # download with all the other repos, below
+            scheduler.addRepo(repo, fetch_list)
+            scheduled.append((repo, download_list, state))
+            continue
+
+        remote_size = 0
+        for pkg in fetch_list:
+            sz = int(pkg.returnSimple('packagesize'))
+            if (os.path.exists(pkg.localpath) and
+                os.path.getsize(pkg.localpath) == sz):
+                continue
+            remote_size += sz
+
+        if hasattr(urlgrabber.progress, 'text_meter_total_size'):
+            urlgrabber.progress.text_meter_total_size(remote_size)
+
+        #  The signatures are checked as each package lands, while the rest
+        # download.
+        verifier = None
+        if opts.gpgcheck:
+            verifier = PkgVerifier(my, download_list)
+            my.downloaded = verifier.check
 
         # use downloader from YumBase
-        probs = my.downloadPkgs(download_list)
+        profiler.phase('download')
+        try:
+            probs = my.downloadPkgs(fetch_list)
+            if store is not None:
+                store.add(download_list, probs)
+                left = store.linkDeferred()
+                if left:
+                    probs.update(my.downloadPkgs(left))
+        finally:
+            my.downloaded = None
         if probs:
             exit_code = 1
             for key in probs:
                 for error in probs[key]:
                     my.logger.error('%s: %s', key, error)
 
+        if verifier is not None:
+            profiler.phase('gpgcheck')
+            removed = verifier.finish(probs)
+            if removed:
+                exit_code = 1
+                if store is not None:
+                    store.discard(removed)
+
+        if state is not None:
+            state.update(download_list, probs, opts.gpgcheck)
+            state.close()
+
+    if scheduler is not None:
+        profiler.phase('download')
+        verifier = None
+        downloaded = None
         if opts.gpgcheck:
-            for pkg in download_list:
-                result, error = my.sigCheckPkg(pkg)
-                if result != 0:
-                    rpmfn = os.path.basename(pkg.remote_path)
-                    if result == 1:
-                        my.logger.warning('Removing %s, due to missing GPG key.' % rpmfn)
-                    elif result == 2:
-                        my.logger.warning('Removing %s due to failed signature check.' % rpmfn)
-                    else:
-                        my.logger.warning('Removing %s due to failed signature check: %s' % (rpmfn, error))
-                    os.unlink(pkg.localpath)
-                    exit_code = 1
-                    continue
+            all_pkgs = []
+            for (repo, download_list, state) in scheduled:
+                all_pkgs.extend(download_list)
+            verifier = PkgVerifier(my, all_pkgs)
+            downloaded = verifier.check
+            #  What's linked or rebuilt already can go now.
+            fetching = set(scheduler.pkgs)
+            for pkg in all_pkgs:
+                if pkg not in fetching and os.path.exists(pkg.localpath):
+                    verifier.check(pkg)
+        failed = scheduler.run(downloaded)
+        if store is not None:
+            for (repo, download_list, state) in scheduled:
+                store.add(download_list, failed.get(repo.id, {}))
+            left = store.linkDeferred()
+            if left:
+                for (pkg, errors) in my.downloadPkgs(left).iteritems():
+                    if pkg.repoid not in failed:
+                        failed[pkg.repoid] = {}
+                    failed[pkg.repoid][pkg] = errors
+                    for error in errors:
+                        my.logger.error('%s: %s', pkg, error)
+        for (repo, download_list, state) in scheduled:
+            if repo.id in failed:
+                exit_code = 1
+                my.logger.error(_('%s: %d of %d packages failed to download')
+                                % (repo.id, len(failed[repo.id]),
+                                   len(download_list)))
+        removed = []
+        if verifier is not None:
+            profiler.phase('gpgcheck')
+            skip = set()
+            for pkgs in failed.values():
+                skip.update(pkgs)
+            removed = verifier.finish(skip)
+            if removed:
+                exit_code = 1
+                if store is not None:
+                    store.discard(removed)
+        for (repo, download_list, state) in scheduled:
+            if state is not None:
+                state.update(download_list, failed.get(repo.id, {}),
+                             opts.gpgcheck)
+                state.close()
+
+    if store is not None:
+        if opts.delete:
+            store.prune()
+        if not opts.quiet:
+            my.logger.info(_('Linked %d packages instead of downloading them, '
+                             'saving %s') % (store.linked,
+                                             format_number(store.saved)))
+
+    if deltas is not None and not opts.quiet:
+        my.logger.info(_('Rebuilt %d packages from deltas, saving %s') %
+                       (deltas.rebuilt, format_number(deltas.saved)))
 
     my.closeRpmDB()
+    profiler.done()
     sys.exit(exit_code)
 
 if __name__ == "__main__":
@@ -37,6 +37,7 @@ from yum.misc import getCacheDir
 from yum.constants import *
 from yum.packages import parsePackages
 from yum.packageSack import ListPackageSack
+from yumutils.profiling import add_profile_option, get_profiler
 
 class RepoTrack(yum.YumBase):
     def __init__(self, opts):
@@ -101,6 +102,7 @@ def parseArgs():
         help="Toggle downloading only the newest packages(defaults to newest-only)")
     parser.add_option("-q", "--quiet", default=False, action="store_true", 
         help="Output as little as possible")
+    add_profile_option(parser)
                           
     (opts, args) = parser.parse_args()
     return (opts, args)
@@ -127,6 +129,8 @@ def main():
         print >> sys.stderr, "Error: Cannot write to  destination dir %s" % opts.destdir
         sys.exit(1)
         
+    profiler = get_profiler(opts.profile)
+    profiler.phase('config')
     my = RepoTrack(opts=opts)
     my.doConfigSetup(fn=opts.config,init_plugins=False) # init yum, without plugins
     
@@ -136,6 +140,7 @@ def main():
     else:
         archlist = rpmUtils.arch.getArchList()
 
+    profiler.phase('repo setup')
     if opts.repofrompath:
         for repo in opts.repofrompath:
             tmp = tuple(repo.split(','))
@@ -186,6 +191,7 @@ def main():
                 my.logger.error(e)
                 sys.exit(1)
 
+    profiler.phase('sack setup')
     try:
         my.doRepoSetup()
         my._getSacks(archlist=archlist)
@@ -197,6 +203,7 @@ def main():
     final_pkgs = {}
     pkg_list = []
     
+    profiler.phase('dependencies')
     avail = my.pkgSack.returnPackages()
     for item in user_pkg_list:
         exactmatch, matched, unmatched = parsePackages(avail, [item])
@@ -248,6 +255,7 @@ def main():
         download_list = this_sack.returnNewestByNameArch()
         
     download_list.sort(key=lambda pkg: pkg.name)
+    profiler.phase('download')
     for pkg in download_list:
         repo = my.repos.getRepo(pkg.repoid)
         remote = pkg.returnSimple('relativepath')
@@ -274,6 +282,7 @@ def main():
 
         if not os.path.exists(local) or not os.path.samefile(path, local):
             shutil.copy2(path, local)
+    profiler.done()
 
 if __name__ == "__main__":
     main()
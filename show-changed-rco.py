@@ -23,6 +23,8 @@ import os
 from optparse import OptionParser
 from optparse import SUPPRESS_HELP
 
+from yumutils.profiling import add_profile_option, get_profiler
+
 version = "1.0.0"
 
 
@@ -185,15 +187,18 @@ def main():
                       help="run from cache only")
     parser.add_option("-c", "--config", dest="conffile", default=None,
                       help="config file location")
+    add_profile_option(parser)
 
     (opts, args) = parser.parse_args()
 
-
+    profiler = get_profiler(opts.profile)
+    profiler.phase('config')
     yb = yum.YumBase()
     yb.preconf.releasever = opts.releasever
     if opts.conffile is not None:
         yb.preconf.fn = opts.conffile
 
+    profiler.phase('repo setup')
     # setup the fake repos
     for repo in opts.repofrompath or []:
         tmp = tuple(repo.split(','))
@@ -238,12 +243,15 @@ def main():
             for repo in yb.repos.findRepos(repo_match):
                 repo.enable()
 
+    #  The sacks are setup as the packages are looked up.
+    profiler.phase('packages')
     npkgs = _get_npkgs(yb, args)
     opkgs = {}
     for pkg in sorted(_get_opkgs(yb, npkgs, opts.old_packages)):
         opkgs[(pkg.name, pkg.arch)] = pkg
         opkgs[pkg.name] = pkg
 
+    profiler.phase('compare')
     for pkg in sorted(npkgs):
         opkg = None
         oreqs = {}
@@ -302,6 +310,7 @@ def main():
         _print_sum("Dep-Repos:",
                    used_repos_reqs + used_repos_cons + used_repos_obss,
                    end='')
+    profiler.done()
 
 
 if __name__ == "__main__":
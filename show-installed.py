@@ -8,6 +8,7 @@ TODO:
 import yum
 from optparse import OptionParser
 import sys
+from yumutils.profiling import add_profile_option, get_profiler
 
 __stateprefixes = {
     None : '# ',
@@ -374,8 +375,10 @@ def __main__():
     parser.add_option("-a", "--allow-all", dest="allowed", action='append_const', const='all', help='Check if installing all packages in the groups gives better results. Uses "*" to mark those groups.')
     parser.add_option("--ignore-missing", dest="ignore_missing", action="store_true", help="Ignore packages missing in the repos.")
     parser.add_option("--ignore-missing-excludes", dest="ignore_missing_excludes", action="store_true", help="Do not produce exclude lines for packages not in the repository.")
+    add_profile_option(parser)
 
     (options, args) = parser.parse_args()
+    profiler = get_profiler(options.profile)
 
     if options.format != "human" and len(options.allowed)>1:
         print '-m, --allow-mandatories, -a, --allow-all are only allowed in "human" (readable) format as yum and anaconda do not support installing all or only mandatory packages per group. Sorry.'
@@ -397,13 +400,19 @@ def __main__():
     else:
         output = sys.stdout
 
+    #  The config., repos., sacks and comps are all setup as the package
+    # list is built.
+    profiler.phase('packages')
     i = InstalledPackages(input=input_, ignore_missing=options.ignore_missing)
+    profiler.phase('groups')
     i.autodetectStates(options.excludes, options.allowed)
 
+    profiler.phase('output')
     p = ListPrinter(i, options, output=output)
     if not options.quiet:
         p.writeWarnings()
     p.writeList()
+    profiler.done()
 
 if __name__ == "__main__":
     __main__()
@@ -0,0 +1,71 @@
+#!/usr/bin/python -tt
+#
+# Time the repoclosure --newest filter (the newest packages by name and arch,
+# without the ones they obsolete), with a ListPackageSack and an
+# rpmUtils.updates.Updates checking each package (as it was) and with the
+# obsoletes index. Uses the enabled repos (from cache), or just the given
+# repoids, best with a lot of obsoletes (Eg. a Fedora release + updates). Run
+# from the top of the source tree:
+#
+#   python test/bench-repoclosure-newest.py [repoid ...]
+
+import sys
+import time
+import imp
+
+import rpmUtils.updates
+from yum.packageSack import ListPackageSack
+
+repoclosure = imp.load_source('repoclosure', 'repoclosure.py')
+
+def old_newest(my):
+    pkgs = my.pkgSack.returnNewestByNameArch()
+    mypkgSack = ListPackageSack(pkgs)
+    pkgtuplist = mypkgSack.simplePkgList()
+
+    up = rpmUtils.updates.Updates([], pkgtuplist)
+    up.rawobsoletes = mypkgSack.returnObsoletes()
+    obsoleted = set()
+    for pkg in pkgs:
+        if up.checkForObsolete([pkg.pkgtup]):
+            my.pkgSack.delPackage(pkg)
+            obsoleted.add(pkg)
+
+    # we've deleted items so remake the pkgs
+    my.pkgSack.returnNewestByNameArch()
+    return [pkg for pkg in pkgs if pkg not in obsoleted]
+
+def main(args):
+    my = repoclosure.RepoClosure()
+    my.conf.cache = True
+    if len(args) > 1:
+        for repo in my.repos.repos.values():
+            if repo.id in args[1:]:
+                repo.enable()
+            else:
+                repo.disable()
+    my.readMetadata()
+    # Don't time the sack setup
+    num = len(my.pkgSack)
+
+    #  The old way deletes the obsoleted packages from the pkgSack, so it has
+    # to go last.
+    start = time.time()
+    new = my.returnNewest()
+    new_time = time.time() - start
+
+    start = time.time()
+    old = old_newest(my)
+    old_time = time.time() - start
+
+    if set([pkg.pkgtup for pkg in old]) != set([pkg.pkgtup for pkg in new]):
+        print "Newest packages differ between Updates and the index!"
+        sys.exit(1)
+
+    print "packages: %d, newest and not obsoleted: %d" % (num, len(new))
+    print "ListPackageSack + Updates: %.3fs" % old_time
+    print "obsoletes index:           %.3fs (%.1fx)" % (new_time,
+                                                       old_time / new_time)
+
+if __name__ == "__main__":
+    main(sys.argv)
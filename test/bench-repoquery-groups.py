@@ -0,0 +1,96 @@
+#!/usr/bin/python -tt
+#
+# Time repoquery --groupmember for every package in a comps file, and
+# matching @group patterns, scanning all the groups per package (as it was)
+# and with the group member index. Run from the top of the source tree with
+# a full comps file (Eg. Fedora's comps-f*.xml):
+#
+#   python test/bench-repoquery-groups.py comps.xml ['group pattern' ...]
+
+import sys
+import time
+import fnmatch
+import imp
+
+import yum.comps
+
+repoquery = imp.load_source('repoquery', 'repoquery.py')
+
+class benchQuery(repoquery.YumBaseQuery):
+    """ Query with the given comps, instead of loading them from repos. """
+    comps = property(lambda self: self._bench_comps)
+
+def old_find_groupmember(comps, name):
+    grps = []
+    for group in comps.get_groups():
+        if name in group.packages:
+            grps.append(group.groupid)
+    return grps
+
+def old_matchGroups(comps, items):
+    grps = []
+    for grp in comps.get_groups():
+        for expr in items:
+            if grp.name == expr or fnmatch.fnmatch("%s" % grp.name, expr):
+                grps.append(grp.groupid)
+            elif grp.groupid == expr or fnmatch.fnmatch(grp.groupid, expr):
+                grps.append(grp.groupid)
+    return grps
+
+def main(args):
+    if len(args) < 2:
+        print "Usage: %s comps.xml ['group pattern' ...]" % args[0]
+        sys.exit(1)
+    patterns = args[2:] or ['*desktop*', 'base', 'core', '*-tools',
+                            'Development*']
+
+    comps = yum.comps.Comps()
+    comps.add(args[1])
+    names = set()
+    for group in comps.get_groups():
+        names.update(group.packages)
+    names = sorted(names)
+
+    parser = repoquery.make_parser()
+    (opts, regexs) = parser.parse_args(['--groupmember'])
+    (pkgops, sackops,
+     needother, needgroup, needsource) = repoquery.query_ops(opts)
+    repoq = benchQuery(pkgops, sackops, opts)
+    repoq._bench_comps = comps
+
+    start = time.time()
+    old = [sorted(old_find_groupmember(comps, name)) for name in names]
+    old_time = time.time() - start
+
+    start = time.time()
+    new = [sorted(repoq.find_groupmember(name)) for name in names]
+    new_time = time.time() - start
+
+    if old != new:
+        print "Group members differ between the scan and the index!"
+        sys.exit(1)
+
+    start = time.time()
+    old_grps = [sorted(set(old_matchGroups(comps, [pat])))
+                for pat in patterns for name in names[:100]]
+    old_match_time = time.time() - start
+
+    start = time.time()
+    new_grps = [sorted([grp.id for grp in repoq.matchGroups([pat])])
+                for pat in patterns for name in names[:100]]
+    new_match_time = time.time() - start
+
+    if old_grps != new_grps:
+        print "Matched groups differ between fnmatch and the compiled globs!"
+        sys.exit(1)
+
+    print "groups: %d, packages: %d" % (len(comps.get_groups()), len(names))
+    print "groupmember scan:  %.3fs" % old_time
+    print "groupmember index: %.3fs (%.1fx)" % (new_time, old_time / new_time)
+    print "matchGroups x%d, fnmatch:        %.3fs" % (len(old_grps),
+                                                      old_match_time)
+    print "matchGroups x%d, compiled globs: %.3fs (%.1fx)" % \
+          (len(new_grps), new_match_time, old_match_time / new_match_time)
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,93 @@
+#!/usr/bin/python -tt
+#
+# Compare the old per-tag __getitem__ queryformat renderer with the compiled
+# one, over a large synthetic sack. Run from the top of the source tree:
+#
+#   python test/bench-repoquery-qf.py [num packages]
+
+import sys
+import time
+import imp
+
+repoquery = imp.load_source('repoquery', 'repoquery.py')
+
+QF = '%{name} %{epoch} %{version} %{release} %{arch} %{size} ' \
+     '%{buildtime:day} %{sourcerpm} %{nevra} %{repoid}'
+
+class FakeRepo:
+    id = 'bench'
+    urls = ['http://example.com/bench/']
+
+class FakePackage:
+    """ Just enough of a YumAvailablePackage to render QF. """
+    def __init__(self, num):
+        self.name = 'pkg%d' % num
+        self.epoch = '0'
+        self.version = '1.%d' % (num % 100)
+        self.release = '%d.fc15' % (num % 7)
+        self.arch = ('x86_64', 'i686', 'noarch')[num % 3]
+        self.repo = FakeRepo()
+        self.repoid = self.repo.id
+        self.size = 1024 * num
+        self.sourcerpm = '%s-%s-%s.src.rpm' % (self.name, self.version,
+                                               self.release)
+        self._simple = {'buildtime' : 1300000000 + num}
+
+    def returnSimple(self, item):
+        return self._simple[item]
+
+class oldRepoPkgQuery(repoquery.repoPkgQuery):
+    """ The renderer as it was, everything going through __getitem__. """
+
+    def __getitem__(self, item):
+        item = item.lower()
+        if hasattr(self, "fmt_%s" % item):
+            return getattr(self, "fmt_%s" % item)()
+        elif item.startswith('repo.'):
+            return getattr(self.pkg.repo, item.split('.')[1])
+        elif hasattr(self.pkg, item):
+            return getattr(self.pkg, item)
+
+        convert = None
+        tmp = item.split(':')
+        if len(tmp) > 1:
+            item = tmp[0]
+            convert = repoquery.convertmap[tmp[1]]
+        res = self.pkg.returnSimple(item)
+        if convert:
+            res = convert(res)
+        return res
+
+    def _render(self, fmt):
+        return fmt % self
+
+def bench(qclass, pkgs):
+    qpkg = None
+    out = []
+    start = time.time()
+    for pkg in pkgs:
+        if qpkg is None:
+            qpkg = qclass(pkg, QF)
+        qpkg.pkg = pkg
+        qpkg.name = pkg.name
+        out.append(qpkg.fmt_queryformat())
+    return time.time() - start, out
+
+def main(args):
+    num = 60000
+    if len(args) > 1:
+        num = int(args[1])
+    pkgs = [FakePackage(i) for i in range(num)]
+
+    old_time, old_out = bench(oldRepoPkgQuery, pkgs)
+    new_time, new_out = bench(repoquery.repoPkgQuery, pkgs)
+    if old_out != new_out:
+        print "Output differs between the old and new renderers!"
+        sys.exit(1)
+
+    print "packages: %d, queryformat: %s" % (num, QF)
+    print "old renderer:      %.3fs" % old_time
+    print "compiled renderer: %.3fs (%.1fx)" % (new_time, old_time / new_time)
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,66 @@
+#!/usr/bin/python -tt
+#
+# Time repoquery --search over name, summary, description and url, with
+# yum's searchGenerator and with the --search-index. Uses the enabled repos
+# (from cache), run from the top of the source tree:
+#
+#   python test/bench-repoquery-search.py [words] [repoquery opts]
+
+import sys
+import time
+import imp
+
+repoquery = imp.load_source('repoquery', 'repoquery.py')
+
+FIELDS = ['name', 'summary', 'description', 'url']
+
+def main(args):
+    words = 'python library'
+    if len(args) > 1:
+        words = args[1]
+
+    parser = repoquery.make_parser()
+    fopts = []
+    for field in FIELDS:
+        fopts.extend(['--search-fields', field])
+    (opts, terms) = parser.parse_args(['--search-index'] + fopts +
+                                      args[2:] + words.split())
+    (pkgops, sackops,
+     needother, needgroup, needsource) = repoquery.query_ops(opts)
+    repoq = repoquery.YumBaseQuery(pkgops, sackops, opts)
+    repoq.preconf.debuglevel = 0
+    repoq.conf.cache = True
+    repoq.setCacheDir()
+    if not hasattr(repoq, 'arch'):
+        repoq.doSackSetup()
+    # Don't time the sack setup
+    repoq.pkgSack
+
+    start = time.time()
+    old = set([qpkg.pkg.pkgtup for qpkg in repoq.yum_search(terms)])
+    old_time = time.time() - start
+
+    # The first search loads (or builds) the index
+    start = time.time()
+    repoq.index_search(terms)
+    load_time = time.time() - start
+
+    start = time.time()
+    new = [qpkg.pkg.pkgtup for qpkg in repoq.index_search(terms)]
+    new_time = time.time() - start
+
+    #  searchGenerator matches any term as a substring, the index needs
+    # every word, so it has to find a subset.
+    if not set(new) <= old:
+        print "Index found packages the search didn't: %s" % \
+              sorted(set(new) - old)
+        sys.exit(1)
+
+    print "%s: %d packages with any term, %d with all the words" % \
+          (words, len(old), len(new))
+    print "searchGenerator:    %.3fs" % old_time
+    print "search index load:  %.3fs" % load_time
+    print "search index:       %.3fs (%.1fx)" % (new_time, old_time / new_time)
+
+if __name__ == "__main__":
+    main(sys.argv)
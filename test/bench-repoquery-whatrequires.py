@@ -0,0 +1,79 @@
+#!/usr/bin/python -tt
+#
+# Time repoquery --whatrequires --recursive --alldeps for a capability with a
+# big reverse closure, using the old per-provide sack searches and the
+# requires index. Uses the enabled repos (from cache), run from the top of
+# the source tree:
+#
+#   python test/bench-repoquery-whatrequires.py [capability] [repoquery opts]
+
+import sys
+import time
+import imp
+
+repoquery = imp.load_source('repoquery', 'repoquery.py')
+
+def old_whatrequires(repoq, name):
+    """ fmt_whatrequires as it was, recursing with a search per provide. """
+    pkgs = {}
+    done = set()
+
+    def require_recursive(name):
+        if name in done:
+            return
+        done.add(name)
+
+        provs = [name]
+        for pkg in repoq.returnByName(name):
+            provs.extend(pkg.prco("provides"))
+            provs.extend(pkg.files())
+
+        for prov in provs:
+            for sackstr in repoq._sacks:
+                sack = getattr(repoq, sackstr)
+                for pkg in sack.searchRequires(prov):
+                    pkgs[pkg.pkgtup] = pkg
+                    require_recursive(pkg.name)
+
+    require_recursive(name)
+    return sorted(pkgs.values())
+
+def main(args):
+    name = 'glibc'
+    if len(args) > 1:
+        name = args[1]
+
+    parser = repoquery.make_parser()
+    (opts, regexs) = parser.parse_args(['--whatrequires', '--recursive',
+                                        '--alldeps'] + args[2:] + [name])
+    (pkgops, sackops,
+     needother, needgroup, needsource) = repoquery.query_ops(opts)
+    repoq = repoquery.YumBaseQuery(pkgops, sackops, opts)
+    repoq.preconf.debuglevel = 0
+    repoq.conf.cache = True
+    repoq.setCacheDir()
+    if not hasattr(repoq, 'arch'):
+        repoq.doSackSetup()
+    # Don't time the sack setup
+    repoq.pkgSack
+
+    # This recurses once per package in the closure
+    sys.setrecursionlimit(100000)
+    start = time.time()
+    old = [pkg.pkgtup for pkg in old_whatrequires(repoq, name)]
+    old_time = time.time() - start
+
+    start = time.time()
+    new = [qpkg.pkg.pkgtup for qpkg in repoq.fmt_whatrequires(name)]
+    new_time = time.time() - start
+
+    if sorted(old) != sorted(new):
+        print "Results differ: %d old, %d new" % (len(old), len(new))
+        sys.exit(1)
+
+    print "%s: %d packages in the reverse closure" % (name, len(new))
+    print "sack searches:  %.3fs" % old_time
+    print "requires index: %.3fs (%.1fx)" % (new_time, old_time / new_time)
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -22,6 +22,7 @@ import urlparse
 from yum import Errors
 from optparse import OptionParser
 import ConfigParser
+from yumutils.profiling import add_profile_option, get_profiler
 
 # Subclass ConfigParser so that the options don't get lowercased.  This is
 # important given that they are path names.
@@ -153,7 +154,15 @@ def main():
             help="Report results to the given testopia run number")
     parser.add_option("-r","--treeinfo", action="store_true", default=False,
             help="check the checksums of listed files in a .treeinfo file, if available")
+    add_profile_option(parser)
     opts, args = parser.parse_args()
+    profiler = get_profiler(opts.profile)
+    try:
+        return verifytree(opts, args, profiler)
+    finally:
+        profiler.done()
+
+def verifytree(opts, args, profiler):
     if not args: 
         print "Must provide a file url to the repo"
         sys.exit(1)
@@ -177,6 +186,7 @@ def main():
 
     basedir = url.replace('file://', '') # for a normal path thing
 
+    profiler.phase('config')
     my = yum.YumBase()
     if opts.noplugins:
         my.preconf.init_plugins = False
@@ -192,6 +202,7 @@ def main():
     # we want *all* metadata
     newrepo.mdpolicy = 'group:all'
 
+    profiler.phase('repo setup')
     # add our new repo
     my.repos.add(newrepo)
     # enable that repo
@@ -209,6 +220,7 @@ def main():
 
 
     # Check the metadata
+    profiler.phase('repodata')
     print "Checking repodata:"
     try:
         md_types = newrepo.repoXML.fileTypes()
@@ -233,6 +245,7 @@ def main():
         report('REPODATA','PASSED')
 
     if not opts.nocomps:
+        profiler.phase('comps')
         print "Checking groups (comps.xml):"
         try:
             print "  verifying comps.xml with yum"
@@ -266,10 +279,12 @@ def main():
     # if we've got a .treeinfo file and we are told to check it, then do so
     tr_path = basedir + '/.treeinfo'
     if opts.treeinfo and os.path.exists(tr_path):
+        profiler.phase('treeinfo')
         print "Checking checksums of files in .treeinfo"
         tr_val = treeinfo_checksum(tr_path)
         retval = tr_val | retval
 
+    profiler.phase('packages')
     sack = []
     packages_ok = True
     if opts.checkall:
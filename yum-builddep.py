@@ -22,6 +22,8 @@ from yum.misc import setup_locale
 from yum.i18n import exception2msg
 import yum.Errors
 from utils import YumUtilBase
+from yumutils.profiling import add_profile_option, get_profiler, snapshot
+from yumutils.profiling import NoProfiler
 
 import logging
 import rpmUtils
@@ -74,15 +76,23 @@ class YumBuildDep(YumUtilBase):
                 metavar="'MACRO EXPR'",
                 help="define the rpm MACRO with value EXPR for spec parsing",
             )
-        self.main()
+        add_profile_option(self.optparser)
+        self.profiler = NoProfiler()
+        try:
+            self.main()
+        finally:
+            self.profiler.done()
 
     def main(self):
         # Parse the commandline option and setup the basics.
+        start = snapshot()
         try:
             opts = self.doUtilConfigSetup()
         except yum.Errors.RepoError, e:
             self.logger.error("Cannot handle specific enablerepo/disablerepo options.")
             sys.exit(50)
+        self.profiler = get_profiler(opts.profile)
+        self.profiler.phase('config', start)
 
         # turn of our local gpg checking for opening the srpm if it is turned
         # off for repos :)
@@ -105,9 +115,11 @@ class YumBuildDep(YumUtilBase):
             self.setupSourceRepos()
 
         # Setup yum (Ts, RPM db, Repo & Sack)
+        self.profiler.phase('yum setup')
         self.doUtilYumSetup()
         # Do the real action
         # solve for each srpm and put the pkgs into a ts
+        self.profiler.phase('depsolve')
         try:
             self.get_build_deps(opts)
         except yum.Errors.MiscError, e:
@@ -130,6 +142,7 @@ class YumBuildDep(YumUtilBase):
             print 'No uninstalled build requires'
             sys.exit()
             
+        self.profiler.phase('transaction')
         sys.exit(self.doUtilTransaction())
         
     def setupSourceRepos(self):
@@ -16,6 +16,7 @@ import yum.config
 import yum.yumRepo
 
 from yum.parser import varReplace
+from yumutils.profiling import add_profile_option, get_profiler, snapshot
 
 # Regular expressions to sanitise cache filenames
 re_url_scheme    = re.compile(r'^\w+:/*(\w+:|www\.)?')
@@ -130,12 +131,16 @@ group.add_option("--disable", default=False, action="store_true",
           help='disable the specified repos (automatically saves)')
 group.add_option("--add-repo", default=[], dest='addrepo', action='append',
           help='add (and enable) the repo from the specified file or url')
+add_profile_option(group)
+start = snapshot()
 try:
     opts = yb.doUtilConfigSetup()
     yb.repos
 except yum.Errors.YumBaseError, e:
     logger.error(str(e))
     sys.exit(50)
+profiler = get_profiler(opts.profile)
+profiler.phase('config', start)
 
 if opts.save or opts.enable or opts.disable or opts.addrepo:
     if yb.conf.uid != 0:
@@ -156,6 +161,7 @@ if opts.disable and not args:
 
 only = None
 
+profiler.phase('dump')
 if (not args and not opts.addrepo) or 'main' in args:
     print yb.fmtSection('main')
     print yb.conf.dump()
@@ -207,6 +213,7 @@ if not opts.addrepo:
                                only)
 
 if opts.addrepo:
+    profiler.phase('add repos')
     # figure out the best reposdir by seeing which dirs exist
     myrepodir = None
     for rdir in yb.conf.reposdir:
@@ -277,5 +284,6 @@ if opts.addrepo:
             else:
                 fo.close()
 
-    if error:
-        sys.exit(1)
+profiler.done()
+if opts.addrepo and error:
+    sys.exit(1)
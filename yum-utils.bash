@@ -65,7 +65,7 @@ _yu_package_cleanup()
     COMPREPLY=( $( compgen -W '$( _yum_baseopts 2>/dev/null ) --problems
         --queryformat --orphans --dupes --cleandupes --noscripts --leaves --all
         --leaf-regex --exclude-devel --exclude-bin --oldkernels --count
-        --keepdevel' -- "$cur" ) )
+        --keepdevel --profile' -- "$cur" ) )
 } &&
 complete -F _yu_package_cleanup -o filenames package-cleanup package-cleanup.py
 
@@ -84,7 +84,8 @@ _yu_verifytree()
     $split && return 0
 
     if [[ $cur == -* ]] ; then
-        COMPREPLY=( $( compgen -W '--help --checkall --testopia --treeinfo' \
+        COMPREPLY=( $( compgen -W '--help --checkall --testopia --treeinfo
+            --profile' \
             -- "$cur" ) )
         return 0
     fi
@@ -117,7 +118,7 @@ _yu_repo_graph()
 
     $split && return 0
 
-    COMPREPLY=( $( compgen -W '--help --repoid -c' -- "$cur" ) )
+    COMPREPLY=( $( compgen -W '--help --repoid -c --profile' -- "$cur" ) )
 } &&
 complete -F _yu_repo_graph -o filenames repo-graph repo-graph.py
 
@@ -142,7 +143,8 @@ _yu_repo_rss()
             ;;
     esac
 
-    COMPREPLY=( $( compgen -W '--help -f -l -t -d -r --tempcache -g -a -c' \
+    COMPREPLY=( $( compgen -W '--help -f -l -t -d -r --tempcache -g -a -c
+        --profile' \
         -- "$2" ) )
     [[ $2 == -* ]] || _yum_helper repolist all "$2" 2>/dev/null || return 0
 } &&
@@ -155,7 +157,7 @@ _yu_repoclosure()
     _yu_init_completion "$2" "$3"
 
     case $prev in
-        -h|--help|-a|--arch|--basearch|--repofrompath)
+        -h|--help|-a|--arch|--basearch|--repofrompath|-j|--jobs)
             return 0
             ;;
         -c|--config)
@@ -175,13 +177,28 @@ _yu_repoclosure()
             _yum_helper groups list all "$cur" 2>/dev/null
             return 0
             ;;
+        --state-file)
+            local IFS=$'\n'
+            COMPREPLY=( $( compgen -f -o plusdirs -- "$cur" ) )
+            return 0
+            ;;
+        --baseline)
+            local IFS=$'\n'
+            COMPREPLY=( $( compgen -f -o plusdirs -X '!*.json' -- "$cur" ) )
+            return 0
+            ;;
+        --output)
+            COMPREPLY=( $( compgen -W 'text json' -- "$cur" ) )
+            return 0
+            ;;
     esac
 
     $split && return 0
 
     COMPREPLY=( $( compgen -W '--help --config --arch --basearch --builddeps
         --lookaside --repoid --tempcache --quiet --newest --repofrompath --pkg
-        --group' -- "$cur" ) )
+        --group --jobs --state-file --output --baseline --profile' \
+        -- "$cur" ) )
 } &&
 complete -F _yu_repoclosure -o filenames repoclosure repoclosure.py
 
@@ -198,7 +215,7 @@ _yu_repoquery()
 
     case $prev in
         -h|--help|--version|--qf|--queryformat|--archlist|--repofrompath|\
-        --setopt)
+        --setopt|--batch-delim)
             return 0
             ;;
         -f|--file)
@@ -242,12 +259,17 @@ _yu_repoquery()
             COMPREPLY=( $( compgen -f -o plusdirs -X '!*.conf' -- "$cur" ) )
             return 0
             ;;
+        --serve|--connect|--profile-file)
+            local IFS=$'\n'
+            COMPREPLY=( $( compgen -f -o plusdirs -- "$cur" ) )
+            return 0
+            ;;
         --level)
             COMPREPLY=( $( compgen -W '{1..9} all' -- "$cur" ) )
             return 0
             ;;
         --output)
-            COMPREPLY=( $( compgen -W 'text ascii-tree dot-tree' -- "$cur" ) )
+            COMPREPLY=( $( compgen -W 'text ascii-tree dot-tree jsonl csv' -- "$cur" ) )
             return 0
             ;;
         --search-fields)
@@ -267,12 +289,14 @@ _yu_repoquery()
         COMPREPLY=( $( compgen -W '--version --help --list --info --file
             --queryformat --groupmember --all --requires --provides --obsoletes
             --conflicts --changelog --location --nevra --envra --nvr --source
-            --srpm --resolve --exactdeps --recursive --whatprovides
+            --srpm --resolve --cache-provides --exactdeps --recursive --whatprovides
             --whatrequires --whatobsoletes --whatconflicts --group --grouppkgs
             --archlist --pkgnarrow --installed --show-duplicates --repoid
             --enablerepo --disablerepo --repofrompath --plugins --quiet
             --verbose --cache --tempcache --querytags --config --level --output
-            --search --search-fields --setopt --installroot' -- "$cur" ) )
+            --search --search-fields --search-index --setopt --installroot --batch
+            --batch-delim --serve --connect --profile --profile-file' \
+            -- "$cur" ) )
         return 0
     fi
 
@@ -328,7 +352,7 @@ _yu_repodiff()
     $split && return 0
 
     COMPREPLY=( $( compgen -W '--version --help --new --old --quiet --archlist
-        --compare-arch --size --downgrade --simple' -- "$cur" ) )
+        --compare-arch --size --downgrade --simple --profile' -- "$cur" ) )
 } &&
 complete -F _yu_repodiff repodiff repodiff.py
 
@@ -350,7 +374,8 @@ _yu_builddep()
     $split && return 0
 
     if [[ $cur == -* ]] ; then
-        COMPREPLY=( $( compgen -W '$( _yum_baseopts 2>/dev/null )' -- "$cur" ) )
+        COMPREPLY=( $( compgen -W '$( _yum_baseopts 2>/dev/null )
+            --profile' -- "$cur" ) )
         return 0
     fi
 
@@ -373,7 +398,7 @@ _yu_debuginfo_install()
 
     if [[ $cur == -* ]] ; then
         COMPREPLY=( $( compgen -W '$( _yum_baseopts 2>/dev/null )
-            --no-debuginfo-plugin' -- "$cur" ) )
+            --no-debuginfo-plugin --profile' -- "$cur" ) )
         return 0
     fi
 
@@ -425,7 +450,7 @@ _yu_yumdownloader()
 
     if [[ $cur == -* ]] ; then
         COMPREPLY=( $( compgen -W '$( _yum_baseopts 2>/dev/null ) --destdir
-            --urls --resolve --source --archlist' -- "$cur" ) )
+            --urls --resolve --source --archlist --profile' -- "$cur" ) )
         return 0
     fi
 
@@ -24,6 +24,8 @@ from yum.packages import parsePackages
 from yum.Errors import RepoError
 from yum.i18n import exception2msg
 from utils import YumUtilBase
+from yumutils.profiling import add_profile_option, get_profiler, snapshot
+from yumutils.profiling import NoProfiler
 
 from urlparse import urljoin
 from urlgrabber.progress import TextMeter
@@ -72,24 +74,31 @@ class YumDownloader(YumUtilBase):
         self.logger = logging.getLogger("yum.verbose.cli.yumdownloader")  
         
         self.localPackages = []
+        self.profiler = NoProfiler()
                           
         # Add util commandline options to the yum-cli ones
         self.optparser = self.getOptionParser() 
         try:
-            self.main()
-        except (OSError, IOError), e:
-            self.logger.error(exception2msg(e))
-            sys.exit(1)
+            try:
+                self.main()
+            except (OSError, IOError), e:
+                self.logger.error(exception2msg(e))
+                sys.exit(1)
+        finally:
+            self.profiler.done()
 
     def main(self):
         # Add command line option specific to yumdownloader
         self.addCmdOptions()
         # Parse the commandline option and setup the basics.
+        start = snapshot()
         try:
             opts = self.doUtilConfigSetup()
         except yum.Errors.RepoError, e:
             self.logger.error(exception2msg(e))
             sys.exit(50)
+        self.profiler = get_profiler(opts.profile)
+        self.profiler.phase('config', start)
                 
         # Check if there is anything to do.
         if len(self.cmds) < 1: 
@@ -110,8 +119,10 @@ class YumDownloader(YumUtilBase):
             self.setupSourceRepos()
 
         # Setup yum (Ts, RPM db, Repo & Sack)
+        self.profiler.phase('yum setup')
         self.doUtilYumSetup()
         # Do the real action
+        self.profiler.phase('download')
         self.exit_code = self.downloadPackages(opts)
         
     def setupSourceRepos(self):
@@ -259,6 +270,7 @@ class YumDownloader(YumUtilBase):
           help='operate on source packages')
         group.add_option("--archlist",
           help="only download packages of given and compatible architectures")
+        add_profile_option(group)
 
 if __name__ == '__main__':
     setup_locale()
@@ -0,0 +1,135 @@
+#!/usr/bin/python -tt
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Library General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+
+"""
+The yumutils.metadata python module for getting the metadata of many repos
+at once, used by utils after the repo setup and before they setup their
+package sacks
+"""
+
+import time
+import multiprocessing
+
+from yum import misc
+
+# Max. number of repos we download metadata for at once
+max_workers = 4
+
+#  The workers are forked from us, so they get the repo objects from here
+# instead of having them pickled.
+_prefetch_repos = {}
+
+def _prefetch_repo(repoid, mdtypes):
+    '''
+    Worker: download repomd.xml and the given metadata types for a repo, and
+    uncompress the sqlite ones, so it's all in the repo cachedir for when the
+    sack is populated. Returns (repoid, [(step, seconds)], error).
+    '''
+    repo = _prefetch_repos[repoid]
+    steps = []
+    try:
+        #  The workers would all draw on the same terminal, the progress is
+        # the timing report.
+        repo.setCallback(None)
+        start = time.time()
+        repoXML = repo.repoXML
+        steps.append(('repomd', time.time() - start))
+
+        for mdtype in mdtypes:
+            start = time.time()
+            if mdtype + '_db' in repoXML.fileTypes():
+                mdtype += '_db'
+            elif mdtype not in repoXML.fileTypes():
+                continue
+            fn = repo.retrieveMD(mdtype)
+            if fn and mdtype.endswith('_db'):
+                misc.decompress(fn)
+            steps.append((mdtype, time.time() - start))
+    except KeyboardInterrupt:
+        return (repoid, steps, 'interrupted')
+    except Exception, e:
+        #  Whatever it was, the normal sack setup will hit it again and deal
+        # with it, so just pass it back for the timings.
+        return (repoid, steps, str(e))
+    return (repoid, steps, None)
+
+def prefetch_metadata(repos, mdtypes=('primary',), workers=None, cache=False):
+    '''
+    Get the metadata for the repos into their cachedirs, with a pool of
+    worker processes. The repos have to be setup already (so repo.cache,
+    the mirrors and whatever plugins did in prereposetup are there). The
+    package sacks still have to be populated after this, but that just
+    opens the sqlite files. Nothing is done when running from the cache.
+
+    @type repos: list of YumRepository
+    @type mdtypes: tuple of metadata types, the _db variant is used if it
+        exists
+    @type cache: bool, conf.cache
+    @rtype: tuple of (seconds taken, [(repoid, [(step, seconds)], error)])
+    '''
+    global _prefetch_repos
+
+    if cache:
+        return (0, [])
+    repos = [repo for repo in repos if not repo.cache]
+    if workers is None:
+        workers = max_workers
+    workers = min(workers, len(repos))
+    if workers < 2:
+        return (0, [])
+
+    start = time.time()
+    _prefetch_repos = dict([(repo.id, repo) for repo in repos])
+    pool = multiprocessing.Pool(workers)
+    try:
+        jobs = [pool.apply_async(_prefetch_repo, (repo.id, mdtypes))
+                for repo in repos]
+        pool.close()
+        #  A timeout, so that a ^C isn't ignored while we wait.
+        results = [job.get(86400) for job in jobs]
+    finally:
+        pool.terminate()
+        pool.join()
+        _prefetch_repos = {}
+    return (time.time() - start, results)
+
+def critical_path(results):
+    '''
+    Return the result for the repo which took the longest to get, which is
+    what the other sack setup is waiting on. None if there are no results.
+    '''
+    def _total(result):
+        return sum([secs for step, secs in result[1]])
+    if not results:
+        return None
+    return max(results, key=_total)
+
+def format_timing(taken, results):
+    '''
+    Return the lines for a timing report of prefetch_metadata().
+
+    @rtype: list of str
+    '''
+    if not results:
+        return []
+    ret = ['Metadata for %d repos: %.2fs' % (len(results), taken)]
+    repoid, steps, error = critical_path(results)
+    total = sum([secs for step, secs in steps])
+    parts = ', '.join(['%s %.2fs' % step for step in steps])
+    ret.append('  Critical path: %s %.2fs (%s)' % (repoid, total, parts))
+    for repoid, steps, error in results:
+        if error is not None:
+            ret.append('  %s: %s' % (repoid, error))
+    return ret
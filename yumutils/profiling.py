@@ -0,0 +1,174 @@
+#!/usr/bin/python -tt
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Library General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+
+"""
+The yumutils.profiling python module for the --profile option of the utils,
+timing the phases of a run (config, repo setup, sack setup, ...)
+"""
+
+import os
+import sys
+import time
+import resource
+
+_sql_queries = 0
+
+def _count_sql(executeSQL):
+    def counted(cursor, query, params=None):
+        global _sql_queries
+        _sql_queries += 1
+        if params is None:
+            return executeSQL(cursor, query)
+        return executeSQL(cursor, query, params)
+    counted._yumutils_counted = True
+    return counted
+
+def _install_sql_counter():
+    '''
+    Count the sqlite queries yum makes, they all go through executeSQL() in
+    yum.sqlutils (which the sqlite sack and rpmdb cache import directly).
+    '''
+    try:
+        import yum.sqlutils
+        import yum.sqlitesack
+    except ImportError:
+        return
+    for mod in (yum.sqlutils, yum.sqlitesack):
+        func = getattr(mod, 'executeSQL', None)
+        if func is not None and not hasattr(func, '_yumutils_counted'):
+            mod.executeSQL = _count_sql(func)
+
+def snapshot():
+    '''
+    Now, for the start of a phase which begins before the profiler can be
+    made, Eg. the config. setup which parses the options. See phase().
+    '''
+    times = os.times()
+    return (time.time(), times[0] + times[1], _sql_queries)
+
+def _peak_rss():
+    ''' Peak RSS of this process so far, in KB. '''
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+class PhaseProfiler:
+    '''
+    Times the phases of a run, one after another, call phase() at the start
+    of each one and done() at the end to print the wall time, CPU time, peak
+    RSS and number of sqlite queries of each phase.
+    '''
+
+    def __init__(self, dumpfile=None, out=sys.stderr):
+        self.dumpfile = dumpfile
+        self.out = out
+        self.phases = []
+        self._current = None
+        self._cprofile = None
+        _install_sql_counter()
+
+    def _now(self):
+        return snapshot()
+
+    def _end(self):
+        if self._current is None:
+            return
+        name, (wall, cpu, sql) = self._current
+        (nwall, ncpu, nsql) = self._now()
+        phase = [name, nwall - wall, ncpu - cpu, _peak_rss(), nsql - sql]
+        #  A phase can happen more than once (Eg. a query per line in batch
+        # mode), add them up.
+        for old in self.phases:
+            if old[0] == name:
+                old[1] += phase[1]
+                old[2] += phase[2]
+                old[3] = max(old[3], phase[3])
+                old[4] += phase[4]
+                break
+        else:
+            self.phases.append(phase)
+        self._current = None
+
+    def phase(self, name, since=None):
+        '''
+        End the current phase (if any), and start the named one, now or at
+        the since snapshot().
+        '''
+        self._end()
+        if since is None:
+            since = self._now()
+        self._current = (name, since)
+
+    def runcall(self, func, *args, **kwargs):
+        '''
+        Call func, under cProfile if we have a dumpfile. This is for the hot
+        loop of a phase, the stats of all the calls are written to the
+        dumpfile (for pstats) by done().
+        '''
+        if not self.dumpfile:
+            return func(*args, **kwargs)
+        if self._cprofile is None:
+            import cProfile
+            self._cprofile = cProfile.Profile()
+        return self._cprofile.runcall(func, *args, **kwargs)
+
+    def done(self):
+        ''' End the current phase and print the report. '''
+        self._end()
+        if not self.phases:
+            return
+        out = self.out
+        print >> out, "%-16s %9s %9s %11s %8s" % ("Phase", "Wall", "CPU",
+                                                 "Peak RSS", "SQL")
+        for (name, wall, cpu, rss, sql) in self.phases:
+            print >> out, "%-16s %8.3fs %8.3fs %8.1f MB %8d" % (name, wall, cpu,
+                                                               rss / 1024.0,
+                                                               sql)
+        print >> out, "%-16s %8.3fs %8.3fs %8.1f MB %8d" % (
+            "total",
+            sum([phase[1] for phase in self.phases]),
+            sum([phase[2] for phase in self.phases]),
+            max([phase[3] for phase in self.phases]) / 1024.0,
+            sum([phase[4] for phase in self.phases]))
+        if self._cprofile is not None:
+            self._cprofile.dump_stats(self.dumpfile)
+            self._cprofile = None
+            print >> out, "cProfile stats written to %s" % self.dumpfile
+        self.phases = []
+
+class NoProfiler:
+    ''' What tools use without --profile, so they don't need to check. '''
+
+    def phase(self, name, since=None):
+        pass
+
+    def runcall(self, func, *args, **kwargs):
+        return func(*args, **kwargs)
+
+    def done(self):
+        pass
+
+def add_profile_option(parser):
+    ''' Add the --profile option to an OptionParser (or option group). '''
+    parser.add_option("--profile", default=False, action="store_true",
+                      help="print the time, CPU time, peak memory and sqlite "
+                           "queries of each phase of the run to stderr")
+
+def get_profiler(enabled, dumpfile=None):
+    '''
+    Return a PhaseProfiler if enabled (or there is a dumpfile), else a
+    NoProfiler.
+    '''
+    if enabled or dumpfile:
+        return PhaseProfiler(dumpfile)
+    return NoProfiler()